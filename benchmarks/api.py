@@ -0,0 +1,351 @@
+# Run from the repository root as a module, so simplefiles is importable:
+#   python -m benchmarks.api --help
+
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from dataclasses import dataclass, field
+from datetime import datetime as dt, timezone as tz
+from multiprocessing.connection import Connection
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from aiohttp import ClientSession, FormData, TCPConnector, web
+
+from simplefiles.app import create_app
+from simplefiles.config import create_from_mapping
+
+
+LAG_INTERVAL = 0.005
+OPERATIONS = ("upload", "duplicate", "show", "download")
+SIZE_UNITS = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    # "upload=40,duplicate=10,show=30,download=20"
+    mix: dict[str, float] = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {OPERATIONS}")
+        mix[name] = float(weight)
+    return mix
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().lower().removesuffix("ib").removesuffix("b")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)] if ordered else 0.0
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        "mean_ms": (sum(ordered) / len(ordered) if ordered else 0.0) * 1000,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+# Server side: runs in its own process so the client's work does not show
+# up in the server's event-loop lag.
+
+async def measure_lag(lags: list[float]) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - started - LAG_INTERVAL)
+
+
+async def serve(mapping: dict[str, Any], control: Connection) -> None:
+    app = await create_app(create_from_mapping(mapping))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    control.send(site._server.sockets[0].getsockname()[1])  # type: ignore[union-attr]
+    loop = asyncio.get_running_loop()
+    lags: list[float] = []
+    monitor: asyncio.Task[None] | None = None
+    while True:
+        # "measure" starts a fresh lag series, "stop" reports it and exits
+        command = await loop.run_in_executor(None, control.recv)
+        if command == "measure" and monitor is None:
+            monitor = asyncio.create_task(measure_lag(lags))
+        elif command == "stop":
+            break
+    if monitor is not None:
+        monitor.cancel()
+    await runner.cleanup()
+    control.send(summarize(lags))
+
+
+def run_server(mapping: dict[str, Any], control: Connection) -> None:
+    asyncio.run(serve(mapping, control))
+
+
+# Client side
+
+@dataclass
+class OperationStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    bytes: int = 0
+
+
+class Workload:
+    def __init__(self, session: ClientSession, base: str, args: Namespace) -> None:
+        self.session = session
+        self.base = base
+        self.sizes = [parse_size(size) for size in args.sizes.split(",")]
+        self.payload = random.Random(args.seed).randbytes(max(self.sizes))
+        self.uploaded: list[tuple[int, int]] = []  # (size, serial) of unique uploads
+        self.ids: list[int] = []
+        self.serial = 0
+
+    def content(self, size: int, serial: int) -> bytes:
+        # A serial number in front makes every unique upload hash differently
+        # without generating fresh random data per request.
+        return serial.to_bytes(16, "big") + self.payload[:max(size - 16, 0)]
+
+    async def store(self, data: bytes) -> bool:
+        form = FormData()
+        form.add_field("file", data, filename="bench.bin", content_type="application/octet-stream")
+        async with self.session.post(f"{self.base}/api/store", data=form) as response:
+            await response.read()
+            return response.status == 200
+
+    async def upload(self, rng: random.Random) -> tuple[bool, int]:
+        size = rng.choice(self.sizes)
+        self.serial += 1
+        serial = self.serial
+        ok = await self.store(self.content(size, serial))
+        if ok:
+            self.uploaded.append((size, serial))
+        return ok, size
+
+    async def duplicate(self, rng: random.Random) -> tuple[bool, int]:
+        size, serial = rng.choice(self.uploaded)
+        return await self.store(self.content(size, serial)), size
+
+    async def show(self, rng: random.Random) -> tuple[bool, int]:
+        async with self.session.get(f"{self.base}/api/show", json={"id": rng.choice(self.ids)}) as response:
+            body = await response.read()
+            return response.status == 200, len(body)
+
+    async def download(self, rng: random.Random) -> tuple[bool, int]:
+        async with self.session.get(f"{self.base}/api/download", params={"id": rng.choice(self.ids)}) as response:
+            received = 0
+            async for chunk in response.content.iter_any():
+                received += len(chunk)
+            return response.status == 200, received
+
+    async def seed(self, count: int, rng: random.Random) -> None:
+        for _ in range(count):
+            await self.upload(rng)
+        cursor = None
+        while True:
+            params = {"limit": "1000", **({"cursor": cursor} if cursor else {})}
+            async with self.session.get(f"{self.base}/api/medias", params=params) as response:
+                page = await response.json()
+            self.ids.extend(item["media_id"] for item in page["items"])
+            cursor = page["next"]
+            if cursor is None:
+                break
+
+
+async def worker(
+    workload: Workload,
+    operations: dict[str, Callable[[random.Random], Awaitable[tuple[bool, int]]]],
+    weights: list[float],
+    rng: random.Random,
+    deadline: float,
+    stats: dict[str, OperationStats],
+) -> None:
+    names = list(operations)
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        started = time.perf_counter()
+        try:
+            ok, size = await operations[name](rng)
+        except OSError:
+            ok, size = False, 0
+        elapsed = time.perf_counter() - started
+        if ok:
+            stats[name].latencies.append(elapsed)
+            stats[name].bytes += size
+        else:
+            stats[name].errors += 1
+
+
+async def drive(args: Namespace, port: int, control: Connection) -> dict[str, Any]:
+    mix = parse_mix(args.mix)
+    base = f"http://127.0.0.1:{port}"
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as session:
+        workload = Workload(session, base, args)
+        await workload.seed(args.seed_files, random.Random(args.seed))
+        operations = {name: getattr(workload, name) for name in mix}
+        stats = {name: OperationStats() for name in mix}
+        control.send("measure")
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(
+            worker(workload, operations, list(mix.values()), random.Random(args.seed + i), deadline, stats)
+            for i in range(args.concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+    completed = sum(len(op.latencies) for op in stats.values())
+    return {
+        "elapsed_s": elapsed,
+        "throughput_rps": completed / elapsed,
+        "errors": sum(op.errors for op in stats.values()),
+        "latency": summarize([latency for op in stats.values() for latency in op.latencies]),
+        "operations": {
+            name: {
+                "count": len(op.latencies),
+                "errors": op.errors,
+                "throughput_rps": len(op.latencies) / elapsed,
+                "throughput_mbps": op.bytes / elapsed / 1e6,
+                **summarize(op.latencies),
+            }
+            for name, op in stats.items()
+        },
+    }
+
+
+def report(result: dict[str, Any]) -> None:
+    print(
+        f"{'operation':>10} {'count':>7} {'err':>5} {'req/s':>9} {'MB/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}",
+        file=sys.stderr,
+    )
+    rows = [*result["operations"].items(), ("total", {
+        "count": sum(op["count"] for op in result["operations"].values()),
+        "errors": result["errors"],
+        "throughput_rps": result["throughput_rps"],
+        "throughput_mbps": sum(op["throughput_mbps"] for op in result["operations"].values()),
+        **result["latency"],
+    })]
+    for name, op in rows:
+        print(
+            f"{name:>10} {op['count']:>7} {op['errors']:>5} {op['throughput_rps']:>9.1f} "
+            f"{op['throughput_mbps']:>8.1f} {op['p50_ms']:>8.2f} {op['p95_ms']:>8.2f} {op['p99_ms']:>8.2f}",
+            file=sys.stderr,
+        )
+    lag = result["loop_lag"]
+    print(
+        f"server loop lag: p50={lag['p50_ms']:.2f} ms p99={lag['p99_ms']:.2f} ms max={lag['max_ms']:.2f} ms",
+        file=sys.stderr,
+    )
+
+
+def compare(result: dict[str, Any], baseline: dict[str, Any]) -> None:
+    print(f"change against {baseline.get('label') or 'baseline'}:", file=sys.stderr)
+    for name, op in result["operations"].items():
+        before = baseline.get("operations", {}).get(name)
+        if not before:
+            continue
+        deltas = "  ".join(
+            f"{key}={(op[key] / before[key] - 1) * 100:+6.1f}%"
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+            if before[key]
+        )
+        print(f"{name:>10} {deltas}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m benchmarks.api",
+        description="HTTP API load test against a throwaway server",
+    )
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--mix", default="upload=30,duplicate=10,show=35,download=25",
+        help="Relative weights of the operations",
+    )
+    parser.add_argument("--sizes", default="4KiB,64KiB,1MiB", help="Upload sizes, picked uniformly")
+    parser.add_argument("--seed-files", type=int, default=200, help="Uploads made before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for payloads and operation order")
+    parser.add_argument("--output", type=Path, help="Write JSON results here instead of stdout")
+    parser.add_argument("--label", help="Name of this run in the results (defaults to the git revision)")
+    parser.add_argument("--baseline", type=Path, help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.seed_files < 1:
+        parser.error("--seed-files must be positive: show, download and duplicate pick from seeded files")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mapping = {
+            "app": {"host": "127.0.0.1", "port": 0},
+            "db": {"url": f"sqlite+aiosqlite:///{tmpdir}/bench.db"},
+            "storage": {"root": f"{tmpdir}/blobs"},
+            "log": {"level": "WARNING"},
+        }
+        control, server_control = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=run_server, args=(mapping, server_control))
+        server.start()
+        try:
+            port = control.recv()
+            result = asyncio.run(drive(args, port, control))
+            control.send("stop")
+            result["loop_lag"] = control.recv()
+        finally:
+            server.join(timeout=30)
+            if server.is_alive():
+                server.kill()
+
+    result = {
+        "label": args.label or git_revision(),
+        "timestamp": dt.now(tz.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            name: getattr(args, name)
+            for name in ("duration", "concurrency", "mix", "sizes", "seed_files", "seed")
+        },
+        **result,
+    }
+    report(result)
+    if args.baseline is not None:
+        compare(result, json.loads(args.baseline.read_text()))
+    output = json.dumps(result, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# Run from the repository root as a module, so simplefiles is importable:
+#   python -m benchmarks.db --help
+
+from __future__ import annotations
+
+import asyncio
+import tempfile
+import time
+from argparse import ArgumentParser
+from dataclasses import replace
+from pathlib import Path
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from simplefiles.app.db import FileInfo, registry
+from simplefiles.app.engine import create_engine
+from simplefiles.app.repository import MediaRepository
+from simplefiles.config import create_from_mapping
+from simplefiles.core.entities import MIMEType
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)] if ordered else 0.0
+
+
+async def writer(factory: async_sessionmaker[AsyncSession], worker: int, count: int, stats: Stats) -> None:
+    for i in range(count):
+        started = time.perf_counter()
+        try:
+            async with factory() as session:
+                repository = MediaRepository(session)
+                file = FileInfo(Path(f"{worker}-{i}"), f"{worker:032x}{i:032x}", i)
+                file = await repository.add_file_info(file)
+                await repository.add(f"{worker}-{i}.bin", MIMEType.APPLICATION, "octet-stream", file)
+        except OperationalError:
+            stats.errors += 1
+            continue
+        stats.latencies.append(time.perf_counter() - started)
+
+
+async def reader(factory: async_sessionmaker[AsyncSession], count: int, stats: Stats) -> None:
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            async with factory() as session:
+                await MediaRepository(session).page(limit=50)
+        except OperationalError:
+            stats.errors += 1
+            continue
+        stats.latencies.append(time.perf_counter() - started)
+
+
+async def run(name: str, engine: AsyncEngine, writers: int, readers: int, count: int) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(registry.metadata.create_all)
+    factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    writes, reads = Stats(), Stats()
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(writer(factory, worker, count, writes) for worker in range(writers)),
+        *(reader(factory, count, reads) for _ in range(readers)),
+    )
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+    for kind, stats in (("write", writes), ("read", reads)):
+        print(
+            f"{name:>7} {kind:>5}: {len(stats.latencies) / elapsed:8.1f} ops/s  "
+            f"p50={stats.percentile(0.50) * 1000:7.2f} ms p99={stats.percentile(0.99) * 1000:7.2f} ms  "
+            f"errors={stats.errors}"
+        )
+
+
+async def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m benchmarks.db",
+        description="Concurrent SQLite writers and readers, default vs tuned engine",
+    )
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--count", type=int, default=200, help="Operations per task")
+    args = parser.parse_args()
+    config = create_from_mapping({"app": {}, "db": {}})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = f"sqlite+aiosqlite:///{tmpdir}/before.db"
+        await run("before", create_async_engine(url), args.writers, args.readers, args.count)
+        config.db = replace(config.db, url=f"sqlite+aiosqlite:///{tmpdir}/after.db")
+        await run("after", create_engine(config), args.writers, args.readers, args.count)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
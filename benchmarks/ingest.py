@@ -0,0 +1,98 @@
+# Run from the repository root as a module, so simplefiles is importable:
+#   python -m benchmarks.ingest --help
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable
+
+import aiofiles
+
+from simplefiles.app.storage import MaterialTempFile
+
+
+LAG_INTERVAL = 0.005
+
+
+async def chunks(total: int, chunk_size: int) -> AsyncIterator[bytes]:
+    payload = os.urandom(chunk_size)
+    sent = 0
+    while sent < total:
+        chunk = payload[:min(chunk_size, total - sent)]
+        sent += len(chunk)
+        yield chunk
+        await asyncio.sleep(0)
+
+
+async def legacy_ingest(directory: Path, total: int, chunk_size: int, buffer_size: int) -> None:
+    hasher = hashlib.new("sha256")
+    path = directory / str(uuid.uuid4())
+    async with aiofiles.open(path, "wb") as file:
+        async for chunk in chunks(total, chunk_size):
+            await file.write(chunk)
+            hasher.update(chunk)
+    path.unlink()
+
+
+async def buffered_ingest(directory: Path, total: int, chunk_size: int, buffer_size: int) -> None:
+    async with MaterialTempFile.open(directory, buffer_size) as tmp:
+        async for chunk in chunks(total, chunk_size):
+            await tmp.write(chunk)
+
+
+async def measure_lag(lags: list[float], stop: asyncio.Event) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - started - LAG_INTERVAL)
+
+
+async def run(
+    name: str,
+    ingest: Callable[[Path, int, int, int], Awaitable[None]],
+    directory: Path, total: int, chunk_size: int, buffer_size: int,
+) -> None:
+    lags: list[float] = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(measure_lag(lags, stop))
+    started = time.perf_counter()
+    await ingest(directory, total, chunk_size, buffer_size)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    lags.sort()
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+    worst = lags[-1] if lags else 0.0
+    print(
+        f"{name:>9}: chunk={chunk_size:>8} buffer={buffer_size:>9} "
+        f"{total / elapsed / 1e6:8.1f} MB/s  "
+        f"loop lag p99={p99 * 1000:6.2f} ms max={worst * 1000:6.2f} ms"
+    )
+
+
+async def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m benchmarks.ingest",
+        description="Upload ingest throughput and event-loop lag",
+    )
+    parser.add_argument("--size", type=int, default=256, help="Upload size, MiB")
+    parser.add_argument("--chunk-size", type=int, default=64*1024)
+    parser.add_argument("--buffer-size", type=int, default=4*1024*1024)
+    args = parser.parse_args()
+    total = args.size * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmpdir:
+        directory = Path(tmpdir)
+        await run("before", legacy_ingest, directory, total, 1024, 0)
+        await run("after", buffered_ingest, directory, total, args.chunk_size, args.buffer_size)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
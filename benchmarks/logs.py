@@ -0,0 +1,152 @@
+# Run from the repository root as a module, so simplefiles is importable:
+#   python -m benchmarks.logs --help
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Awaitable, Callable, Iterator
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import make_mocked_request
+
+from simplefiles.app.logs import access_logger, log_event, log_requests, start_logging
+from simplefiles.config import LogOptions
+
+
+REQUEST_ATTRS = (
+    "charset", "content_type", "content_length",
+    "cookies", "forwarded", "headers", "http_range", "remote"
+)
+HEADERS = {
+    "Host": "localhost:8080",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/118.0",
+    "Accept": "*/*",
+    "Cookie": "session=0123456789abcdef; theme=dark",
+    "Authorization": "Bearer secret",
+}
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+def legacy_log_request(request: web.Request) -> None:
+    # The print-based logger that used to run in the store handler
+    print("\n\t".join((
+        "Got request from %(remote)s (%(forwarded)s):",
+        "headers: %(headers)s",
+        "content_length: %(content_length)s",
+        "content_type: %(content_type)s",
+        "charset: %(charset)s",
+        "cookies: %(cookies)s",
+        "http_range: %(http_range)s",
+        "remote: %(remote)s",
+        "forwarded: %(forwarded)s",
+    )) % {name: getattr(request, name) for name in REQUEST_ATTRS})
+
+
+def structured_log_request(request: web.Request) -> None:
+    log_event(
+        access_logger, logging.INFO, "request",
+        method=request.method, path=request.path, status=200,
+        duration_ms=0.1, remote=request.remote, content_length=request.content_length,
+    )
+
+
+@web.middleware
+async def legacy_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    legacy_log_request(request)
+    return await handler(request)
+
+
+@contextlib.contextmanager
+def redirected(sample_rate: float) -> Iterator[None]:
+    # Both loggers write to /dev/null so the terminal does not skew results;
+    # the structured one is started with the requested sampling.
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = sys.stderr = devnull
+        listener = start_logging(LogOptions(sample_rate=sample_rate))
+        try:
+            yield
+        finally:
+            listener.stop()
+            sys.stdout, sys.stderr = stdout, stderr
+
+
+def emit_cost(emit: Callable[[web.Request], None], count: int) -> float:
+    request = make_mocked_request("GET", "/api/show?id=1&token=abc", headers=HEADERS)
+    started = time.perf_counter()
+    for _ in range(count):
+        emit(request)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+async def hello(request: web.Request) -> web.StreamResponse:
+    return web.Response(text="ok")
+
+
+async def serve(middlewares: list[Handler], concurrency: int, duration: float) -> float:
+    app = web.Application(middlewares=middlewares)
+    app.router.add_get("/", hello)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(session: ClientSession) -> None:
+        nonlocal done
+        while time.perf_counter() < deadline:
+            async with session.get(f"http://127.0.0.1:{port}/", headers=HEADERS) as response:
+                await response.read()
+            done += 1
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await runner.cleanup()
+    return done / elapsed
+
+
+async def main() -> None:
+    parser = ArgumentParser(
+        prog="python -m benchmarks.logs",
+        description="Per-request logging overhead: print-based vs queued structured logger",
+    )
+    parser.add_argument("--count", type=int, default=100_000, help="Records for the emit micro-benchmark")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per HTTP run")
+    parser.add_argument("--sample-rate", type=float, default=0.1)
+    args = parser.parse_args()
+
+    sampled = f"sampled {args.sample_rate:g}"
+    emits: list[tuple[str, float]] = []
+    results: list[tuple[str, float]] = []
+    with redirected(1.0):
+        emits.append(("print", emit_cost(legacy_log_request, args.count)))
+        emits.append(("structured", emit_cost(structured_log_request, args.count)))
+        results.append(("none", await serve([], args.concurrency, args.duration)))
+        results.append(("print", await serve([legacy_middleware], args.concurrency, args.duration)))
+        results.append(("structured", await serve([log_requests], args.concurrency, args.duration)))
+    with redirected(args.sample_rate):
+        emits.append((sampled, emit_cost(structured_log_request, args.count)))
+        results.append((sampled, await serve([log_requests], args.concurrency, args.duration)))
+
+    for name, per_call in emits:
+        print(f"{name:>14} emit: {per_call:8.2f} us/request on the event loop")
+    baseline = results[0][1]
+    for name, rps in results:
+        overhead = (1 / rps - 1 / baseline) * 1e6
+        print(f"{name:>14} http: {rps:8.1f} req/s  overhead {overhead:+7.2f} us/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,15 +1,25 @@
+import asyncio
 import sys
 from pathlib import Path
 
 from aiohttp import web
 
 from .app import create_app
+from .app.commands import import_tree, reshard, scrub
+from .app.workers import serve_workers
 from .config import create_from_mapping, Config
 
 
 def run(config: Config) -> None:
+    if config.app.workers > 1:
+        serve_workers(config)
+        return
     app = create_app(config)
-    web.run_app(app, host=config.app.host, port=config.app.port)
+    # Requests are logged by the app's own middleware.
+    web.run_app(
+        app, host=config.app.host, port=config.app.port, access_log=None,
+        shutdown_timeout=config.app.shutdown_timeout,
+    )
 
 
 if __name__ == "__main__":
@@ -23,6 +33,42 @@ if __name__ == "__main__":
         type=Path, required=False,
         help='Path to config file'
     )
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='Run HTTP server (default)')
+    reshard_parser = commands.add_parser(
+        'reshard', help='Move blobs from a flat directory into the sharded store'
+    )
+    reshard_parser.add_argument(
+        'source', type=Path, nargs='?',
+        help='Flat directory to migrate (defaults to the storage root)'
+    )
+    import_parser = commands.add_parser(
+        'import', help='Hash a directory tree and add its files to the store'
+    )
+    import_parser.add_argument('source', type=Path, help='Directory to import')
+    import_parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Hashing processes (defaults to the number of CPUs)'
+    )
+    import_parser.add_argument(
+        '--copy', action='store_true',
+        help='Copy files into the store instead of hard-linking them'
+    )
+    scrub_parser = commands.add_parser(
+        'scrub', help='Re-hash stored blobs and flag corrupt or missing ones'
+    )
+    scrub_parser.add_argument(
+        '--all', dest='everything', action='store_true',
+        help='Verify every blob, not only those past the scrub period'
+    )
+    scrub_parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Hashing processes (defaults to scrub.workers)'
+    )
+    scrub_parser.add_argument(
+        '--rate', type=float, default=None,
+        help='Read budget in MB/s, 0 for none (defaults to scrub.rate)'
+    )
 
     args = parser.parse_args()
     config_path: Path | None = args.config
@@ -32,4 +78,23 @@ if __name__ == "__main__":
     with config_path.open() as config_file:
         config_toml = tomlkit.load(config_file)
     config = create_from_mapping(config_toml)
-    run(config)
+    match args.command:
+        case 'reshard':
+            moved = asyncio.run(reshard(config, args.source))
+            print(f"Moved {moved} blobs")
+        case 'import':
+            stats = asyncio.run(import_tree(
+                config, args.source, args.workers, args.copy,
+                progress=lambda stats: print(f"Import: {stats}", flush=True),
+            ))
+            print(f"Done: {stats}")
+        case 'scrub':
+            rate = None if args.rate is None else int(args.rate * 1e6)
+            stats = asyncio.run(scrub(
+                config, args.everything, args.workers, rate,
+                progress=lambda stats: print(f"Scrub: {stats}", flush=True),
+            ))
+            print(f"Done: {stats}")
+            sys.exit(1 if stats.failed else 0)
+        case _:
+            run(config)
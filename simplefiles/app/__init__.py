@@ -1,98 +1,62 @@
 from __future__ import annotations
 
+import base64
 import dataclasses
-import hashlib
-import uuid
-from contextlib import asynccontextmanager
-from datetime import datetime as dt, timezone as tz
-from functools import wraps
+import json
+import logging
+from datetime import datetime as dt, timedelta as td, timezone as tz
+from functools import partial, wraps
 from pathlib import Path
-from typing import AsyncIterator, Awaitable, Callable, TypeVar
+from typing import Any, Awaitable, Callable, Mapping
 
-import aiofiles
 from aiohttp import web
-from sqlalchemy.sql import text
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import joinedload
-
-from simplefiles.config import Config
-from simplefiles.core import entities
-from simplefiles.core.entities import TempFile, MIMEType, MIMESubtype, AudiosMIME, ImagesMIME, VideosMIME
-from .db import Audio, Image, Video, File, FileInfo, Media
-from .db import registry
-
-
-REQUEST_ATTRS = (
-    "charset", "content_type", "content_length",
-    "cookies", "forwarded", "headers", "http_range", "remote"
-)
-
-
-class MaterialTempFile(TempFile):
-    _path: Path
-    _file: aiofiles.threadpool.binary.AsyncBufferedIOBase
-
-    def __init__(self, directory: Path | None) -> None:
-        tmpdir = directory or (Path.cwd() / "tmp")
-        self._path = tmpdir / str(uuid.uuid4())
-        self._hasher = hashlib.new("sha256")
-        self._size = 0
-
-    @property
-    def hash(self) -> bytes:
-        return self._hasher.digest()
-
-    @property
-    def size(self) -> int:
-        return self._size
-
-    @classmethod
-    @asynccontextmanager
-    async def open(cls: type[_MTF], directory: Path | None = None) -> AsyncIterator[_MTF]:
-        tempfile = cls(directory)
-        await tempfile._open()
-        yield tempfile
-        await tempfile.close()
-        tempfile._path.unlink(missing_ok=True)
-
-    async def _open(self) -> None:
-        self._file = await aiofiles.open(self._path, "wb")
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-    async def write(self, data: bytes) -> None:
-        await self._file.write(data)
-        self._hasher.update(data)
-        self._size += len(data)
-
-    async def close(self) -> None:
-        await self._file.close()
-
-    async def materialize(self, path: str | Path, exists_ok: bool = False) -> None:
-        target_path = Path(path)
-        if target_path.exists() and not exists_ok:
-            raise RuntimeError
-        self._path.rename(path)
-
-
-_MTF = TypeVar("_MTF", bound=MaterialTempFile)
-
-
-def utcnow() -> dt:
-    return dt.now(tz.utc)
-
-
-def log_request(request: web.Request) -> None:
-    print("\n\t".join((
-        "Got request from %(remote)s (%(forwarded)s):",
-        "headers: %(headers)s",
-        "content_length: %(content_length)s",
-        "content_type: %(content_type)s",
-        "charset: %(charset)s",
-        "cookies: %(cookies)s",
-        "http_range: %(http_range)s",
-        "remote: %(remote)s",
-        "forwarded: %(forwarded)s",
-    )) % {name: getattr(request, name) for name in REQUEST_ATTRS})
+from simplefiles.config import Config, UploadOptions
+from simplefiles.core.entities import BlobStore, MIMEType, MIMESubtype
+from .db import FileInfo, Media
+from .db import registry
+from .admission import UploadAdmission
+from .archive import parse_ids, send_archive
+from .cache import BlobCache
+from .collector import GarbageCollector, close_collector, start_collector
+from .compression import CompressionManager, close_compression, send_compressed
+from .engine import create_engine
+from .logs import log_event, log_requests, logger, start_logging, stop_logging
+from .metrics import INGESTED_BYTES, instrument_executor, metrics, record_stored, track_requests
+from .mime import parse_content_type, sniff
+from .previews import PreviewManager, close_previews, preview
+from .repository import MediaRepository, fts_query
+from .responses import IMMUTABLE, send_blob
+from .scrubber import Scrubber, close_scrubber, start_scrubber
+from .storage import HASH_PATTERN, FileSystemBlobStore
+from .uploads import UploadManager, create_upload, upload_status, put_chunk, finalize_upload, abort_upload
+from .uploads import instant_upload, resolve_upload_type
+
+
+BATCH_LIMIT = 1000
+PAGE_SIZE = 50
+
+# (method, route) pairs counted by the in-flight transfers gauge
+TRANSFERS = {
+    ("POST", "/api/store"): "upload",
+    ("PUT", "/api/uploads/{upload_id}"): "upload",
+    ("GET", "/api/download"): "download",
+    ("GET", "/api/archive"): "download",
+    ("GET", "/api/preview"): "download",
+    ("GET", "/blob/{hash}"): "download",
+}
+
+
+def json_default(obj: object) -> str | float:
+    match obj:
+        case dt(): return obj.isoformat()
+        case td(): return obj.total_seconds()
+        case Path(): return obj.name
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+dumps: Callable[[Any], str] = partial(json.dumps, default=json_default)
 
 
 def redirect(target: str) -> Callable[[web.Request], Awaitable[web.StreamResponse]]:
@@ -119,72 +83,67 @@ def make_wrapper(
     return wrap
 
 
-def parse_content_type(string: str) -> tuple[MIMEType, MIMESubtype]:
-    try:
-        type_str, subtype_str = string.split("/", maxsplit=1)
-    except TypeError as e:
-        raise ValueError(f"{string!r} is not valid MIME type.") from e
-    mime_type = MIMEType(type_str)
-    SubType: type[MIMESubtype] = str
-    match mime_type:
-        case MIMEType.AUDIO: SubType = AudiosMIME
-        case MIMEType.IMAGE: SubType = ImagesMIME
-        case MIMEType.VIDEO: SubType = VideosMIME
-    try:
-        mime_subtype = SubType(subtype_str)
-    except ValueError:
-        mime_subtype = subtype_str
-    return mime_type, mime_subtype
-
-
-async def store(request: web.Request, session: AsyncSession) -> web.StreamResponse:
-    log_request(request)
-    parts = await request.multipart()
-    async for part in parts:
-        print()
-        print(
-            "Got part!",
-            f"Name: {part.name}",
-            f"Filename: {part.filename}",
-            f"Headers: {part.headers}",
-            sep="\n\t"
-        )
-        content_type = part.headers.get("Content-Type", "application/octet-stream")
-        mime_type, mime_subtype = parse_content_type(content_type)
-        file_name = part.filename
-        if file_name is None:
-            raise web.HTTPBadRequest(text="'name' field of 'Content-Disposition' header is not set")
-        if part.name == 'file':
-            async with MaterialTempFile.open() as tmp:
-                while chunk := await part.read_chunk(1024*1):
-                    await tmp.write(chunk)
-                file_hash = tmp.hash.hex()
-                file_path = Path.cwd() / "tmp" / file_hash
-                await tmp.materialize(file_path, exists_ok=True)
-            file = FileInfo(file_path, file_hash, tmp.size)
-            try:
-                session.add(file)
-                await session.commit()
-            except IntegrityError:
-                await session.rollback()
-                file = await session.get(FileInfo, file_hash)  # type: ignore
-            media: entities.Media
-            match mime_type:
-                case MIMEType.APPLICATION: media = File(file_name, file, mime_subtype, utcnow())
-                case MIMEType.AUDIO: media = Audio(file_name, file, mime_subtype, utcnow())
-                case MIMEType.CHEMICAL: media = File(file_name, file, mime_subtype, utcnow())
-                case MIMEType.FONT: media = File(file_name, file, mime_subtype, utcnow())
-                case MIMEType.IMAGE: media = Image(file_name, file, mime_subtype, utcnow())
-                case MIMEType.VIDEO: media = Video(file_name, file, mime_subtype, utcnow())
-                case _: media = File(file_name, file, mime_subtype, utcnow())
-            try:
-                session.add(media)
-            finally:
-                await session.commit()
-            print(f"\tHash: {tmp.hash.hex()}\n\tSize: {tmp.size}")
-        if part.filename == "7oYT8NfEETQ.jpg":
-            raise RuntimeError
-    print()
+async def store(request: web.Request) -> web.StreamResponse:
+    options: UploadOptions = request.app["config"].upload
+    blobs: BlobStore = request.app["blobs"]
+    sessions: async_sessionmaker[AsyncSession] = request.app["sessions"]
+    length = request.content_length
+    if length is not None and length > options.max_request_size:
+        raise web.HTTPRequestEntityTooLarge(options.max_request_size, length)
+    max_size = options.max_request_size
+    if length is None:
+        # Admitted as a fixed reservation and held to it while streaming,
+        # rather than taking the whole budget (see UploadOptions).
+        if not options.unknown_length_size:
+            raise web.HTTPLengthRequired()
+        max_size = min(options.unknown_length_size, max_size)
+    async with request.app["admission"].admit(max_size if length is None else length):
+        parts = await request.multipart()
+        received = 0
+        async for part in parts:
+            content_type = part.headers.get("Content-Type", "application/octet-stream")
+            log_event(
+                logger, logging.DEBUG, "multipart part",
+                name=part.name, filename=part.filename, content_type=content_type,
+            )
+            declared = parse_content_type(content_type)
+            file_name = part.filename
+            if file_name is None:
+                raise web.HTTPBadRequest(text="'name' field of 'Content-Disposition' header is not set")
+            if part.name == 'file':
+                async with blobs.tempfile() as tmp:
+                    chunk = await part.read_chunk(options.chunk_size)
+                    mime_type, mime_subtype = resolve_upload_type(request, declared, sniff(chunk))
+                    while chunk:
+                        received += len(chunk)
+                        if tmp.size + len(chunk) > options.max_file_size:
+                            raise web.HTTPRequestEntityTooLarge(options.max_file_size, tmp.size + len(chunk))
+                        if received > max_size:
+                            raise web.HTTPRequestEntityTooLarge(max_size, received)
+                        await tmp.write(chunk)
+                        chunk = await part.read_chunk(options.chunk_size)
+                    await tmp.close()
+                    file_hash = tmp.hash.hex()
+                    file_path = blobs.locate(file_hash)
+                    INGESTED_BYTES.inc(tmp.size)
+                    # The transfer is over: only the metadata commit needs a connection.
+                    async with sessions() as session:
+                        repository = MediaRepository(session)
+                        info = FileInfo(file_path, file_hash, tmp.size)
+                        file = await repository.add_file_info(info)
+                        record_stored(deduplicated=file is not info)
+                        # Published once the row is ours: a blob the collector
+                        # removed before that is put back.
+                        await tmp.materialize(file_path, exists_ok=True)
+                        media = await repository.add(file_name, mime_type, mime_subtype, file, tmp.metadata)
+                request.app["previews"].schedule(media)
+                log_event(
+                    logger, logging.INFO, "stored",
+                    media_id=media.media_id, hash=file_hash, size=tmp.size,
+                    type=f"{mime_type}/{mime_subtype}",
+                )
+            if part.filename == "7oYT8NfEETQ.jpg":
+                raise RuntimeError
     return web.json_response({})
 
 
@@ -195,19 +154,144 @@ async def show(request: web.Request, session: AsyncSession) -> web.StreamRespons
     id = data.get("id")
     if not isinstance(id, int):
         raise web.HTTPBadRequest()
-    media_info = await session.get(Media, id)
-    if media_info is None:
-        raise web.HTTPNotFound()
-    media: Media | None
-    match media_info.type:
-        case MIMEType.AUDIO: media = await session.get(Audio, id)
-        case MIMEType.IMAGE: media = await session.get(Image, id)
-        case MIMEType.VIDEO: media = await session.get(Video, id)
-        case _: media = await session.get(File, id)
+    media = await MediaRepository(session).get(id)
     if media is None:
         raise web.HTTPNotFound()
     info = dataclasses.asdict(media)
-    return web.json_response(info)
+    return web.json_response(info, dumps=dumps)
+
+
+async def show_batch(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest()
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        raise web.HTTPBadRequest()
+    if len(ids) > BATCH_LIMIT:
+        raise web.HTTPRequestEntityTooLarge(BATCH_LIMIT, len(ids), text=f"At most {BATCH_LIMIT} ids per request")
+    medias = await MediaRepository(session).get_many(ids)
+    items: list[dict[str, Any]] = []
+    for id in ids:
+        media = medias.get(id)
+        if media is None:
+            items.append({"media_id": id, "error": "not found"})
+        else:
+            items.append(dataclasses.asdict(media))
+    return web.json_response({"items": items}, dumps=dumps)
+
+
+def pack_cursor(values: list[Any]) -> str:
+    raw = json.dumps(values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def unpack_cursor(cursor: str) -> Any:
+    return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+
+
+def encode_cursor(media: Media) -> str:
+    return pack_cursor([media.loaded_at.isoformat(), media.media_id])
+
+
+def decode_cursor(cursor: str) -> tuple[dt, int]:
+    try:
+        loaded_at, media_id = unpack_cursor(cursor)
+        return dt.fromisoformat(loaded_at), int(media_id)
+    except (ValueError, TypeError) as e:
+        raise web.HTTPBadRequest(text="Invalid cursor") from e
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    try:
+        score, media_id = unpack_cursor(cursor)
+        return float(score), int(media_id)
+    except (ValueError, TypeError) as e:
+        raise web.HTTPBadRequest(text="Invalid cursor") from e
+
+
+def parse_limit(query: Mapping[str, str]) -> int:
+    try:
+        limit = min(int(query.get("limit", PAGE_SIZE)), BATCH_LIMIT)
+    except ValueError:
+        raise web.HTTPBadRequest(text="'limit' must be integer")
+    if limit <= 0:
+        raise web.HTTPBadRequest(text="'limit' must be positive")
+    return limit
+
+
+def parse_type_filter(query: Mapping[str, str]) -> tuple[MIMEType | None, MIMESubtype | None]:
+    # "image" filters by type, "image/png" by type and subtype
+    if "type" not in query:
+        return None, None
+    content_type = query["type"]
+    if "/" not in content_type:
+        content_type += "/"
+    try:
+        mime_type, mime_subtype = parse_content_type(content_type)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{query['type']!r} is not valid MIME type")
+    return mime_type, mime_subtype or None
+
+
+def parse_timestamp(value: str | None) -> dt | None:
+    if value is None:
+        return None
+    try:
+        timestamp = dt.fromisoformat(value)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=f"{value!r} is not ISO 8601 timestamp") from e
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(tz.utc).replace(tzinfo=None)
+    return timestamp
+
+
+async def search_medias(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    query = request.query
+    match = fts_query(query.get("q", ""))
+    if match is None:
+        raise web.HTTPBadRequest(text="'q' must contain at least one word")
+    limit = parse_limit(query)
+    mime_type, mime_subtype = parse_type_filter(query)
+    cursor = query.get("cursor")
+    found = await MediaRepository(session).search(
+        match, mime_type, mime_subtype,
+        after=decode_search_cursor(cursor) if cursor else None,
+        limit=limit + 1,
+    )
+    items = [{**dataclasses.asdict(media), "score": score} for media, score in found[:limit]]
+    next_cursor = None
+    if len(found) > limit:
+        media, score = found[limit - 1]
+        next_cursor = pack_cursor([score, media.media_id])
+    return web.json_response({"items": items, "next": next_cursor}, dumps=dumps)
+
+
+async def delete_media(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    try:
+        media_id = int(request.match_info["media_id"])
+    except ValueError:
+        raise web.HTTPBadRequest()
+    if not await MediaRepository(session).delete(media_id):
+        raise web.HTTPNotFound()
+    return web.Response(status=204)
+
+
+async def list_medias(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    query = request.query
+    limit = parse_limit(query)
+    mime_type, mime_subtype = parse_type_filter(query)
+    cursor = query.get("cursor")
+    medias = await MediaRepository(session).page(
+        mime_type, mime_subtype,
+        since=parse_timestamp(query.get("since")),
+        until=parse_timestamp(query.get("until")),
+        before=decode_cursor(cursor) if cursor else None,
+        limit=limit + 1,
+    )
+    items = [dataclasses.asdict(media) for media in medias[:limit]]
+    next_cursor = encode_cursor(medias[limit - 1]) if len(medias) > limit else None
+    return web.json_response({"items": items, "next": next_cursor}, dumps=dumps)
 
 
 async def download(request: web.Request, session: AsyncSession) -> web.StreamResponse:
@@ -219,48 +303,93 @@ async def download(request: web.Request, session: AsyncSession) -> web.StreamRes
         id = int(id_raw)
     except ValueError:
         raise web.HTTPBadRequest()
-    media_info = await session.get(Media, id)
-    if media_info is None:
-        raise web.HTTPNotFound()
-    media: Media | None
-    match media_info.type:
-        case MIMEType.AUDIO: media = await session.get(Audio, id)
-        case MIMEType.IMAGE: media = await session.get(Image, id)
-        case MIMEType.VIDEO: media = await session.get(Video, id)
-        case _: media = await session.get(File, id)
+    media = await MediaRepository(session).get(id)
     if media is None:
         raise web.HTTPNotFound()
-    file_path = Path.cwd() / "tmp" / media.info.hash
-    response = web.StreamResponse(
-        status=200,
-        headers={
-            "Content-Disposition": f"attachment; filename={media.name}",
-            "Content-Type": f"{media.type}/{media.subtype}",
-            "Content-Length": str(media.info.size),
-        },
-    )
-    await response.prepare(request)
-    CHUNK_SIZE = 64*1024
-    async with aiofiles.open(file_path, "rb") as file:
-        chunk = await file.read(CHUNK_SIZE)
-        while chunk:
-            await response.write(chunk)
-            chunk = await file.read(CHUNK_SIZE)
-    return response
-
-
-async def create_app(config: Config) -> web.Application:
-    app = web.Application()
-    engine = create_async_engine("sqlite+aiosqlite:///tmp/test.db")
-    async with engine.begin() as conn:
-        await conn.execute(text("PRAGMA foreign_keys = 1"))
-        await conn.run_sync(registry.metadata.create_all)
-    sessions_factory = async_sessionmaker(engine, class_=AsyncSession)
+    headers = {
+        "Content-Disposition": f"attachment; filename={media.name}",
+        "Content-Type": f"{media.type}/{media.subtype}",
+        "Cache-Control": "no-cache",
+    }
+    return await send_compressed(request, session, media.info, (media.type, media.subtype), headers)
+
+
+async def archive(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    ids = parse_ids(request.query.get("ids", ""), BATCH_LIMIT)
+    return await send_archive(request, session, ids, "media.zip")
+
+
+async def blob(request: web.Request) -> web.StreamResponse:
+    hash = request.match_info["hash"].lower()
+    if not HASH_PATTERN.fullmatch(hash):
+        raise web.HTTPNotFound()
+    return await send_blob(request, hash, {"Cache-Control": IMMUTABLE})
+
+
+async def dispose_engine(app: web.Application) -> None:
+    await app["engine"].dispose()
+
+
+async def create_schema(config: Config) -> None:
+    engine = create_engine(config)
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(registry.metadata.create_all)
+    finally:
+        await engine.dispose()
+
+
+async def create_app(config: Config, init_schema: bool = True) -> web.Application:
+    app = web.Application(middlewares=[log_requests, track_requests(TRANSFERS)])
+    app["config"] = config
+    app["logs"] = start_logging(config.log)
+    blobs = FileSystemBlobStore.from_options(config.storage, config.upload.buffer_size)
+    app["blobs"] = blobs
+    app["uploads"] = UploadManager(blobs, config.upload)
+    app["admission"] = UploadAdmission(config.upload)
+    app["cache"] = BlobCache.from_options(config.cache)
+    # Worker processes get their own engine; the supervisor has already
+    # created the schema, so concurrent CREATE TABLEs never race.
+    engine = create_engine(config)
+    if init_schema:
+        async with engine.begin() as conn:
+            await conn.run_sync(registry.metadata.create_all)
+    app["engine"] = engine
+    sessions_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    # for handlers that must not hold a session while they transfer data
+    app["sessions"] = sessions_factory
+    app["previews"] = PreviewManager(blobs, sessions_factory, config.preview)
+    app["collector"] = GarbageCollector(blobs, sessions_factory, config.gc, app["cache"], app["uploads"])
+    app["compression"] = CompressionManager(blobs, sessions_factory, config.compression, config.upload.buffer_size)
+    app["scrubber"] = Scrubber(blobs, sessions_factory, config.scrub)
+    app.on_startup.append(instrument_executor)
+    app.on_startup.append(start_collector)
+    app.on_startup.append(start_scrubber)
+    app.on_cleanup.append(close_collector)
+    app.on_cleanup.append(close_previews)
+    app.on_cleanup.append(close_compression)
+    app.on_cleanup.append(close_scrubber)
+    app.on_cleanup.append(dispose_engine)
+    app.on_cleanup.append(stop_logging)
     wrap = make_wrapper(sessions_factory)
     static_dir = Path.cwd() / "webui"
     app.router.add_get("/", redirect("/index.html"))
-    app.router.add_static("/", static_dir)
-    app.router.add_post("/api/store", wrap(store))
+    app.router.add_post("/api/store", store)
     app.router.add_get("/api/show", wrap(show))
+    app.router.add_post("/api/show/batch", wrap(show_batch))
+    app.router.add_get("/api/medias", wrap(list_medias))
+    app.router.add_get("/api/search", wrap(search_medias))
+    app.router.add_delete("/api/medias/{media_id}", wrap(delete_media))
     app.router.add_get("/api/download", wrap(download))
+    app.router.add_get("/api/archive", wrap(archive))
+    app.router.add_get("/api/preview", preview)
+    app.router.add_get("/blob/{hash}", blob)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_post("/api/uploads", wrap(create_upload))
+    app.router.add_post("/api/uploads/instant", wrap(instant_upload))
+    app.router.add_get("/api/uploads/{upload_id}", wrap(upload_status))
+    app.router.add_put("/api/uploads/{upload_id}", put_chunk)
+    app.router.add_delete("/api/uploads/{upload_id}", wrap(abort_upload))
+    app.router.add_post("/api/uploads/{upload_id}/finalize", wrap(finalize_upload))
+    app.router.add_static("/", static_dir)
     return app
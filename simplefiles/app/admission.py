@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from aiohttp import hdrs, web
+
+from simplefiles.config import UploadOptions
+from .metrics import UPLOAD_BYTES_ADMITTED, UPLOAD_QUEUE, UPLOADS_ADMITTED, UPLOADS_REJECTED
+
+
+class UploadAdmission:
+    # Limits the uploads that transfer data at the same time, by count and
+    # by the bytes they declared. Waiters are admitted strictly in arrival
+    # order, so a large upload is not starved by a stream of small ones.
+    _waiters: deque[tuple[int, asyncio.Future[None]]]
+
+    def __init__(self, options: UploadOptions) -> None:
+        self._options = options
+        self._waiters = deque()
+        self.active = 0
+        self.admitted_bytes = 0
+        UPLOADS_ADMITTED.function = lambda: self.active
+        UPLOAD_BYTES_ADMITTED.function = lambda: self.admitted_bytes
+        UPLOAD_QUEUE.function = lambda: len(self._waiters)
+
+    @asynccontextmanager
+    async def admit(self, size: int) -> AsyncIterator[None]:
+        size = min(size, self._options.max_bytes_in_flight)
+        if not self._waiters and self._fits(size):
+            self._grant(size)
+        else:
+            await self._wait(size)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.admitted_bytes -= size
+            self._wake()
+
+    def _fits(self, size: int) -> bool:
+        if self.active >= self._options.max_concurrent:
+            return False
+        return self.active == 0 or self.admitted_bytes + size <= self._options.max_bytes_in_flight
+
+    def _grant(self, size: int) -> None:
+        self.active += 1
+        self.admitted_bytes += size
+
+    async def _wait(self, size: int) -> None:
+        if len(self._waiters) >= self._options.queue_size:
+            raise self._reject("queue_full")
+        waiter = (size, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), self._options.queue_timeout)
+        except BaseException as e:
+            if waiter[1].done():
+                # admitted just as the wait ended
+                self.active -= 1
+                self.admitted_bytes -= size
+            else:
+                waiter[1].cancel()
+                self._waiters.remove(waiter)
+            # either way the head of the queue may fit now
+            self._wake()
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("timeout") from None
+            raise
+
+    def _wake(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][0]):
+            size, future = self._waiters.popleft()
+            self._grant(size)
+            future.set_result(None)
+
+    def _reject(self, reason: str) -> web.HTTPServiceUnavailable:
+        UPLOADS_REJECTED.inc(labels=(reason,))
+        return web.HTTPServiceUnavailable(
+            headers={hdrs.RETRY_AFTER: str(self._options.retry_after)},
+            text="Too many uploads in progress, try again later",
+        )
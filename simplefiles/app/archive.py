@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import struct
+import zlib
+from dataclasses import dataclass
+from datetime import datetime as dt
+from pathlib import Path, PurePosixPath
+from typing import AsyncIterator, Iterable
+
+from aiohttp import hdrs, web
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from simplefiles.core.entities import BlobStore
+from .logs import log_event, logger
+from .repository import MediaRepository
+from .responses import CHUNK_SIZE
+
+
+# Archives are written in stored mode with the CRC in a data descriptor
+# after each member, so nothing is read twice and nothing is buffered; all
+# sizes come from files_info, which makes the whole layout, and with it
+# Content-Length, known before the first byte is sent.
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+VERSION = 20
+VERSION_ZIP64 = 45
+FLAGS = 0x0008 | 0x0800  # data descriptor follows, names are UTF-8
+UNIX_FILE = 0o100644 << 16
+MADE_BY_UNIX = 3 << 8
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+DESCRIPTOR = struct.Struct("<IIII")
+DESCRIPTOR_ZIP64 = struct.Struct("<IIQQ")
+END_RECORD = struct.Struct("<IHHHHIIH")
+END_RECORD_ZIP64 = struct.Struct("<IQHHIIQQQQ")
+END_LOCATOR_ZIP64 = struct.Struct("<IIQI")
+
+
+def dos_time(moment: dt) -> tuple[int, int]:
+    if moment.year < 1980:
+        return 0, (1 << 5) | 1
+    time = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+    date = ((moment.year - 1980) << 9) | (moment.month << 5) | moment.day
+    return time, date
+
+
+def member_name(name: str, taken: set[str]) -> str:
+    # Names come from uploads: keep only the last path component and make
+    # duplicates unique the way file managers do.
+    base = PurePosixPath(name.replace("\\", "/")).name or "file"
+    if base in (".", ".."):
+        base = "file"
+    candidate, number = base, 1
+    while candidate in taken:
+        number += 1
+        stem, dot, suffix = base.rpartition(".")
+        candidate = f"{stem} ({number}).{suffix}" if dot and stem else f"{base} ({number})"
+    taken.add(candidate)
+    return candidate
+
+
+@dataclass
+class ZipMember:
+    name: bytes
+    hash: str
+    size: int
+    time: int
+    date: int
+    offset: int = 0
+    crc: int = 0
+
+    @property
+    def zip64(self) -> bool:
+        return self.size >= ZIP64_LIMIT
+
+    def local_header(self) -> bytes:
+        if self.zip64:
+            # Sizes live in the ZIP64 extra field; all of them are repeated
+            # in the data descriptor.
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            sizes = ZIP64_LIMIT
+        else:
+            extra, sizes = b"", 0
+        return LOCAL_HEADER.pack(
+            0x04034B50, VERSION_ZIP64 if self.zip64 else VERSION, FLAGS, 0,
+            self.time, self.date, 0, sizes, sizes, len(self.name), len(extra),
+        ) + self.name + extra
+
+    def descriptor(self) -> bytes:
+        if self.zip64:
+            return DESCRIPTOR_ZIP64.pack(0x08074B50, self.crc, self.size, self.size)
+        return DESCRIPTOR.pack(0x08074B50, self.crc, self.size, self.size)
+
+    def central_header(self) -> bytes:
+        fields = [self.size, self.size] if self.zip64 else []
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+        extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields) if fields else b""
+        version = VERSION_ZIP64 if extra else VERSION
+        return CENTRAL_HEADER.pack(
+            0x02014B50, MADE_BY_UNIX | version, version, FLAGS, 0, self.time, self.date, self.crc,
+            min(self.size, ZIP64_LIMIT), min(self.size, ZIP64_LIMIT), len(self.name), len(extra), 0,
+            0, 0, UNIX_FILE, min(self.offset, ZIP64_LIMIT),
+        ) + self.name + extra
+
+    @property
+    def length(self) -> int:
+        # bytes from the local header through the data descriptor
+        extra = 20 if self.zip64 else 0
+        descriptor = DESCRIPTOR_ZIP64.size if self.zip64 else DESCRIPTOR.size
+        return LOCAL_HEADER.size + len(self.name) + extra + self.size + descriptor
+
+    @property
+    def central_length(self) -> int:
+        fields = (2 if self.zip64 else 0) + (self.offset >= ZIP64_LIMIT)
+        return CENTRAL_HEADER.size + len(self.name) + (4 + 8 * fields if fields else 0)
+
+
+class ZipLayout:
+    def __init__(self, members: list[ZipMember]) -> None:
+        self.members = members
+        offset = 0
+        for member in members:
+            member.offset = offset
+            offset += member.length
+        self.directory_offset = offset
+        self.directory_size = sum(member.central_length for member in members)
+        self.zip64 = (
+            len(members) >= ZIP64_COUNT_LIMIT
+            or self.directory_offset >= ZIP64_LIMIT
+            or self.directory_size >= ZIP64_LIMIT
+        )
+
+    @property
+    def content_length(self) -> int:
+        end = END_RECORD.size
+        if self.zip64:
+            end += END_RECORD_ZIP64.size + END_LOCATOR_ZIP64.size
+        return self.directory_offset + self.directory_size + end
+
+    def end(self) -> bytes:
+        count = len(self.members)
+        record = b""
+        if self.zip64:
+            end_offset = self.directory_offset + self.directory_size
+            record = END_RECORD_ZIP64.pack(
+                0x06064B50, END_RECORD_ZIP64.size - 12, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64,
+                0, 0, count, count, self.directory_size, self.directory_offset,
+            ) + END_LOCATOR_ZIP64.pack(0x07064B50, 0, end_offset, 1)
+        return record + END_RECORD.pack(
+            0x06054B50, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+            min(self.directory_size, ZIP64_LIMIT), min(self.directory_offset, ZIP64_LIMIT), 0,
+        )
+
+
+async def read_blob(blobs: BlobStore, hash: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    path = blobs.local_path(hash)
+    if path is None:
+        yield await blobs.read(hash)
+        return
+    loop = asyncio.get_running_loop()
+    file = await loop.run_in_executor(None, path.open, "rb")
+    try:
+        while chunk := await loop.run_in_executor(None, file.read, chunk_size):
+            yield chunk
+    finally:
+        await loop.run_in_executor(None, file.close)
+
+
+def check_sizes(paths: Iterable[tuple[Path, int]]) -> list[Path]:
+    # Content-Length is promised up front, so blobs whose file is missing or
+    # does not match files_info are refused before anything is sent.
+    broken = []
+    for path, size in paths:
+        try:
+            if path.stat().st_size != size:
+                broken.append(path)
+        except FileNotFoundError:
+            broken.append(path)
+    return broken
+
+
+def parse_ids(value: str, limit: int) -> list[int]:
+    try:
+        ids = [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        raise web.HTTPBadRequest(text="'ids' must be a comma-separated list of media ids")
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        raise web.HTTPBadRequest(text="'ids' must name at least one media")
+    if len(ids) > limit:
+        raise web.HTTPRequestEntityTooLarge(limit, len(ids), text=f"At most {limit} ids per request")
+    return ids
+
+
+async def send_archive(
+    request: web.Request, session: AsyncSession, ids: list[int], filename: str
+) -> web.StreamResponse:
+    blobs: BlobStore = request.app["blobs"]
+    medias = await MediaRepository(session).get_many(ids)
+    missing = [id for id in ids if id not in medias]
+    if missing:
+        raise web.HTTPNotFound(text=f"Media not found: {missing[:16]}")
+    taken: set[str] = set()
+    members = []
+    for id in ids:
+        media = medias[id]
+        time, date = dos_time(media.loaded_at)
+        name = member_name(media.name, taken).encode()
+        members.append(ZipMember(name, media.info.hash, media.info.size, time, date))
+    layout = ZipLayout(members)
+    paths = [(path, member.size) for member in members if (path := blobs.local_path(member.hash)) is not None]
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, check_sizes, paths):
+        raise web.HTTPConflict(text="Some of the files are not available")
+
+    response = web.StreamResponse(headers={
+        hdrs.CONTENT_TYPE: "application/zip",
+        hdrs.CONTENT_DISPOSITION: f"attachment; filename={filename}",
+        hdrs.CACHE_CONTROL: "no-cache",
+    })
+    response.content_length = layout.content_length
+    await response.prepare(request)
+    if request.method == hdrs.METH_HEAD:
+        return response
+    for member in members:
+        await response.write(member.local_header())
+        crc, written = 0, 0
+        async for chunk in read_blob(blobs, member.hash):
+            crc = zlib.crc32(chunk, crc)
+            written += len(chunk)
+            await response.write(chunk)
+        if written != member.size:
+            # The promised length can no longer be met; cut the connection
+            # rather than send a corrupt archive that looks complete.
+            log_event(logger, logging.ERROR, "archive member changed", hash=member.hash, size=member.size, read=written)
+            raise ConnectionResetError(f"Blob {member.hash} changed while being archived")
+        member.crc = crc
+        await response.write(member.descriptor())
+    await response.write(b"".join(member.central_header() for member in members))
+    await response.write(layout.end())
+    await response.write_eof()
+    return response
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import NamedTuple
+
+from simplefiles.config import CacheOptions
+from .metrics import BLOB_CACHE_BYTES, BLOB_CACHE_ENTRIES, BLOB_CACHE_EVICTIONS, BLOB_CACHE_HITS, BLOB_CACHE_MISSES
+
+
+class CachedBlob(NamedTuple):
+    data: bytes
+    mtime: float  # of the blob file, for Last-Modified and If-Modified-Since
+
+
+class BlobCache:
+    # LRU cache of small blobs, keyed by hash. Blobs are content-addressed,
+    # so an entry can never go stale: it only has to be dropped when the
+    # collector deletes the blob. Caches are per process; a worker that did
+    # not run the collection keeps its copy, which is harmless since nothing
+    # references the hash any more, and if the content is uploaded again
+    # the bytes are the same.
+    _entries: OrderedDict[str, CachedBlob]
+
+    def __init__(self, max_bytes: int, max_blob_size: int) -> None:
+        self.max_bytes = max_bytes
+        self.max_blob_size = min(max_blob_size, max_bytes)
+        self._entries = OrderedDict()
+        self.size = 0
+        BLOB_CACHE_BYTES.function = lambda: self.size
+        BLOB_CACHE_ENTRIES.function = lambda: len(self._entries)
+
+    @classmethod
+    def from_options(cls, options: CacheOptions) -> BlobCache:
+        return cls(options.max_bytes, options.max_blob_size)
+
+    def admits(self, size: int) -> bool:
+        return 0 < size <= self.max_blob_size
+
+    def get(self, hash: str) -> CachedBlob | None:
+        entry = self._entries.get(hash)
+        if entry is None:
+            return None
+        self._entries.move_to_end(hash)
+        BLOB_CACHE_HITS.inc()
+        return entry
+
+    def put(self, hash: str, entry: CachedBlob) -> None:
+        # Called after a miss was read from disk, so that is where misses
+        # are counted: blobs too large to cache are not misses.
+        BLOB_CACHE_MISSES.inc()
+        size = len(entry.data)
+        if not self.admits(size):
+            return
+        self.discard(hash)
+        while self.size + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.data)
+            BLOB_CACHE_EVICTIONS.inc()
+        self._entries[hash] = entry
+        self.size += size
+
+    def discard(self, hash: str) -> None:
+        entry = self._entries.pop(hash, None)
+        if entry is not None:
+            self.size -= len(entry.data)
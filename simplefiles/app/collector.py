@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import timedelta as td
+from pathlib import Path
+
+from aiohttp import web
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import GCOptions
+from simplefiles.core.entities import BlobStore
+from .cache import BlobCache
+from .db import file_infos, previews, uploads, variants
+from .logs import log_event, logger
+from .repository import utcnow
+from .storage import sweep_incoming
+from .uploads import UploadManager
+
+
+class GarbageCollector:
+    # Removes blobs whose files_info row has had no references for longer
+    # than the grace period. Each round handles at most batch_size blobs in
+    # two short write transactions, so uploads keep interleaving with it.
+    _task: asyncio.Task[None] | None
+
+    def __init__(
+        self,
+        blobs: BlobStore,
+        sessions: async_sessionmaker[AsyncSession],
+        options: GCOptions,
+        cache: BlobCache | None = None,
+        uploads: UploadManager | None = None,
+    ) -> None:
+        self._blobs = blobs
+        self._cache = cache
+        self._uploads = uploads
+        self._sessions = sessions
+        self._options = options
+        self._task = None
+
+    async def collect(self) -> list[str]:
+        cutoff = utcnow() - td(seconds=self._options.grace)
+        candidates = (
+            select(file_infos.c.hash)
+            .where(file_infos.c.unreferenced_at < cutoff)
+            .order_by(file_infos.c.unreferenced_at)
+            .limit(self._options.batch_size)
+        )
+        async with self._sessions() as session:
+            # Rows are claimed first: storing the same content again clears
+            # the claim (see MediaRepository.add_file_info) and keeps the row.
+            claimed = list(await session.scalars(
+                update(file_infos)
+                .where(file_infos.c.hash.in_(candidates.scalar_subquery()), file_infos.c.refs == 0)
+                .values(collecting_since=utcnow())
+                .returning(file_infos.c.hash)
+            ))
+            await session.commit()
+            if not claimed:
+                return []
+            still_claimed = select(file_infos.c.hash).where(
+                file_infos.c.hash.in_(claimed),
+                file_infos.c.refs == 0,
+                file_infos.c.collecting_since.is_not(None),
+            )
+            # Previews and variants of a removed source are useless; dropping
+            # them releases their own blobs, which come up in a later round.
+            await session.execute(delete(previews).where(previews.c.source_hash.in_(still_claimed)))
+            await session.execute(delete(variants).where(variants.c.source_hash.in_(still_claimed)))
+            result = await session.scalars(
+                delete(file_infos)
+                .where(file_infos.c.hash.in_(still_claimed.scalar_subquery()))
+                .returning(file_infos.c.hash)
+            )
+            collected = list(result)
+            # The blobs go while this transaction holds the write lock: a
+            # store of the same content waits for the commit, finds no row
+            # and publishes its own copy.
+            for hash in collected:
+                if self._cache is not None:
+                    self._cache.discard(hash)
+                await self._blobs.delete(hash)
+            await session.commit()
+        return collected
+
+    async def sweep(self, directory: Path) -> int:
+        async with self._sessions() as session:
+            active = set(await session.scalars(select(uploads.c.upload_id)))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, sweep_incoming, directory, active, self._options.temp_max_age)
+
+    async def expire_uploads(self) -> int:
+        if self._uploads is None:
+            return 0
+        async with self._sessions() as session:
+            return await self._uploads.expire(session, self._options.upload_max_age)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                collected = await self.collect()
+            except (SQLAlchemyError, OSError) as e:
+                log_event(logger, logging.WARNING, "garbage collection failed", error=repr(e))
+                collected = []
+            if collected:
+                log_event(logger, logging.INFO, "blobs collected", count=len(collected))
+            try:
+                expired = await self.expire_uploads()
+            except (SQLAlchemyError, OSError) as e:
+                log_event(logger, logging.WARNING, "upload expiry failed", error=repr(e))
+                expired = 0
+            if expired:
+                log_event(logger, logging.INFO, "uploads expired", count=expired)
+            # A full batch means there is a backlog: go on after yielding.
+            full = len(collected) >= self._options.batch_size
+            await asyncio.sleep(0 if full else self._options.interval)
+
+
+async def start_collector(app: web.Application) -> None:
+    collector: GarbageCollector = app["collector"]
+    removed = await collector.sweep(app["blobs"].incoming)
+    if removed:
+        log_event(logger, logging.INFO, "incoming swept", count=removed)
+    collector.start()
+
+
+async def close_collector(app: web.Application) -> None:
+    await app["collector"].close()
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import asyncio
+import mimetypes
+import time
+from datetime import timedelta as td
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import Config, SniffPolicy
+from simplefiles.core.entities import MIMEType
+from .engine import create_engine
+from .db import FileInfo, Integrity, file_infos, imported_files, registry
+from .mime import MIME, MIMEConflict, parse_content_type, resolve_content_type
+from .repository import create_media, utcnow
+from .scrubber import Scrubber
+from .storage import FileSystemBlobStore, HashedFile, hash_file, reshard_blobs, walk_files
+
+
+BATCH_SIZE = 1000
+HASH_CHUNKSIZE = 16
+
+
+@dataclass
+class ImportStats:
+    scanned: int = 0
+    imported: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def __str__(self) -> str:
+        rate = self.bytes / max(self.elapsed, 1e-9) / 1e6
+        return (
+            f"scanned {self.scanned}, imported {self.imported}, skipped {self.skipped}, "
+            f"failed {self.failed}, {self.bytes / 1e6:.1f} MB at {rate:.1f} MB/s"
+        )
+
+
+@dataclass
+class ScrubStats:
+    checked: int = 0
+    failed: int = 0
+    bytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def __str__(self) -> str:
+        rate = self.bytes / max(self.elapsed, 1e-9) / 1e6
+        return (
+            f"checked {self.checked}, failed {self.failed}, "
+            f"{self.bytes / 1e6:.1f} MB at {rate:.1f} MB/s"
+        )
+
+
+async def reshard(config: Config, source: Path | None = None) -> int:
+    store = FileSystemBlobStore.from_options(config.storage)
+    engine = create_engine(config)
+    statement = (
+        update(file_infos)
+        .where(file_infos.c.hash == bindparam("blob_hash"))
+        .values(path=bindparam("blob_path"))
+    )
+    moved = 0
+    batch: list[dict[str, str | Path]] = []
+    async with engine.begin() as conn:
+        for hash, path in reshard_blobs(store, source):
+            batch.append({"blob_hash": hash, "blob_path": path})
+            if len(batch) >= BATCH_SIZE:
+                await conn.execute(statement, batch)
+                moved += len(batch)
+                batch.clear()
+        if batch:
+            await conn.execute(statement, batch)
+            moved += len(batch)
+    await engine.dispose()
+    return moved
+
+
+def batched(iterable: Iterable[Path], size: int) -> Iterator[list[Path]]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def guess_mime(path: Path) -> MIME:
+    content_type, _ = mimetypes.guess_type(path.name)
+    try:
+        return parse_content_type(content_type or "application/octet-stream")
+    except ValueError:
+        return MIMEType.APPLICATION, "octet-stream"
+
+
+def hash_batch(pool: Executor, batch: list[Path]) -> list[HashedFile]:
+    return list(pool.map(hash_file, batch, chunksize=HASH_CHUNKSIZE))
+
+
+def adopt_batch(store: FileSystemBlobStore, batch: list[HashedFile], copy: bool) -> list[tuple[HashedFile, Path]]:
+    return [(hashed, store.adopt(hashed.path, hashed.hash, copy)) for hashed in batch]  # type: ignore[arg-type]
+
+
+async def import_batch(
+    sessions: async_sessionmaker[AsyncSession],
+    store: FileSystemBlobStore,
+    batch: list[HashedFile],
+    copy: bool,
+    policy: SniffPolicy,
+    stats: ImportStats,
+) -> None:
+    # Every path becomes a media, while its content is adopted and given a
+    # files_info row once. Paths are recorded in imported_files along with
+    # their media, which makes re-running an interrupted import safe: done
+    # paths are skipped, and blobs adopted before a crash are found in place.
+    stats.scanned += len(batch)
+    async with sessions() as session:
+        query = select(imported_files.c.path, imported_files.c.hash).where(
+            imported_files.c.path.in_([hashed.path for hashed in batch])
+        )
+        done = dict((await session.execute(query)).tuples().all())
+    pending: list[tuple[HashedFile, MIME]] = []
+    for hashed in batch:
+        if hashed.hash is None:
+            stats.failed += 1
+            continue
+        if done.get(hashed.path) == hashed.hash:
+            stats.skipped += 1
+            continue
+        try:
+            mime = resolve_content_type(guess_mime(hashed.path), hashed.mime, policy)
+        except MIMEConflict:
+            stats.failed += 1
+            continue
+        pending.append((hashed, mime))
+    if not pending:
+        return
+    contents: dict[str, HashedFile] = {}
+    for hashed, _ in pending:
+        contents.setdefault(hashed.hash, hashed)  # type: ignore[arg-type]
+    loop = asyncio.get_running_loop()
+    # Linking or copying happens before a connection is taken.
+    adopted = await loop.run_in_executor(None, adopt_batch, store, list(contents.values()), copy)
+    async with sessions() as session:
+        # Known rows are reclaimed first (see MediaRepository.add_file_info);
+        # that takes the write lock, so the collector removes none of them
+        # before the commit.
+        known = set(await session.scalars(
+            update(file_infos)
+            .where(file_infos.c.hash.in_(list(contents)))
+            .values(collecting_since=None)
+            .returning(file_infos.c.hash)
+        ))
+        query = select(FileInfo).where(FileInfo.hash.in_(known))  # type: ignore
+        files = {file.hash: file for file in await session.scalars(query)}
+        new = [(hashed, path) for hashed, path in adopted if hashed.hash not in known]
+        # A blob that was stored already may have been collected along with
+        # its row since it was adopted: it is adopted again.
+        gone = [hashed for hashed, path in new if not path.exists()]
+        if gone:
+            await loop.run_in_executor(None, adopt_batch, store, gone, copy)
+        for hashed, path in new:
+            file = FileInfo(path, hashed.hash, hashed.size)  # type: ignore[arg-type]
+            files[file.hash] = file
+            session.add(file)
+        loaded_at = utcnow()
+        for hashed, (mime_type, mime_subtype) in pending:
+            file = files[hashed.hash]
+            session.add(create_media(hashed.path.name, file, mime_type, mime_subtype, loaded_at, hashed.metadata))
+            stats.bytes += hashed.size
+        marker = insert(imported_files).values([{"path": hashed.path, "hash": hashed.hash} for hashed, _ in pending])
+        await session.execute(marker.on_conflict_do_update(
+            index_elements=[imported_files.c.path], set_={"hash": marker.excluded.hash},
+        ))
+        await session.commit()
+    stats.imported += len(pending)
+
+
+async def import_tree(
+    config: Config,
+    source: Path,
+    workers: int | None = None,
+    copy: bool = False,
+    progress: Callable[[ImportStats], None] | None = None,
+) -> ImportStats:
+    store = FileSystemBlobStore.from_options(config.storage)
+    engine = create_engine(config)
+    async with engine.begin() as conn:
+        await conn.run_sync(registry.metadata.create_all)
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    stats = ImportStats()
+    loop = asyncio.get_running_loop()
+    batches = batched(walk_files(source.absolute(), exclude=store.root), BATCH_SIZE)
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            # The next batch is hashed by the pool while the current one is
+            # linked into the store and inserted.
+            pending = None
+            if batch := next(batches, None):
+                pending = loop.run_in_executor(None, hash_batch, pool, batch)
+            while pending is not None:
+                hashed = await pending
+                pending = None
+                if batch := next(batches, None):
+                    pending = loop.run_in_executor(None, hash_batch, pool, batch)
+                await import_batch(sessions, store, hashed, copy, config.upload.sniff, stats)
+                if progress is not None:
+                    progress(stats)
+    finally:
+        await engine.dispose()
+    return stats
+
+
+async def scrub(
+    config: Config,
+    everything: bool = False,
+    workers: int | None = None,
+    rate: int | None = None,
+    progress: Callable[[ScrubStats], None] | None = None,
+) -> ScrubStats:
+    # Verifies every blob not verified within the scrub period, or all of
+    # them; interrupting and running it again continues with the rest.
+    options = config.scrub
+    if workers is not None:
+        options = replace(options, workers=workers)
+    if rate is not None:
+        options = replace(options, rate=rate)
+    store = FileSystemBlobStore.from_options(config.storage)
+    engine = create_engine(config)
+    async with engine.begin() as conn:
+        await conn.run_sync(registry.metadata.create_all)
+    sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    scrubber = Scrubber(store, sessions, options)
+    stats = ScrubStats()
+    cutoff = utcnow() if everything else utcnow() - td(seconds=options.period)
+    try:
+        # A batch can come back empty when the collector removed all of its
+        # rows meanwhile; the scrub is over only once no row was taken.
+        while True:
+            taken, verified = await scrubber.scrub(cutoff)
+            if not taken:
+                break
+            stats.checked += len(verified)
+            stats.failed += sum(result is not Integrity.OK for _, _, result in verified)
+            stats.bytes += sum(size for _, size, _ in verified)
+            if progress is not None:
+                progress(stats)
+    finally:
+        await scrubber.close()
+        await engine.dispose()
+    return stats
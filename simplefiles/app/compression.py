@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Sequence
+
+from aiohttp import hdrs, web
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import CompressionOptions
+from simplefiles.core.entities import AudiosMIME, ImagesMIME, MIMEType
+from .db import FileInfo
+from .logs import log_event, logger
+from .mime import MIME, zip_based
+from .repository import MediaRepository
+from .responses import send_blob
+from .storage import FileSystemBlobStore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+try:
+    import brotli
+except ImportError:
+    brotli = None  # type: ignore[assignment]
+
+
+# (compress, finish) pair of a streaming compressor
+Compressor = tuple[Callable[[bytes], bytes], Callable[[], bytes]]
+
+
+def gzip_compressor(level: int) -> Compressor:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def zstd_compressor(level: int) -> Compressor:
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+def brotli_compressor(level: int) -> Compressor:
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+# Content-Encoding tokens this process can produce
+COMPRESSORS: dict[str, Callable[[int], Compressor]] = {"gzip": gzip_compressor}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = zstd_compressor
+if brotli is not None:
+    COMPRESSORS["br"] = brotli_compressor
+
+COMPRESSIBLE_IMAGES = {ImagesMIME.SVG_XML, ImagesMIME.TIFF, ImagesMIME.MS_ICON, ImagesMIME.WAP_WBMP}
+COMPRESSIBLE_AUDIOS = {AudiosMIME.BASIC, AudiosMIME.L24, AudiosMIME.WAVE}  # uncompressed PCM
+COMPRESSED_APPLICATIONS = {
+    "zip", "gzip", "x-gzip", "x-bzip2", "x-xz", "zstd", "x-compress", "x-7z-compressed",
+    "vnd.rar", "x-rar-compressed", "pdf", "ogg", "x-shockwave-flash",
+}
+COMPRESSED_FONTS = {"woff", "woff2"}
+
+
+def compressible(mime: MIME) -> bool:
+    # Formats that carry their own compression only waste CPU here.
+    mime_type, subtype = mime
+    match mime_type:
+        case MIMEType.IMAGE: return subtype in COMPRESSIBLE_IMAGES
+        case MIMEType.AUDIO: return subtype in COMPRESSIBLE_AUDIOS
+        case MIMEType.VIDEO: return False
+        case MIMEType.FONT: return subtype not in COMPRESSED_FONTS
+        case MIMEType.APPLICATION: return not (subtype in COMPRESSED_APPLICATIONS or zip_based(subtype))
+        case _: return True
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    accepted: dict[str, float] = {}
+    for item in header.split(","):
+        name, *params = item.split(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def choose_encoding(header: str, offered: Sequence[str]) -> str | None:
+    # The client's highest q-value wins and ties go to the server's order;
+    # "*" stands for every coding the client did not name.
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    chosen, best = None, 0.0
+    for encoding in offered:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best:
+            chosen, best = encoding, quality
+    return chosen
+
+
+def compress_file(source: Path, target: Path, encoding: str, level: int, buffer_size: int) -> tuple[str, int]:
+    # Runs in the pool: streams the blob through the compressor into an
+    # incoming/ file, hashing the output on the way.
+    compress, finish = COMPRESSORS[encoding](level)
+    hasher = hashlib.new("sha256")
+    size = 0
+    with source.open("rb") as src, target.open("wb") as dst:
+        while data := src.read(buffer_size):
+            if output := compress(data):
+                hasher.update(output)
+                dst.write(output)
+                size += len(output)
+        output = finish()
+        hasher.update(output)
+        dst.write(output)
+        size += len(output)
+    return hasher.hexdigest(), size
+
+
+class CompressionManager:
+    # Compressed variants are derived blobs, stored and deduplicated like
+    # any other content and recorded in `variants`; each one is computed
+    # once. Variants that would save too little are recorded without a blob
+    # so they are not attempted again.
+    _pending: dict[tuple[str, str], asyncio.Task[None]]
+
+    def __init__(
+        self,
+        blobs: FileSystemBlobStore,
+        sessions: async_sessionmaker[AsyncSession],
+        options: CompressionOptions,
+        buffer_size: int,
+    ) -> None:
+        self._blobs = blobs
+        self._sessions = sessions
+        self._options = options
+        self._buffer_size = buffer_size
+        self.encodings = [encoding for encoding in options.encodings if encoding in COMPRESSORS]
+        self._pool = ProcessPoolExecutor(options.workers) if self.encodings else None
+        self._pending = {}
+
+    def accepts(self, mime: MIME, size: int) -> bool:
+        return bool(self.encodings) and size >= self._options.min_size and compressible(mime)
+
+    def schedule(self, info: FileInfo, encoding: str) -> None:
+        key = (info.hash, encoding)
+        if key in self._pending:
+            return
+        task = asyncio.create_task(self._compress(info, encoding))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    async def close(self) -> None:
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._pool is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._pool.shutdown)
+
+    async def _compress(self, info: FileInfo, encoding: str) -> None:
+        loop = asyncio.get_running_loop()
+        target = self._blobs.incoming / str(uuid.uuid4())
+        try:
+            file_hash, size = await loop.run_in_executor(
+                self._pool, compress_file,
+                self._blobs.locate(info.hash), target, encoding,
+                self._options.levels.get(encoding, -1), self._buffer_size,
+            )
+            file: FileInfo | None = None
+            async with self._sessions() as session:
+                repository = MediaRepository(session)
+                if size <= info.size * self._options.max_ratio:
+                    file = await repository.add_file_info(FileInfo(self._blobs.locate(file_hash), file_hash, size))
+                    # adopted after the commit, like uploads (see store)
+                    await loop.run_in_executor(None, self._blobs.adopt, target, file_hash)
+                await repository.add_variant(info.hash, encoding, file.hash if file is not None else None)
+        except Exception as e:
+            log_event(logger, logging.WARNING, "compression failed", hash=info.hash, encoding=encoding, error=repr(e))
+        finally:
+            await loop.run_in_executor(None, target.unlink, True)
+
+
+async def close_compression(app: web.Application) -> None:
+    await app["compression"].close()
+
+
+async def send_compressed(
+    request: web.Request, session: AsyncSession, info: FileInfo, mime: MIME, headers: dict[str, str]
+) -> web.StreamResponse:
+    compression: CompressionManager = request.app["compression"]
+    if not compression.accepts(mime, info.size):
+        return await send_blob(request, info.hash, headers)
+    headers = {**headers, hdrs.VARY: hdrs.ACCEPT_ENCODING}
+    # Ranges are left on the identity representation so that resumed
+    # downloads keep addressing the same bytes.
+    encoding = choose_encoding(request.headers.get(hdrs.ACCEPT_ENCODING, ""), compression.encodings)
+    if encoding is None or hdrs.RANGE in request.headers:
+        return await send_blob(request, info.hash, headers)
+    variants = await MediaRepository(session).get_variants(info.hash)
+    if encoding not in variants:
+        compression.schedule(info, encoding)
+    variant = variants.get(encoding)
+    if variant is None:
+        return await send_blob(request, info.hash, headers)
+    return await send_blob(request, variant, {**headers, hdrs.CONTENT_ENCODING: encoding})
@@ -1,16 +1,18 @@
 from dataclasses import dataclass, field
-from datetime import timedelta as td
+from enum import StrEnum
+from datetime import datetime as dt, timedelta as td
 from pathlib import Path
-from typing import Any, ClassVar
+from typing import Any, ClassVar, Literal
 
-from sqlalchemy import Column, ForeignKey, Table
-from sqlalchemy import CheckConstraint, ForeignKeyConstraint
+from sqlalchemy import Column, ForeignKey, Index, Table
+from sqlalchemy import CheckConstraint, ForeignKeyConstraint, UniqueConstraint
 from sqlalchemy import DateTime, Enum, Integer, String
-from sqlalchemy import MetaData
-from sqlalchemy import orm
+from sqlalchemy import DefaultClause, MetaData, event, func
+from sqlalchemy import orm, select
 from sqlalchemy.sql import Selectable
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy.engine import Dialect
+from sqlalchemy.engine import Connection, Dialect
+from sqlalchemy.ext.asyncio import async_object_session
 
 from simplefiles.core._types import AudiosMIME, ImagesMIME, VideosMIME, MIMEType
 from simplefiles.core import entities
@@ -53,7 +55,7 @@ class MediaLength(TypeDecorator[td]):
         minutes, seconds = divmod(value.seconds, 60)
         hours, minutes = divmod(minutes, 60)
         microseconds = value.microseconds
-        return f"{days}:{hours}:{minutes}:{seconds}.{microseconds:.3f}"
+        return f"{days}:{hours}:{minutes}:{seconds}.{microseconds:06d}"
 
     def process_result_value(self, value: str | None, dialect: Dialect) -> td | None:
         if value is None:
@@ -82,12 +84,33 @@ class MediaResolution(TypeDecorator[entities.Resolution]):
 registry = orm.registry(metadata=MetaData(naming_convention=NAMING))
 
 
+class Integrity(StrEnum):
+    OK = "ok"
+    CORRUPT = "corrupt"        # size or content does not match the hash
+    MISSING = "missing"
+    UNREADABLE = "unreadable"  # any other I/O error, such as permissions
+
+
 file_infos = Table(
     "files_info",
     registry.metadata,
     Column("hash", String, primary_key=True),
     Column("path", FilePath),
-    Column("size", Integer)
+    Column("size", Integer),
+    # medias and previews pointing at this blob, kept by the triggers below
+    Column("refs", Integer, nullable=False, server_default="0"),
+    # set while refs is 0; new rows start unreferenced until their media lands
+    Column(
+        "unreferenced_at", DateTime,
+        default=func.current_timestamp(), server_default=func.current_timestamp(),
+    ),
+    # result of the last integrity scrub; both NULL until the blob's first
+    Column("verified_at", DateTime, nullable=True),
+    Column("integrity", Enum(Integrity), nullable=True),
+    # set while the collector removes the blob; clearing it takes the row back
+    Column("collecting_since", DateTime, nullable=True),
+    Index(None, "unreferenced_at"),
+    Index(None, "verified_at"),
 )
 
 medias = Table(
@@ -98,6 +121,33 @@ medias = Table(
     Column("name", String),
     Column("file_hash", String, ForeignKey(file_infos.c.hash)),
     Column("loaded_at", DateTime),
+    Index(None, "loaded_at", "media_id"),
+    Index(None, "media_type", "loaded_at", "media_id"),
+    Index(None, "file_hash"),
+)
+
+previews = Table(
+    "previews",
+    registry.metadata,
+    Column("preview_id", Integer, primary_key=True, autoincrement=True),
+    Column("source_hash", String, ForeignKey(file_infos.c.hash)),
+    Column("preset", String),
+    Column("name", String),
+    Column("subtype", Enum(ImagesMIME)),
+    Column("file_hash", String, ForeignKey(file_infos.c.hash)),
+    Column("resolution", MediaResolution),
+    Column("loaded_at", DateTime),
+    UniqueConstraint("source_hash", "preset"),
+)
+
+# Content-Encoding variants of a blob, themselves stored as blobs. A NULL
+# file_hash records that the encoding did not pay off for this source.
+variants = Table(
+    "variants",
+    registry.metadata,
+    Column("source_hash", String, ForeignKey(file_infos.c.hash), primary_key=True),
+    Column("encoding", String, primary_key=True),
+    Column("file_hash", String, ForeignKey(file_infos.c.hash), nullable=True),
 )
 
 audios = Table(
@@ -107,12 +157,15 @@ audios = Table(
     Column("media_type", Enum(MIMEType), default=MIMEType.AUDIO),
     Column("subtype", Enum(AudiosMIME)),
     Column("length", MediaLength),
+    Column("artist", String),
+    Column("album", String),
+    Column("track", String),
     ForeignKeyConstraint(
         ("audio_id", "media_type"),
         (medias.c.media_id, medias.c.media_type)
     ),
     CheckConstraint(
-        "subtype IN ('MPEG', 'OGG')"
+        f"subtype IN ({', '.join(repr(subtype.name) for subtype in AudiosMIME)})"
     )
 )
 
@@ -123,13 +176,13 @@ images = Table(
     Column("media_type", Enum(MIMEType), default=MIMEType.IMAGE),
     Column("subtype", Enum(ImagesMIME)),
     Column("resolution", MediaResolution),
-    Column("preview_id", Integer),
+    Column("preview_id", Integer, ForeignKey(previews.c.preview_id)),
     ForeignKeyConstraint(
         ("image_id", "media_type"),
         (medias.c.media_id, medias.c.media_type)
     ),
     CheckConstraint(
-        "subtype IN ('JPEG', 'PNG')"
+        f"subtype IN ({', '.join(repr(subtype.name) for subtype in ImagesMIME)})"
     )
 )
 
@@ -141,12 +194,13 @@ videos = Table(
     Column("subtype", Enum(VideosMIME)),
     Column("resolution", MediaResolution),
     Column("length", MediaLength),
+    Column("preview_id", Integer, ForeignKey(previews.c.preview_id)),
     ForeignKeyConstraint(
         ("video_id", "media_type"),
         (medias.c.media_id, medias.c.media_type)
     ),
     CheckConstraint(
-        "subtype IN ('MP4', 'MPEG', 'OGG')"
+        f"subtype IN ({', '.join(repr(subtype.name) for subtype in VideosMIME)})"
     )
 )
 
@@ -162,6 +216,171 @@ files = Table(
     ),
 )
 
+# Reference counts are maintained by triggers so every writer (handlers,
+# the importer, other worker processes) keeps them exact inside its own
+# transaction. An insert pointing at a row the collector has just removed
+# is refused instead of leaving a media without a blob.
+REFERENCE_TRIGGERS = tuple(
+    statement
+    for table in ("medias", "previews", "variants")
+    for statement in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_reference AFTER INSERT ON {table}
+        BEGIN
+            SELECT RAISE(ABORT, 'files_info row was collected')
+            WHERE NEW.file_hash IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM files_info WHERE hash = NEW.file_hash);
+            UPDATE files_info SET refs = refs + 1, unreferenced_at = NULL WHERE hash = NEW.file_hash;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_unreference AFTER DELETE ON {table}
+        BEGIN
+            UPDATE files_info
+            SET refs = refs - 1, unreferenced_at = CASE WHEN refs = 1 THEN CURRENT_TIMESTAMP END
+            WHERE hash = OLD.file_hash;
+        END
+        """,
+    )
+)
+
+# Recounts references from scratch, for databases whose rows predate the
+# triggers.
+COUNT_REFERENCES = (
+    """
+    UPDATE files_info SET refs =
+        (SELECT count(*) FROM medias WHERE file_hash = files_info.hash)
+        + (SELECT count(*) FROM previews WHERE file_hash = files_info.hash)
+        + (SELECT count(*) FROM variants WHERE file_hash = files_info.hash)
+    """,
+    """
+    UPDATE files_info
+    SET unreferenced_at = CASE WHEN refs = 0 THEN coalesce(unreferenced_at, CURRENT_TIMESTAMP) END
+    """,
+)
+
+# Full-text index over media names. It is an external-content table: the
+# names themselves stay in medias and triggers keep the index in step.
+SEARCH_INDEX = (
+    """
+    CREATE VIRTUAL TABLE medias_fts USING fts5(
+        name, content='medias', content_rowid='media_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER medias_fts_insert AFTER INSERT ON medias
+    BEGIN
+        INSERT INTO medias_fts(rowid, name) VALUES (NEW.media_id, NEW.name);
+    END
+    """,
+    """
+    CREATE TRIGGER medias_fts_delete AFTER DELETE ON medias
+    BEGIN
+        INSERT INTO medias_fts(medias_fts, rowid, name) VALUES ('delete', OLD.media_id, OLD.name);
+    END
+    """,
+    """
+    CREATE TRIGGER medias_fts_update AFTER UPDATE OF name ON medias
+    BEGIN
+        INSERT INTO medias_fts(medias_fts, rowid, name) VALUES ('delete', OLD.media_id, OLD.name);
+        INSERT INTO medias_fts(rowid, name) VALUES (NEW.media_id, NEW.name);
+    END
+    """,
+    "INSERT INTO medias_fts(medias_fts) VALUES ('rebuild')",
+)
+
+
+def add_missing_columns(connection: Connection, table: Table) -> None:
+    existing = {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table.name})")}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"
+        # SQLite only adds columns with constant defaults; the others are
+        # given their values by the inserts (see Column.default).
+        default = column.server_default
+        if isinstance(default, DefaultClause) and isinstance(default.arg, str):
+            ddl += f" DEFAULT '{default.arg}'"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        connection.exec_driver_sql(ddl)
+
+
+def rebuild_checks(connection: Connection, table: Table) -> None:
+    # SQLite cannot alter constraints, so a table whose CHECKs predate the
+    # members its enums have now is copied into a freshly created one.
+    query = "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?"
+    sql = connection.exec_driver_sql(query, (table.name,)).scalar_one()
+    checks = [str(constraint.sqltext) for constraint in table.constraints if isinstance(constraint, CheckConstraint)]
+    if all(check in sql for check in checks):
+        return
+    old = f"{table.name}_old"
+    connection.exec_driver_sql(f"ALTER TABLE {table.name} RENAME TO {old}")
+    # its indexes kept their names and are created again with the table
+    query = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL"
+    for (index,) in connection.exec_driver_sql(query, (old,)).all():
+        connection.exec_driver_sql(f"DROP INDEX {index}")
+    table.create(connection)
+    columns = ", ".join(column.name for column in table.columns)
+    connection.exec_driver_sql(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old}")
+    connection.exec_driver_sql(f"DROP TABLE {old}")
+
+
+def trigger_exists(connection: Connection, name: str) -> bool:
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?"
+    return connection.exec_driver_sql(query, (name,)).first() is not None
+
+
+@event.listens_for(registry.metadata, "after_create")
+def upgrade_schema(target: MetaData, connection: Connection, **kwargs: Any) -> None:
+    # Runs after every create_all, which only creates missing tables. Every
+    # step checks what is there first, so databases created by any earlier
+    # version are brought up to date and current ones are left alone.
+    if connection.dialect.name != "sqlite":
+        return
+    for table in target.sorted_tables:
+        add_missing_columns(connection, table)
+        rebuild_checks(connection, table)
+    for table in target.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+    if not all(trigger_exists(connection, f"{table}_reference") for table in ("medias", "previews", "variants")):
+        for statement in REFERENCE_TRIGGERS + COUNT_REFERENCES:
+            connection.exec_driver_sql(statement)
+    if connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'medias_fts'").first() is None:
+        # the final rebuild indexes the names already stored
+        for statement in SEARCH_INDEX:
+            connection.exec_driver_sql(statement)
+
+
+uploads = Table(
+    "uploads",
+    registry.metadata,
+    Column("upload_id", String, primary_key=True),
+    Column("name", String),
+    Column("content_type", String),
+    Column("size", Integer),
+    Column("chunk_size", Integer),
+    Column("created_at", DateTime),
+)
+
+upload_chunks = Table(
+    "upload_chunks",
+    registry.metadata,
+    Column("upload_id", String, ForeignKey(uploads.c.upload_id, ondelete="CASCADE"), primary_key=True),
+    Column("chunk_offset", Integer, primary_key=True),
+)
+
+# source files the import command has made a media of, with the content it
+# found there; running it again over the same tree skips those
+imported_files = Table(
+    "imported_files",
+    registry.metadata,
+    Column("path", FilePath, primary_key=True),
+    Column("hash", String, nullable=False),
+)
+
 
 @registry.mapped
 @dataclass
@@ -191,14 +410,20 @@ class Image(Media, entities.Image):
     __table__ = images
     __mapper_args__ = {
         "polymorphic_identity": MIMEType.IMAGE,
-        "properties": {
-            "info": orm.relationship(FileInfo)
-        },
     }
 
     @property
     async def preview(self) -> entities.Preview | None:
-        return None
+        # the default preset, linked through preview_id once it is rendered
+        session = async_object_session(self)
+        if session is None:
+            return None
+        query = (
+            select(Preview)
+            .join(images, images.c.preview_id == previews.c.preview_id)
+            .where(images.c.image_id == self.media_id)
+        )
+        return await session.scalar(query)
 
     def __post_init__(self) -> None:
         self.media_type = self.type
@@ -210,9 +435,6 @@ class Audio(Media, entities.Audio):
     __table__ = audios
     __mapper_args__ = {
         "polymorphic_identity": MIMEType.AUDIO,
-        "properties": {
-            "info": orm.relationship(FileInfo)
-        },
     }
 
     def __post_init__(self) -> None:
@@ -225,14 +447,20 @@ class Video(Media, entities.Video):
     __table__ = videos
     __mapper_args__ = {
         "polymorphic_identity": MIMEType.VIDEO,
-        "properties": {
-            "info": orm.relationship(FileInfo)
-        },
     }
 
     @property
-    async def preview(self) -> entities.Preview:
-        return None  # type: ignore
+    async def preview(self) -> entities.Preview | None:
+        # the default preset, linked through preview_id once it is rendered
+        session = async_object_session(self)
+        if session is None:
+            return None
+        query = (
+            select(Preview)
+            .join(videos, videos.c.preview_id == previews.c.preview_id)
+            .where(videos.c.video_id == self.media_id)
+        )
+        return await session.scalar(query)
 
     def __post_init__(self) -> None:
         self.media_type = self.type
@@ -244,10 +472,44 @@ class File(Media, entities.File):
     __table__ = files
     __mapper_args__ = {
         "polymorphic_identity": MIMEType.APPLICATION,
-        "properties": {
-            "info": orm.relationship(FileInfo)
-        },
     }
 
     def __post_init__(self) -> None:
         self.media_type = self.type
+
+
+@registry.mapped
+@dataclass
+class Preview(entities.Preview):
+    type: ClassVar[Literal[MIMEType.IMAGE]] = MIMEType.IMAGE
+    source_hash: str
+    preset: str
+    resolution: entities.Resolution | None = None
+    preview_id: int = field(init=False)
+
+    __table__ = previews
+    __mapper_args__ = {
+        "properties": {
+            "info": orm.relationship(FileInfo, foreign_keys=[previews.c.file_hash], lazy="joined")
+        },
+    }
+
+
+@registry.mapped
+@dataclass
+class Upload:
+    upload_id: str
+    name: str
+    content_type: str
+    size: int
+    chunk_size: int
+    created_at: dt
+
+    __table__ = uploads
+
+    @property
+    def chunks_count(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, offset: int) -> int:
+        return min(self.chunk_size, self.size - offset)
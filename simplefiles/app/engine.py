@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import time
+from functools import partial
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry, StaticPool
+
+from simplefiles.config import Config, DBOptions
+from .metrics import DB_ACQUIRE
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # Records how long each checkout waits for an idle or new connection.
+    # Pool log records stay under sqlalchemy's namespace (and echo_pool)
+    # instead of landing in the app's logger.
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.AsyncAdaptedQueuePool"
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_ACQUIRE.observe(time.perf_counter() - started)
+
+
+def sqlite_pragmas(options: DBOptions) -> dict[str, str | int]:
+    return {
+        "journal_mode": options.journal_mode,
+        "synchronous": options.synchronous,
+        "busy_timeout": options.busy_timeout,
+        "cache_size": options.cache_size,
+        "mmap_size": options.mmap_size,
+        "temp_store": options.temp_store,
+        "foreign_keys": int(options.foreign_keys),
+    }
+
+
+def apply_pragmas(pragmas: dict[str, str | int], dbapi_connection: Any, connection_record: Any) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+def create_engine(config: Config) -> AsyncEngine:
+    options = config.db
+    url = make_url(options.url)
+    if url.get_backend_name() != "sqlite":
+        return create_async_engine(
+            url, echo=options.echo, poolclass=TimedQueuePool,
+            pool_size=options.pool_size, max_overflow=options.max_overflow, pool_timeout=options.pool_timeout,
+        )
+    if url.database in (None, "", ":memory:"):
+        engine = create_async_engine(url, echo=options.echo, poolclass=StaticPool)
+    else:
+        engine = create_async_engine(
+            url, echo=options.echo, poolclass=TimedQueuePool,
+            pool_size=options.pool_size, max_overflow=options.max_overflow, pool_timeout=options.pool_timeout,
+        )
+    event.listen(engine.sync_engine, "connect", partial(apply_pragmas, sqlite_pragmas(options)))
+    return engine
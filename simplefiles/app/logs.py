@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from datetime import datetime as dt, timezone as tz
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Awaitable, Callable, Iterable, Mapping
+
+from aiohttp import web
+
+from simplefiles.config import LogFormat, LogOptions
+
+
+ROOT_LOGGER = "simplefiles"
+REDACTED = "[redacted]"
+ENCODER = json.JSONEncoder(default=str, ensure_ascii=False)
+
+logger = logging.getLogger(ROOT_LOGGER)
+access_logger = logging.getLogger(f"{ROOT_LOGGER}.access")
+
+
+class Sampler:
+    def __init__(self, rate: float = 1.0) -> None:
+        self.rate = rate
+
+    def keep(self, level: int) -> bool:
+        return level >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+
+sampler = Sampler()
+
+
+def log_event(log: logging.Logger, level: int, message: str, **fields: Any) -> None:
+    # Sampling happens before a record exists, and the record is built
+    # directly to skip the stack walk Logger.log does to find its caller.
+    # Fields ride on the record as a plain dict; rendering, redaction and
+    # the write itself all happen on the listener thread.
+    if log.isEnabledFor(level) and sampler.keep(level):
+        record = log.makeRecord(log.name, level, "", 0, message, (), None, extra={"fields": fields})
+        log.handle(record)
+
+
+class BackgroundHandler(QueueHandler):
+    dropped: int
+
+    def __init__(self, records: queue.Queue[logging.LogRecord]) -> None:
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock implementation formats the record to make it picklable;
+        # the queue never leaves the process, so that work is left to the
+        # listener thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, format: LogFormat, redact: Iterable[str]) -> None:
+        super().__init__()
+        self._format = format
+        self._redact = frozenset(name.lower() for name in redact)
+
+    def redact(self, fields: Mapping[str, Any]) -> dict[str, Any]:
+        return {
+            key: REDACTED if key.lower() in self._redact
+            else self.redact(value) if isinstance(value, Mapping)
+            else value
+            for key, value in fields.items()
+        }
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = dt.fromtimestamp(record.created, tz.utc).isoformat(timespec="milliseconds")
+        fields = self.redact(getattr(record, "fields", {}))
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+        match self._format:
+            case LogFormat.JSON:
+                entry = {
+                    "time": timestamp,
+                    "level": record.levelname,
+                    "logger": record.name,
+                    "message": record.getMessage(),
+                    **fields,
+                }
+                if exception:
+                    entry["exception"] = exception
+                return ENCODER.encode(entry)
+            case _:
+                line = " ".join((
+                    timestamp, f"{record.levelname:<7}", record.name, record.getMessage(),
+                    *(f"{key}={value!r}" for key, value in fields.items()),
+                ))
+                return f"{line}\n{exception}" if exception else line
+
+
+def start_logging(options: LogOptions) -> QueueListener:
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(StructuredFormatter(options.format, options.redact))
+    handler = BackgroundHandler(queue.Queue(options.queue_size))
+    sampler.rate = options.sample_rate
+    logger.handlers = [handler]
+    logger.setLevel(options.level.upper())
+    logger.propagate = False
+    # Only aiohttp's warnings and errors (unhandled exceptions in handlers,
+    # protocol errors) are of interest; requests are logged by log_requests.
+    server_logger = logging.getLogger("aiohttp")
+    server_logger.handlers = [handler]
+    server_logger.setLevel(logging.WARNING)
+    server_logger.propagate = False
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+async def stop_logging(app: web.Application) -> None:
+    # Blocks until every queued record has been written.
+    app["logs"].stop()
+
+
+@web.middleware
+async def log_requests(
+    request: web.Request,
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # Only the path is logged: query strings may carry tokens.
+        log_event(
+            access_logger, logging.INFO, "request",
+            method=request.method,
+            path=request.path,
+            status=status,
+            duration_ms=round((time.perf_counter() - started) * 1000, 3),
+            remote=request.remote,
+            content_length=request.content_length,
+        )
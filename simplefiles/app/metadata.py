@@ -0,0 +1,517 @@
+from __future__ import annotations
+
+import asyncio
+import struct
+from datetime import timedelta as td
+from pathlib import Path
+from typing import Iterator
+
+from simplefiles.core.entities import BlobStore, Metadata, Resolution
+
+
+HEAD_SIZE = 1024*1024
+TAIL_SIZE = 64*1024
+MAX_MOOV_SIZE = 16*1024*1024
+READ_SIZE = 256*1024
+MAX_READS = 4096
+
+# MPEG audio layer III: bitrates (kbit/s) by index, sample rates by index
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    25: (11025, 12000, 8000),
+}
+
+ID3_FRAMES = {
+    b"TPE1": "artist", b"TALB": "album", b"TIT2": "track",
+    b"TP1": "artist", b"TAL": "album", b"TT2": "track",
+}
+VORBIS_FIELDS = {"ARTIST": "artist", "ALBUM": "album", "TITLE": "track"}
+
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACK_ENTRY = 0xAE
+EBML_VIDEO = 0xE0
+EBML_PIXEL_WIDTH = 0xB0
+EBML_PIXEL_HEIGHT = 0xBA
+EBML_CLUSTER = 0x1F43B675
+
+
+class MetadataProbe:
+    # Keeps the first HEAD_SIZE and the last TAIL_SIZE bytes of a stream and
+    # walks ISO BMFF top-level boxes as data flows by, so a `moov` box is
+    # captured wherever it sits without buffering `mdat`.
+
+    def __init__(self) -> None:
+        self._head = bytearray()
+        self._tail = b""
+        self._offset = 0
+        self._walking: bool | None = None
+        self._box_end = 0
+        self._box_header = bytearray()
+        self._moov: bytearray | None = None
+        self._moov_end = 0
+        self._moov_data: bytes | None = None
+
+    @property
+    def wanted(self) -> int | None:
+        # Next offset this probe still needs, or None once only the tail is
+        # missing. Lets probe_file() seek over media data instead of reading it.
+        if self._offset < HEAD_SIZE:
+            return self._offset
+        if self._walking and self._moov_data is None:
+            return self._offset if self._moov is not None else max(self._offset, self._box_end)
+        return None
+
+    def feed(self, data: bytes | bytearray | memoryview) -> None:
+        view = memoryview(data)
+        if len(self._head) < HEAD_SIZE:
+            self._head += view[:HEAD_SIZE - len(self._head)]
+        if self._walking is None and len(self._head) >= 8:
+            self._walking = self._head[4:8] == b"ftyp"
+            if self._walking:
+                # Decided only now: replay the few bytes fed before the first 8
+                # arrived, then walk this chunk in place.
+                self._walk_boxes(memoryview(bytes(self._head[:self._offset])), 0)
+                self._walk_boxes(view, self._offset)
+        elif self._walking and self._moov_data is None:
+            self._walk_boxes(view, self._offset)
+        self._offset += len(view)
+        if len(view) >= TAIL_SIZE:
+            self._tail = bytes(view[-TAIL_SIZE:])
+        else:
+            self._tail = (self._tail + bytes(view))[-TAIL_SIZE:]
+
+    @property
+    def head(self) -> bytes:
+        return bytes(self._head)
+
+    def seek(self, offset: int, tail: bytes = b"") -> None:
+        # Skips bytes nothing is interested in; only probe_file() calls this.
+        self._offset = max(self._offset, offset)
+        if tail:
+            self._tail = tail[-TAIL_SIZE:]
+
+    def result(self) -> Metadata:
+        head = bytes(self._head)
+        try:
+            return parse(head, self._tail, self._moov_data, self._offset)
+        except (struct.error, IndexError, ValueError, OverflowError):
+            return Metadata()
+
+    def _walk_boxes(self, view: memoryview, start: int) -> None:
+        end = start + len(view)
+        position = start
+        while position < end and self._walking:
+            if self._moov is not None:
+                stop = min(end, self._moov_end)
+                self._moov += view[position - start:stop - start]
+                position = stop
+                if position == self._moov_end:
+                    self._moov_data = bytes(self._moov)
+                    self._moov = None
+                    self._walking = False
+                continue
+            if position < self._box_end:
+                position = min(end, self._box_end)
+                continue
+            header = self._box_header
+            need = (8 if len(header) < 8 else 16) - len(header)
+            header += view[position - start:position - start + need]
+            position += min(need, end - position)
+            if len(header) < 8:
+                continue
+            size, kind = struct.unpack(">I4s", header[:8])
+            if size == 1:
+                if len(header) < 16:
+                    continue
+                size, = struct.unpack(">Q", header[8:16])
+            header_size = len(header)
+            header.clear()
+            if size < header_size:
+                self._walking = False
+                break
+            self._box_end = position - header_size + size
+            if kind == b"moov" and size - header_size <= MAX_MOOV_SIZE:
+                self._moov = bytearray()
+                self._moov_end = self._box_end
+
+
+def probe_file(path: Path) -> MetadataProbe:
+    probe = MetadataProbe()
+    with path.open("rb") as file:
+        size = file.seek(0, 2)
+        reads = 0
+        while (wanted := probe.wanted) is not None and wanted < size and reads < MAX_READS:
+            reads += 1
+            probe.seek(wanted)
+            file.seek(wanted)
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            probe.feed(data)
+        file.seek(max(size - TAIL_SIZE, 0))
+        probe.seek(size, file.read(TAIL_SIZE))
+    return probe
+
+
+def probe_bytes(data: bytes) -> MetadataProbe:
+    probe = MetadataProbe()
+    probe.feed(data)
+    return probe
+
+
+async def probe_blob(blobs: BlobStore, hash: str) -> MetadataProbe:
+    path = blobs.local_path(hash)
+    if path is None:
+        return probe_bytes(await blobs.read(hash))
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(None, probe_file, path)
+    except OSError:
+        return MetadataProbe()
+
+
+def parse(head: bytes, tail: bytes, moov: bytes | None, size: int) -> Metadata:
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        return Metadata(Resolution(*struct.unpack(">II", head[16:24])))
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return Metadata(Resolution(*struct.unpack("<HH", head[6:10])))
+    if head.startswith(b"\xff\xd8"):
+        return Metadata(jpeg_resolution(head))
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return Metadata(webp_resolution(head))
+    if head[4:8] == b"ftyp":
+        return parse_moov(moov) if moov is not None else Metadata()
+    if head.startswith(EBML_MAGIC):
+        return parse_matroska(head)
+    if head.startswith(b"fLaC"):
+        return parse_flac(head)
+    if head.startswith(b"OggS"):
+        return parse_ogg(head, tail)
+    if head.startswith(b"ID3") or mp3_frame_at(head, 0) is not None:
+        return parse_mp3(head, tail, size)
+    return Metadata()
+
+
+def jpeg_resolution(data: bytes) -> Resolution | None:
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            position += 2
+            continue
+        length, = struct.unpack(">H", data[position + 2:position + 4])
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[position + 5:position + 9])
+            return Resolution(width, height)
+        position += 2 + length
+    return None
+
+
+def webp_resolution(data: bytes) -> Resolution | None:
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", data[26:30])
+        return Resolution(width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L":
+        bits, = struct.unpack("<I", data[21:25])
+        return Resolution((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return Resolution(width, height)
+    return None
+
+
+def iter_boxes(data: bytes) -> Iterator[tuple[bytes, bytes]]:
+    position = 0
+    while position + 8 <= len(data):
+        size, kind = struct.unpack(">I4s", data[position:position + 8])
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack(">Q", data[position + 8:position + 16])
+            header_size = 16
+        elif size == 0:
+            size = len(data) - position
+        if size < header_size:
+            return
+        yield kind, data[position + header_size:position + size]
+        position += size
+
+
+def parse_moov(moov: bytes) -> Metadata:
+    metadata = Metadata()
+    for kind, body in iter_boxes(moov):
+        if kind == b"mvhd":
+            if body[0] == 1:
+                timescale, duration = struct.unpack(">IQ", body[20:32])
+            else:
+                timescale, duration = struct.unpack(">II", body[12:20])
+            if timescale:
+                metadata.length = td(seconds=duration / timescale)
+        elif kind == b"trak" and metadata.resolution is None:
+            for child, content in iter_boxes(body):
+                if child == b"tkhd" and len(content) >= 8:
+                    # 16.16 fixed-point width and height close the box
+                    width, height = struct.unpack(">II", content[-8:])
+                    if width and height:
+                        metadata.resolution = Resolution(width >> 16, height >> 16)
+    return metadata
+
+
+def read_vint(data: bytes, position: int, marker: bool) -> tuple[int | None, int]:
+    first = data[position]
+    if not first:
+        raise ValueError("Invalid EBML variable-length integer")
+    length = 9 - first.bit_length()
+    value = int.from_bytes(data[position:position + length], "big")
+    if marker:
+        return value, length
+    value &= (1 << (7 * length)) - 1
+    if value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def iter_elements(data: bytes, start: int, end: int) -> Iterator[tuple[int, int, int]]:
+    # Yields (id, body start, body end); unknown sizes run to the end.
+    position = start
+    while position < end:
+        try:
+            element_id, id_length = read_vint(data, position, marker=True)
+            size, size_length = read_vint(data, position + id_length, marker=False)
+        except (IndexError, ValueError):
+            return
+        body = position + id_length + size_length
+        stop = end if size is None else min(body + size, end)
+        assert element_id is not None
+        yield element_id, body, stop
+        position = stop
+
+
+def parse_matroska(head: bytes) -> Metadata:
+    metadata = Metadata()
+    scale, duration = 1_000_000, None
+    for element_id, body, stop in iter_elements(head, 0, len(head)):
+        if element_id != EBML_SEGMENT:
+            continue
+        for child_id, child, child_stop in iter_elements(head, body, stop):
+            if child_id == EBML_CLUSTER:
+                break
+            if child_id == EBML_INFO:
+                for info_id, start, end in iter_elements(head, child, child_stop):
+                    if info_id == EBML_TIMECODE_SCALE:
+                        scale = int.from_bytes(head[start:end], "big")
+                    elif info_id == EBML_DURATION:
+                        duration, = struct.unpack(">f" if end - start == 4 else ">d", head[start:end])
+            elif child_id == EBML_TRACKS:
+                for entry_id, start, end in iter_elements(head, child, child_stop):
+                    if entry_id == EBML_TRACK_ENTRY and metadata.resolution is None:
+                        metadata.resolution = matroska_resolution(head, start, end)
+        break
+    if duration is not None:
+        metadata.length = td(seconds=duration * scale / 1e9)
+    return metadata
+
+
+def matroska_resolution(data: bytes, start: int, end: int) -> Resolution | None:
+    for element_id, body, stop in iter_elements(data, start, end):
+        if element_id != EBML_VIDEO:
+            continue
+        sizes = {}
+        for child_id, child, child_stop in iter_elements(data, body, stop):
+            if child_id in (EBML_PIXEL_WIDTH, EBML_PIXEL_HEIGHT):
+                sizes[child_id] = int.from_bytes(data[child:child_stop], "big")
+        if EBML_PIXEL_WIDTH in sizes and EBML_PIXEL_HEIGHT in sizes:
+            return Resolution(sizes[EBML_PIXEL_WIDTH], sizes[EBML_PIXEL_HEIGHT])
+    return None
+
+
+def parse_vorbis_comment(data: bytes, metadata: Metadata) -> None:
+    vendor_length, = struct.unpack("<I", data[:4])
+    position = 4 + vendor_length
+    count, = struct.unpack("<I", data[position:position + 4])
+    position += 4
+    for _ in range(count):
+        if position + 4 > len(data):
+            break
+        length, = struct.unpack("<I", data[position:position + 4])
+        key, _, value = data[position + 4:position + 4 + length].decode("utf-8", "replace").partition("=")
+        position += 4 + length
+        attribute = VORBIS_FIELDS.get(key.upper())
+        if attribute is not None and getattr(metadata, attribute) is None:
+            setattr(metadata, attribute, value)
+
+
+def parse_flac(head: bytes) -> Metadata:
+    metadata = Metadata()
+    position = 4
+    last = False
+    while not last and position + 4 <= len(head):
+        block_type = head[position] & 0x7F
+        last = bool(head[position] & 0x80)
+        length = int.from_bytes(head[position + 1:position + 4], "big")
+        block = head[position + 4:position + 4 + length]
+        if block_type == 0:
+            rate = int.from_bytes(block[10:13], "big") >> 4
+            samples = int.from_bytes(block[13:18], "big") & 0xFFFFFFFFF
+            if rate and samples:
+                metadata.length = td(seconds=samples / rate)
+        elif block_type == 4:
+            parse_vorbis_comment(block, metadata)
+        position += 4 + length
+    return metadata
+
+
+def ogg_packets(data: bytes, count: int) -> list[bytes]:
+    packets: list[bytes] = []
+    packet = bytearray()
+    position = 0
+    while len(packets) < count and data.startswith(b"OggS", position):
+        segments = data[position + 26]
+        table = data[position + 27:position + 27 + segments]
+        position += 27 + segments
+        for lace in table:
+            packet += data[position:position + lace]
+            position += lace
+            if lace < 255:
+                packets.append(bytes(packet))
+                packet.clear()
+    return packets
+
+
+def parse_ogg(head: bytes, tail: bytes) -> Metadata:
+    metadata = Metadata()
+    packets = ogg_packets(head, 2)
+    if not packets:
+        return metadata
+    identification = packets[0]
+    if identification.startswith(b"\x01vorbis"):
+        rate, = struct.unpack("<I", identification[12:16])
+        skip = 0
+        comment_prefix = b"\x03vorbis"
+    elif identification.startswith(b"OpusHead"):
+        rate = 48000
+        skip, = struct.unpack("<H", identification[10:12])
+        comment_prefix = b"OpusTags"
+    else:
+        return metadata
+    if len(packets) > 1 and packets[1].startswith(comment_prefix):
+        parse_vorbis_comment(packets[1][len(comment_prefix):], metadata)
+    last_page = tail.rfind(b"OggS")
+    if last_page >= 0 and last_page + 14 <= len(tail):
+        granule, = struct.unpack("<q", tail[last_page + 6:last_page + 14])
+        if rate and granule > skip:
+            metadata.length = td(seconds=(granule - skip) / rate)
+    return metadata
+
+
+def syncsafe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decode_id3_text(data: bytes) -> str:
+    encoding, text = data[0], data[1:]
+    match encoding:
+        case 1: value = text.decode("utf-16", "replace")
+        case 2: value = text.decode("utf-16-be", "replace")
+        case 3: value = text.decode("utf-8", "replace")
+        case _: value = text.decode("latin-1")
+    return value.split("\x00", 1)[0].strip()
+
+
+def parse_id3v2(head: bytes, metadata: Metadata) -> int:
+    # Returns the offset of the first byte after the tag.
+    version, flags = head[3], head[5]
+    end = 10 + syncsafe(head[6:10]) + (10 if flags & 0x10 else 0)
+    position = 10
+    if flags & 0x40:
+        extended = head[10:14]
+        position += syncsafe(extended) if version == 4 else 4 + int.from_bytes(extended, "big")
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+    while position + header_size <= min(end, len(head)):
+        frame_id = head[position:position + id_size]
+        if not frame_id.strip(b"\x00"):
+            break
+        raw_size = head[position + id_size:position + header_size - (0 if version == 2 else 2)]
+        size = syncsafe(raw_size) if version == 4 else int.from_bytes(raw_size, "big")
+        body = head[position + header_size:position + header_size + size]
+        attribute = ID3_FRAMES.get(frame_id)
+        if attribute is not None and body and getattr(metadata, attribute) is None:
+            setattr(metadata, attribute, decode_id3_text(body) or None)
+        position += header_size + size
+    return end
+
+
+def parse_id3v1(tail: bytes, metadata: Metadata) -> bool:
+    tag = tail[-128:]
+    if len(tag) < 128 or not tag.startswith(b"TAG"):
+        return False
+    fields = {"track": tag[3:33], "artist": tag[33:63], "album": tag[63:93]}
+    for attribute, raw in fields.items():
+        value = raw.split(b"\x00", 1)[0].decode("latin-1").strip()
+        if value and getattr(metadata, attribute) is None:
+            setattr(metadata, attribute, value)
+    return True
+
+
+def mp3_frame_at(data: bytes, position: int) -> tuple[int, int, int, int] | None:
+    # Returns (version, bitrate kbit/s, sample rate, samples per frame) of
+    # an MPEG audio layer III frame header.
+    if position + 4 > len(data) or data[position] != 0xFF or data[position + 1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (data[position + 1] >> 3) & 0x03
+    layer_bits = (data[position + 1] >> 1) & 0x03
+    bitrate_index = data[position + 2] >> 4
+    rate_index = (data[position + 2] >> 2) & 0x03
+    if version_bits == 1 or layer_bits != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    version = {3: 1, 2: 2, 0: 25}[version_bits]
+    bitrate = MP3_BITRATES[1 if version == 1 else 2][bitrate_index]
+    return version, bitrate, MP3_SAMPLE_RATES[version][rate_index], 1152 if version == 1 else 576
+
+
+def parse_mp3(head: bytes, tail: bytes, size: int) -> Metadata:
+    metadata = Metadata()
+    start = parse_id3v2(head, metadata) if head.startswith(b"ID3") else 0
+    end = size - 128 if parse_id3v1(tail, metadata) else size
+    frame = None
+    while (start := head.find(b"\xff", start)) >= 0:
+        frame = mp3_frame_at(head, start)
+        if frame is not None:
+            break
+        start += 1
+    if frame is None:
+        return metadata
+    version, bitrate, rate, samples = frame
+    mono = (head[start + 3] >> 6) == 3
+    side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    xing = start + 4 + side_info
+    if head[xing:xing + 4] in (b"Xing", b"Info"):
+        flags, = struct.unpack(">I", head[xing + 4:xing + 8])
+        if flags & 0x01:
+            frames, = struct.unpack(">I", head[xing + 8:xing + 12])
+            metadata.length = td(seconds=frames * samples / rate)
+            return metadata
+    vbri = start + 4 + 32
+    if head[vbri:vbri + 4] == b"VBRI":
+        frames, = struct.unpack(">I", head[vbri + 14:vbri + 18])
+        metadata.length = td(seconds=frames * samples / rate)
+        return metadata
+    metadata.length = td(seconds=(end - start) * 8 / (bitrate * 1000))
+    return metadata
@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterator
+
+from aiohttp import hdrs, web
+
+
+# Metrics are plain per-process module state. Every update happens on the
+# event loop thread (the DB pool hook runs in SQLAlchemy's greenlet on that
+# same thread), so no locks are needed. With several workers a scrape
+# reaches one of them, so each labels its samples with its worker index
+# (see Registry.constant_labels) and queries sum over the label.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ACQUIRE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = tuple[str, ...]
+Sample = tuple[str, Labels, float]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    type: str
+    suffix = ""  # appended to the name in HELP/TYPE lines
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+    def render(self, constant_labels: dict[str, str] | None = None) -> Iterator[str]:
+        constant = tuple((constant_labels or {}).items())
+        yield f"# HELP {self.name}{self.suffix} {self.help}"
+        yield f"# TYPE {self.name}{self.suffix} {self.type}"
+        for suffix, values, value in self.samples():
+            names = self.labels + ("le",) if suffix == "_bucket" else self.labels
+            pairs = (*constant, *zip(names, values))
+            labels = ",".join(f'{name}="{escape(label)}"' for name, label in pairs)
+            yield f"{self.name}{suffix}{{{labels}}} {format_value(value)}" if labels \
+                else f"{self.name}{suffix} {format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+    suffix = "_total"
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, labels: Labels = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    @property
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def samples(self) -> Iterator[Sample]:
+        if not self._values and not self.labels:
+            yield "_total", (), 0
+        for labels, value in self._values.items():
+            yield "_total", labels, value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self, name: str, help: str, labels: Labels = (), function: Callable[[], float] | None = None
+    ) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[Labels, float] = {}
+        # Gauges backed by a function are evaluated at scrape time.
+        self.function = function
+
+    def inc(self, amount: float = 1, labels: Labels = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: Labels = ()) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self._values[labels] = value
+
+    def samples(self) -> Iterator[Sample]:
+        if self.function is not None:
+            yield "", (), self.function()
+            return
+        if not self._values and not self.labels:
+            yield "", (), 0
+        for labels, value in self._values.items():
+            yield "", labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Labels = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label set: count in each bucket (the last one is +Inf), sum
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def samples(self) -> Iterator[Sample]:
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                yield "_bucket", (*labels, format_value(bound)), cumulative
+            yield "_sum", labels, self._sums[labels]
+            yield "_count", labels, cumulative
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+        # added to every sample, ahead of the metric's own labels
+        self.constant_labels: dict[str, str] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(f"{line}\n" for metric in self.metrics for line in metric.render(self.constant_labels))
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = Histogram(
+    "simplefiles_http_request_duration_seconds",
+    "Time from routing to the last body byte, by route",
+    ("route", "method"),
+)
+REQUESTS = Counter("simplefiles_http_requests", "Finished requests", ("route", "method", "status"))
+INGESTED_BYTES = Counter("simplefiles_ingested_bytes", "Bytes of file content received")
+SERVED_BYTES = Counter("simplefiles_served_bytes", "Response body bytes sent")
+FILES_STORED = Counter("simplefiles_files_stored", "Files stored through any upload path")
+DEDUP_HITS = Counter("simplefiles_dedup_hits", "Stored files whose content was already present")
+DEDUP_RATIO = Gauge(
+    "simplefiles_dedup_ratio", "Share of stored files that were deduplicated",
+    function=lambda: DEDUP_HITS.total / FILES_STORED.total if FILES_STORED.total else 0.0,
+)
+IN_FLIGHT = Gauge("simplefiles_transfers_in_flight", "Uploads and downloads in progress", ("direction",))
+DB_ACQUIRE = Histogram(
+    "simplefiles_db_acquire_seconds", "Time spent waiting for a pooled DB connection",
+    buckets=ACQUIRE_BUCKETS,
+)
+EXECUTOR_QUEUE = Gauge(
+    "simplefiles_executor_queue_depth", "Jobs waiting for a thread of the default executor",
+)
+BLOB_CACHE_HITS = Counter("simplefiles_blob_cache_hits", "Blob sends served from the in-memory cache")
+BLOB_CACHE_MISSES = Counter("simplefiles_blob_cache_misses", "Blob sends of cacheable size read from disk")
+BLOB_CACHE_EVICTIONS = Counter("simplefiles_blob_cache_evictions", "Blobs evicted from the cache to make room")
+BLOB_CACHE_BYTES = Gauge("simplefiles_blob_cache_bytes", "Bytes of blob content held in the cache")
+BLOB_CACHE_ENTRIES = Gauge("simplefiles_blob_cache_entries", "Blobs held in the cache")
+UPLOADS_ADMITTED = Gauge("simplefiles_uploads_admitted", "Uploads admitted to transfer data")
+UPLOAD_BYTES_ADMITTED = Gauge("simplefiles_upload_bytes_admitted", "Declared bytes of the admitted uploads")
+UPLOAD_QUEUE = Gauge("simplefiles_upload_queue_depth", "Uploads waiting for admission")
+UPLOADS_REJECTED = Counter("simplefiles_uploads_rejected", "Uploads refused by admission control", ("reason",))
+BLOBS_SCRUBBED = Counter("simplefiles_blobs_scrubbed", "Blobs verified by the scrubber, by result", ("result",))
+SCRUBBED_BYTES = Counter("simplefiles_scrubbed_bytes", "Bytes of blobs verified by the scrubber")
+
+for metric in (
+    REQUEST_DURATION, REQUESTS, INGESTED_BYTES, SERVED_BYTES, FILES_STORED, DEDUP_HITS,
+    DEDUP_RATIO, IN_FLIGHT, DB_ACQUIRE, EXECUTOR_QUEUE, BLOB_CACHE_HITS, BLOB_CACHE_MISSES,
+    BLOB_CACHE_EVICTIONS, BLOB_CACHE_BYTES, BLOB_CACHE_ENTRIES, UPLOADS_ADMITTED, UPLOAD_BYTES_ADMITTED,
+    UPLOAD_QUEUE, UPLOADS_REJECTED, BLOBS_SCRUBBED, SCRUBBED_BYTES,
+):
+    REGISTRY.register(metric)
+
+
+def record_stored(deduplicated: bool) -> None:
+    FILES_STORED.inc()
+    if deduplicated:
+        DEDUP_HITS.inc()
+
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+Middleware = Callable[[web.Request, Handler], Awaitable[web.StreamResponse]]
+
+
+def track_requests(transfers: dict[tuple[str, str], str]) -> Middleware:
+    # `transfers` maps (method, route) to "upload" or "download" for the
+    # routes that count towards the in-flight gauge.
+    @web.middleware
+    async def middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+        resource = request.match_info.route.resource
+        route = (resource.canonical or "/") if resource is not None else "unmatched"
+        direction = transfers.get((request.method, route))
+        if direction is not None:
+            IN_FLIGHT.inc(labels=(direction,))
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            # Send the body here rather than after the middleware chain
+            # returns, so latency and in-flight cover the whole transfer.
+            await response.prepare(request)
+            await response.write_eof()
+            status = response.status
+            if request.method != hdrs.METH_HEAD:
+                length = response.content_length
+                SERVED_BYTES.inc(length if length is not None else response.body_length)
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            REQUEST_DURATION.observe(time.perf_counter() - started, (route, request.method))
+            REQUESTS.inc(labels=(route, request.method, str(status)))
+            if direction is not None:
+                IN_FLIGHT.dec(labels=(direction,))
+    return middleware
+
+
+async def instrument_executor(app: web.Application) -> None:
+    # Replaces the loop's default executor with one whose queue can be
+    # observed; everything that calls run_in_executor(None, ...) ends up here.
+    executor = ThreadPoolExecutor(thread_name_prefix="simplefiles")
+    asyncio.get_running_loop().set_default_executor(executor)
+    EXECUTOR_QUEUE.function = executor._work_queue.qsize
+
+
+async def metrics(request: web.Request) -> web.StreamResponse:
+    return web.Response(body=REGISTRY.render().encode(), headers={hdrs.CONTENT_TYPE: CONTENT_TYPE})
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from simplefiles.config import SniffPolicy
+from simplefiles.core.entities import MIMEType, MIMESubtype, AudiosMIME, ImagesMIME, VideosMIME
+
+
+MIME = tuple[MIMEType, MIMESubtype]
+
+GENERIC_TYPES = {
+    (MIMEType.APPLICATION, "octet-stream"),
+    (MIMEType.APPLICATION, "binary"),
+}
+# Declared subtypes that name the same format as the sniffed one
+ALIASES: dict[MIME, MIME] = {
+    (MIMEType.IMAGE, ImagesMIME.PJPEG): (MIMEType.IMAGE, ImagesMIME.JPEG),
+    (MIMEType.AUDIO, "mp3"): (MIMEType.AUDIO, AudiosMIME.MPEG),
+    (MIMEType.AUDIO, "wav"): (MIMEType.AUDIO, AudiosMIME.WAVE),
+    (MIMEType.AUDIO, "x-wav"): (MIMEType.AUDIO, AudiosMIME.WAVE),
+    (MIMEType.AUDIO, "x-m4a"): (MIMEType.AUDIO, AudiosMIME.MP4),
+    (MIMEType.AUDIO, AudiosMIME.VORBIS): (MIMEType.AUDIO, AudiosMIME.OGG),
+    (MIMEType.APPLICATION, "x-zip-compressed"): (MIMEType.APPLICATION, "zip"),
+    (MIMEType.APPLICATION, "x-gzip"): (MIMEType.APPLICATION, "gzip"),
+}
+
+# Signatures at offset 0, grouped by their first two bytes so a lookup is a
+# dict hit plus a handful of startswith() calls. Longer prefixes go first.
+SIGNATURES: list[tuple[bytes, MIME]] = [
+    (b"\x89PNG\r\n\x1a\n", (MIMEType.IMAGE, ImagesMIME.PNG)),
+    (b"\xff\xd8\xff", (MIMEType.IMAGE, ImagesMIME.JPEG)),
+    (b"GIF87a", (MIMEType.IMAGE, ImagesMIME.GIF)),
+    (b"GIF89a", (MIMEType.IMAGE, ImagesMIME.GIF)),
+    (b"II*\x00", (MIMEType.IMAGE, ImagesMIME.TIFF)),
+    (b"MM\x00*", (MIMEType.IMAGE, ImagesMIME.TIFF)),
+    (b"\x00\x00\x01\x00", (MIMEType.IMAGE, ImagesMIME.MS_ICON)),
+    (b"ID3", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xfb", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xfa", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xf3", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xf2", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xe3", (MIMEType.AUDIO, AudiosMIME.MPEG)),
+    (b"\xff\xf1", (MIMEType.AUDIO, AudiosMIME.AAC)),
+    (b"\xff\xf9", (MIMEType.AUDIO, AudiosMIME.AAC)),
+    (b"\x1a\x45\xdf\xa3", (MIMEType.VIDEO, VideosMIME.WEBM)),
+    (b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", (MIMEType.VIDEO, VideosMIME.X_MS_WMV)),
+    (b"FLV\x01", (MIMEType.VIDEO, VideosMIME.X_FLV)),
+    (b"\x00\x00\x01\xba", (MIMEType.VIDEO, VideosMIME.MPEG)),
+    (b"\x00\x00\x01\xb3", (MIMEType.VIDEO, VideosMIME.MPEG)),
+    (b"%PDF-", (MIMEType.APPLICATION, "pdf")),
+    (b"PK\x03\x04", (MIMEType.APPLICATION, "zip")),
+    (b"\x1f\x8b", (MIMEType.APPLICATION, "gzip")),
+    (b"7z\xbc\xaf\x27\x1c", (MIMEType.APPLICATION, "x-7z-compressed")),
+    (b"Rar!\x1a\x07", (MIMEType.APPLICATION, "vnd.rar")),
+]
+# RIFF containers: format tag at offset 8
+RIFF_FORMATS: dict[bytes, MIME] = {
+    b"WEBP": (MIMEType.IMAGE, ImagesMIME.WEBP),
+    b"WAVE": (MIMEType.AUDIO, AudiosMIME.WAVE),
+    b"AVI ": (MIMEType.VIDEO, VideosMIME.X_MSVIDEO),
+}
+# ISO BMFF: major brand at offset 8, after the 'ftyp' box type at 4
+FTYP_BRANDS: dict[bytes, MIME] = {
+    b"qt  ": (MIMEType.VIDEO, VideosMIME.QUICKTIME),
+    b"M4A ": (MIMEType.AUDIO, AudiosMIME.MP4),
+    b"M4B ": (MIMEType.AUDIO, AudiosMIME.MP4),
+    b"3gp4": (MIMEType.VIDEO, VideosMIME.ThirdGPP),
+    b"3gp5": (MIMEType.VIDEO, VideosMIME.ThirdGPP),
+    b"3gp6": (MIMEType.VIDEO, VideosMIME.ThirdGPP),
+    b"3g2a": (MIMEType.VIDEO, VideosMIME.ThirdGPP2),
+}
+# Ogg: first packet of the first logical stream, at offset 28
+OGG_CODECS: dict[bytes, MIME] = {
+    b"\x01vorbis": (MIMEType.AUDIO, AudiosMIME.OGG),
+    b"OpusHead": (MIMEType.AUDIO, AudiosMIME.OGG),
+    b"\x7fFLAC": (MIMEType.AUDIO, AudiosMIME.OGG),
+    b"Speex   ": (MIMEType.AUDIO, AudiosMIME.OGG),
+    b"\x80theora": (MIMEType.VIDEO, VideosMIME.OGG),
+}
+
+# ZIP containers besides OOXML, ODF and the "+zip" suffix (see zip_based)
+ZIP_APPLICATIONS = {"java-archive", "vnd.android.package-archive", "vnd.google-earth.kmz", "x-xpinstall"}
+ZIP_PREFIXES = ("vnd.openxmlformats-", "vnd.oasis.opendocument.")
+# Declared types that use the sniffed container; their own signature lies
+# inside it, so sniffing cannot tell them apart and the declared one is kept.
+CONTAINED: dict[MIME, set[MIME]] = {
+    (MIMEType.AUDIO, AudiosMIME.OGG): {(MIMEType.VIDEO, VideosMIME.OGG), (MIMEType.APPLICATION, "ogg")},
+    (MIMEType.VIDEO, VideosMIME.MP4): {
+        (MIMEType.AUDIO, AudiosMIME.MP4),
+        (MIMEType.VIDEO, VideosMIME.QUICKTIME),
+        (MIMEType.VIDEO, VideosMIME.ThirdGPP),
+        (MIMEType.VIDEO, VideosMIME.ThirdGPP2),
+    },
+    (MIMEType.VIDEO, VideosMIME.WEBM): {(MIMEType.AUDIO, AudiosMIME.WEBM), (MIMEType.VIDEO, "x-matroska")},
+}
+
+
+class MIMEConflict(ValueError):
+    pass
+
+
+def index_signatures(signatures: list[tuple[bytes, MIME]]) -> dict[bytes, list[tuple[bytes, MIME]]]:
+    index: dict[bytes, list[tuple[bytes, MIME]]] = {}
+    for signature, mime in signatures:
+        index.setdefault(signature[:2], []).append((signature, mime))
+    return index
+
+
+PREFIXES = index_signatures(SIGNATURES)
+
+
+def parse_content_type(string: str) -> tuple[MIMEType, MIMESubtype]:
+    try:
+        type_str, subtype_str = string.split("/", maxsplit=1)
+    except TypeError as e:
+        raise ValueError(f"{string!r} is not valid MIME type.") from e
+    mime_type = MIMEType(type_str)
+    SubType: type[MIMESubtype] = str
+    match mime_type:
+        case MIMEType.AUDIO: SubType = AudiosMIME
+        case MIMEType.IMAGE: SubType = ImagesMIME
+        case MIMEType.VIDEO: SubType = VideosMIME
+    try:
+        mime_subtype = SubType(subtype_str)
+    except ValueError:
+        mime_subtype = subtype_str
+    return mime_type, mime_subtype
+
+
+def sniff(data: bytes) -> MIME | None:
+    if data[4:8] == b"ftyp":
+        return FTYP_BRANDS.get(data[8:12], (MIMEType.VIDEO, VideosMIME.MP4))
+    if data.startswith(b"RIFF"):
+        return RIFF_FORMATS.get(data[8:12])
+    if data.startswith(b"OggS"):
+        for codec, mime in OGG_CODECS.items():
+            if data.startswith(codec, 28):
+                return mime
+        return MIMEType.AUDIO, AudiosMIME.OGG
+    for signature, mime in PREFIXES.get(data[:2], []):
+        if data.startswith(signature):
+            return mime
+    return None
+
+
+def zip_based(subtype: MIMESubtype) -> bool:
+    # application subtypes stored as ZIP archives: JAR, OOXML, ODF, EPUB...
+    return subtype in ZIP_APPLICATIONS or subtype.endswith("+zip") or subtype.startswith(ZIP_PREFIXES)
+
+
+def contained(declared: MIME, sniffed: MIME) -> bool:
+    if sniffed == (MIMEType.APPLICATION, "zip"):
+        return declared[0] is MIMEType.APPLICATION and zip_based(declared[1])
+    return declared in CONTAINED.get(sniffed, ())
+
+
+def resolve_content_type(declared: MIME, sniffed: MIME | None, policy: SniffPolicy) -> MIME:
+    if policy is SniffPolicy.DECLARED or sniffed is None:
+        return declared
+    if declared in GENERIC_TYPES or ALIASES.get(declared, declared) == sniffed:
+        return sniffed
+    if contained(declared, sniffed):
+        return declared
+    if policy is SniffPolicy.REJECT:
+        raise MIMEConflict(
+            f"Declared type {'/'.join(declared)} does not match content ({'/'.join(sniffed)})"
+        )
+    return sniffed
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import logging
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from aiohttp import web
+from PIL import Image as PILImage, ImageOps
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import PreviewOptions
+from simplefiles.core.entities import BlobStore, ImagesMIME, MIMEType, Resolution
+from .db import FileInfo, Media, Preview
+from .logs import log_event, logger
+from .repository import MediaRepository, utcnow
+from .responses import send_blob
+
+
+FRAME_TIMEOUT = 30
+FRAME_OFFSETS = ("1", "0")  # seconds; very short clips have no frame at 1s
+
+Rendered = tuple[bytes, int, int]
+
+
+def extract_frame(source: Path | bytes, ffmpeg: str) -> bytes | None:
+    for offset in FRAME_OFFSETS:
+        command = [
+            ffmpeg, "-v", "error", "-ss", offset,
+            "-i", "-" if isinstance(source, bytes) else str(source),
+            "-frames:v", "1", "-f", "image2pipe", "-c:v", "png", "-",
+        ]
+        result = subprocess.run(
+            command,
+            input=source if isinstance(source, bytes) else None,
+            capture_output=True,
+            timeout=FRAME_TIMEOUT,
+        )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    return None
+
+
+def render_preview(
+    source: Path | bytes, kind: MIMEType, size: int, quality: int, ffmpeg: str | None
+) -> Rendered | None:
+    # Runs in a worker process. Failures are reported as None rather than
+    # raised: decoder exceptions do not always survive pickling.
+    try:
+        if kind is MIMEType.VIDEO:
+            if ffmpeg is None:
+                return None
+            frame = extract_frame(source, ffmpeg)
+            if frame is None:
+                return None
+            source = frame
+        with PILImage.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+            # thumbnail() lets JPEG decode at a reduced scale via draft()
+            image.thumbnail((size, size), PILImage.LANCZOS)
+            image = ImageOps.exif_transpose(image)
+            mode = "RGBA" if image.mode in ("RGBA", "LA", "PA", "P") else "RGB"
+            if image.mode != mode:
+                image = image.convert(mode)
+            output = io.BytesIO()
+            image.save(output, "WEBP", quality=quality, method=4)
+            return output.getvalue(), image.width, image.height
+    except (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError, subprocess.SubprocessError):
+        return None
+
+
+class PreviewManager:
+    _pending: dict[tuple[str, str], asyncio.Future[Preview | None]]
+    _tasks: set[asyncio.Task[None]]
+
+    def __init__(
+        self,
+        blobs: BlobStore,
+        sessions: async_sessionmaker[AsyncSession],
+        options: PreviewOptions,
+    ) -> None:
+        self._blobs = blobs
+        self._sessions = sessions
+        self._options = options
+        self._ffmpeg = shutil.which(options.ffmpeg)
+        self._pool = ProcessPoolExecutor(options.workers)
+        self._pending = {}
+        self._tasks = set()
+
+    @property
+    def presets(self) -> dict[str, int]:
+        return self._options.presets
+
+    @property
+    def default(self) -> str:
+        return self._options.default
+
+    def schedule(self, media: Media) -> None:
+        if media.type not in (MIMEType.IMAGE, MIMEType.VIDEO):
+            return
+        task = asyncio.create_task(self._generate_default(media))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def ensure(self, source_hash: str, kind: MIMEType, preset: str) -> Preview | None:
+        # Concurrent requests for the same preview share one render.
+        key = (source_hash, preset)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._generate(source_hash, kind, preset))
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._pool.shutdown)
+
+    async def _generate_default(self, media: Media) -> None:
+        try:
+            preview = await self.ensure(media.info.hash, media.type, self.default)
+            if preview is not None:
+                async with self._sessions() as session:
+                    await MediaRepository(session).link_preview(media.media_id, media.type, preview.preview_id)
+        except Exception as e:
+            log_event(logger, logging.WARNING, "preview failed", media_id=media.media_id, error=repr(e))
+
+    async def _generate(self, source_hash: str, kind: MIMEType, preset: str) -> Preview | None:
+        async with self._sessions() as session:
+            repository = MediaRepository(session)
+            preview = await repository.get_preview(source_hash, preset)
+            if preview is not None:
+                return preview
+        source: Path | bytes | None = self._blobs.local_path(source_hash)
+        if source is None:
+            source = await self._blobs.read(source_hash)
+        loop = asyncio.get_running_loop()
+        rendered = await loop.run_in_executor(
+            self._pool, render_preview,
+            source, kind, self.presets[preset], self._options.quality, self._ffmpeg,
+        )
+        if rendered is None:
+            return None
+        data, width, height = rendered
+        async with self._blobs.tempfile() as tmp:
+            await tmp.write(data)
+            await tmp.close()
+            file_hash = tmp.hash.hex()
+            file_path = self._blobs.locate(file_hash)
+            async with self._sessions() as session:
+                repository = MediaRepository(session)
+                file = await repository.add_file_info(FileInfo(file_path, file_hash, len(data)))
+                await tmp.materialize(file_path, exists_ok=True)
+                preview = Preview(
+                    f"{preset}.webp", file, ImagesMIME.WEBP, utcnow(),
+                    source_hash, preset, Resolution(width, height),
+                )
+                return await repository.add_preview(preview)
+
+
+async def close_previews(app: web.Application) -> None:
+    await app["previews"].close()
+
+
+async def preview(request: web.Request) -> web.StreamResponse:
+    previews: PreviewManager = request.app["previews"]
+    try:
+        id = int(request.query["id"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest()
+    preset = request.query.get("size", previews.default)
+    if preset not in previews.presets:
+        raise web.HTTPBadRequest(text=f"'size' must be one of {sorted(previews.presets)}")
+    # The session is closed before a render, which holds the request for
+    # as long as the process pool takes, like the transfer in store.
+    async with request.app["sessions"]() as session:
+        repository = MediaRepository(session)
+        media = await repository.get(id)
+        if media is None or media.type not in (MIMEType.IMAGE, MIMEType.VIDEO):
+            raise web.HTTPNotFound()
+        source_hash, kind = media.info.hash, media.type
+        found = await repository.get_preview(source_hash, preset)
+    if found is None:
+        found = await previews.ensure(source_hash, kind, preset)
+    if found is None:
+        raise web.HTTPNotFound(text="Preview is not available")
+    headers = {"Content-Type": "image/webp", "Cache-Control": "no-cache"}
+    return await send_blob(request, found.info.hash, headers)
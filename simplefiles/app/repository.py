@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+import re
+from datetime import datetime as dt, timezone as tz
+from typing import Iterable
+
+from sqlalchemy import case, column, func, literal_column, select, table, tuple_, update
+from sqlalchemy.sql.functions import coalesce
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, with_polymorphic
+
+from simplefiles.core.entities import Metadata, MIMEType, MIMESubtype
+from .db import Audio, Image, Video, File, FileInfo, Media, Preview, variants
+from .db import audios, file_infos, files, images, medias, videos
+
+
+MEDIAS = with_polymorphic(Media, [Audio, Image, Video, File])
+SUBTYPES = {
+    MIMEType.AUDIO: MEDIAS.Audio.subtype,
+    MIMEType.IMAGE: MEDIAS.Image.subtype,
+    MIMEType.VIDEO: MEDIAS.Video.subtype,
+}
+
+SEARCH_TERMS = 16
+# Ranking is limited to this many of the newest matches: bm25 costs about a
+# microsecond per matching row, which broad terms multiply by millions.
+SEARCH_WINDOW = 5000
+SEARCH_TOKEN = re.compile(r"(\w+)(\*?)")
+FTS = literal_column("medias_fts")
+medias_fts = table("medias_fts", column("rowid"))
+SUBTYPE_TABLES = {MIMEType.AUDIO: audios, MIMEType.IMAGE: images, MIMEType.VIDEO: videos}
+
+
+def utcnow() -> dt:
+    return dt.now(tz.utc)
+
+
+def create_media(
+    name: str,
+    file: FileInfo,
+    mime_type: MIMEType,
+    mime_subtype: MIMESubtype,
+    loaded_at: dt,
+    metadata: Metadata | None = None,
+) -> Media:
+    meta = metadata or Metadata()
+    match mime_type:
+        case MIMEType.APPLICATION: return File(name, file, mime_subtype, loaded_at)
+        case MIMEType.AUDIO:
+            return Audio(name, file, mime_subtype, loaded_at, meta.length, meta.artist, meta.album, meta.track)
+        case MIMEType.CHEMICAL: return File(name, file, mime_subtype, loaded_at)
+        case MIMEType.FONT: return File(name, file, mime_subtype, loaded_at)
+        case MIMEType.IMAGE: return Image(name, file, mime_subtype, loaded_at, meta.resolution)
+        case MIMEType.VIDEO: return Video(name, file, mime_subtype, loaded_at, meta.resolution, meta.length)
+        case _: return File(name, file, mime_subtype, loaded_at)
+
+
+def fts_query(text: str) -> str | None:
+    # Every word must match and "word*" matches by prefix. Words are quoted,
+    # so FTS5 operators and column filters in user input stay inert.
+    terms = [f'"{word}"{star}' for word, star in SEARCH_TOKEN.findall(text)[:SEARCH_TERMS]]
+    return " ".join(terms) or None
+
+
+class MediaRepository:
+    _session: AsyncSession
+
+    def __init__(self, session: AsyncSession) -> None:
+        self._session = session
+
+    async def get(self, media_id: int) -> Media | None:
+        query = (
+            select(MEDIAS)
+            .options(joinedload(MEDIAS.info))
+            .where(MEDIAS.media_id == media_id)
+        )
+        result = await self._session.execute(query)
+        return result.scalar_one_or_none()
+
+    async def get_many(self, media_ids: Iterable[int]) -> dict[int, Media]:
+        query = (
+            select(MEDIAS)
+            .options(joinedload(MEDIAS.info))
+            .where(MEDIAS.media_id.in_(set(media_ids)))
+        )
+        result = await self._session.execute(query)
+        return {media.media_id: media for media in result.scalars()}
+
+    async def page(
+        self,
+        mime_type: MIMEType | None = None,
+        mime_subtype: MIMESubtype | None = None,
+        since: dt | None = None,
+        until: dt | None = None,
+        before: tuple[dt, int] | None = None,
+        limit: int = 50,
+    ) -> list[Media]:
+        query = select(MEDIAS).options(joinedload(MEDIAS.info))
+        if mime_type is not None:
+            query = query.where(MEDIAS.media_type == mime_type)
+            if mime_subtype is not None:
+                subtype = SUBTYPES.get(mime_type, MEDIAS.File.subtype)
+                query = query.where(subtype == mime_subtype)
+        if since is not None:
+            query = query.where(MEDIAS.loaded_at >= since)
+        if until is not None:
+            query = query.where(MEDIAS.loaded_at < until)
+        if before is not None:
+            query = query.where(tuple_(MEDIAS.loaded_at, MEDIAS.media_id) < tuple_(*before))
+        query = query.order_by(MEDIAS.loaded_at.desc(), MEDIAS.media_id.desc()).limit(limit)
+        result = await self._session.execute(query)
+        return list(result.scalars())
+
+    async def search(
+        self,
+        query: str,
+        mime_type: MIMEType | None = None,
+        mime_subtype: MIMESubtype | None = None,
+        after: tuple[float, int] | None = None,
+        limit: int = 50,
+    ) -> list[tuple[Media, float]]:
+        # bm25 scores are negative, better matches lower; (score, media_id)
+        # orders results totally, so it doubles as the page cursor. The
+        # window's lower bound is a rowid, which FTS5 applies while reading
+        # its doclists. Filters, cursor and limit all apply inside the
+        # subquery, so only one page of rows is joined to load medias.
+        match = FTS.op("MATCH")(query)
+        score = func.bm25(FTS)
+        rowid = medias_fts.c.rowid
+        newest = select(rowid).where(match).order_by(rowid.desc()).limit(1).offset(SEARCH_WINDOW - 1)
+        page = select(rowid.label("media_id"), score.label("score"))
+        if mime_type is not None:
+            # the window counts matches of the requested type only, so rare
+            # types still fill it
+            newest = newest.join(medias, medias.c.media_id == rowid).where(medias.c.media_type == mime_type)
+            page = page.join(medias, medias.c.media_id == rowid).where(medias.c.media_type == mime_type)
+            if mime_subtype is not None:
+                subtypes = SUBTYPE_TABLES.get(mime_type, files)
+                key = subtypes.primary_key.columns.values()[0]
+                page = page.join(subtypes, key == rowid).where(subtypes.c.subtype == mime_subtype)
+        page = page.where(match, rowid >= coalesce(newest.scalar_subquery(), 0))
+        if after is not None:
+            page = page.where(tuple_(score, rowid) > tuple_(*after))
+        matches = page.order_by(score, rowid).limit(limit).subquery()
+        statement = (
+            select(MEDIAS, matches.c.score)
+            .options(joinedload(MEDIAS.info))
+            .join(matches, MEDIAS.media_id == matches.c.media_id)
+            .order_by(matches.c.score, MEDIAS.media_id)
+        )
+        result = await self._session.execute(statement)
+        return [(media, score) for media, score in result]
+
+    async def add_file_info(self, file: FileInfo) -> FileInfo:
+        # Known content is looked up first and IntegrityError is left to
+        # concurrent inserts: cursors of failed INSERTs linger in traceback
+        # cycles, and the GC resetting one on the loop thread blocks with the
+        # GIL held while its connection waits out busy_timeout elsewhere.
+        existing = await self._session.get(FileInfo, file.hash)
+        if existing is not None:
+            if await self._reclaim(existing):
+                return existing
+            # collected since the lookup: the row is inserted again
+            self._session.expunge(existing)
+        try:
+            self._session.add(file)
+            await self._session.commit()
+        except IntegrityError:
+            await self._session.rollback()
+            file = await self._session.get(FileInfo, file.hash)  # type: ignore
+        return file
+
+    async def reclaim_file_info(self, hash: str) -> FileInfo | None:
+        # For content the client names by hash only. A row the collector has
+        # claimed may be losing its blob right now, so it counts as unknown
+        # and the client uploads the bytes instead.
+        query = select(FileInfo).where(file_infos.c.hash == hash, file_infos.c.collecting_since.is_(None))
+        file = await self._session.scalar(query)
+        if file is None or not await self._reclaim(file):
+            return None
+        return file
+
+    async def _reclaim(self, file: FileInfo) -> bool:
+        # The collector claims unreferenced rows before unlinking their blobs
+        # and only deletes rows still claimed. Clearing the claim keeps the
+        # row, and an unreferenced one gets a new grace period for the media
+        # about to refer to it; callers publish the blob after this commits.
+        result = await self._session.execute(
+            update(file_infos)
+            .where(file_infos.c.hash == file.hash)
+            .values(
+                collecting_since=None,
+                unreferenced_at=case((file_infos.c.refs == 0, func.current_timestamp())),
+            )
+        )
+        await self._session.commit()
+        return bool(result.rowcount)  # type: ignore[attr-defined]
+
+    async def add(
+        self,
+        name: str,
+        mime_type: MIMEType,
+        mime_subtype: MIMESubtype,
+        file: FileInfo,
+        metadata: Metadata | None = None,
+    ) -> Media:
+        media = create_media(name, file, mime_type, mime_subtype, utcnow(), metadata)
+        try:
+            self._session.add(media)
+        finally:
+            await self._session.commit()
+        return media
+
+    async def delete(self, media_id: int) -> bool:
+        # The blob stays; the collector removes it once nothing refers to it.
+        media = await self.get(media_id)
+        if media is None:
+            return False
+        await self._session.delete(media)
+        await self._session.commit()
+        return True
+
+    async def get_preview(self, source_hash: str, preset: str) -> Preview | None:
+        query = select(Preview).where(Preview.source_hash == source_hash, Preview.preset == preset)
+        result = await self._session.execute(query)
+        return result.scalar_one_or_none()
+
+    async def add_preview(self, preview: Preview) -> Preview:
+        try:
+            self._session.add(preview)
+            await self._session.commit()
+        except IntegrityError:
+            await self._session.rollback()
+            existing = await self.get_preview(preview.source_hash, preview.preset)
+            assert existing is not None
+            preview = existing
+        return preview
+
+    async def get_variants(self, source_hash: str) -> dict[str, str | None]:
+        query = select(variants.c.encoding, variants.c.file_hash).where(variants.c.source_hash == source_hash)
+        result = await self._session.execute(query)
+        return {encoding: file_hash for encoding, file_hash in result}
+
+    async def add_variant(self, source_hash: str, encoding: str, file_hash: str | None) -> None:
+        statement = insert(variants).values(source_hash=source_hash, encoding=encoding, file_hash=file_hash)
+        await self._session.execute(statement.on_conflict_do_nothing())
+        await self._session.commit()
+
+    async def link_preview(self, media_id: int, kind: MIMEType, preview_id: int) -> None:
+        if kind is MIMEType.VIDEO:
+            statement = update(videos).where(videos.c.video_id == media_id)
+        else:
+            statement = update(images).where(images.c.image_id == media_id)
+        await self._session.execute(statement.values(preview_id=preview_id))
+        await self._session.commit()
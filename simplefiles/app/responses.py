@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+from email.utils import formatdate
+from pathlib import Path
+from typing import IO, Sequence
+
+from aiohttp import hdrs, web
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.helpers import ETAG_ANY
+
+from simplefiles.core.entities import BlobStore
+from .cache import BlobCache, CachedBlob
+
+
+CHUNK_SIZE = 256*1024
+MAX_RANGES = 64
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+ByteRange = tuple[int, int]
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_ranges(header: str, size: int) -> list[ByteRange] | None:
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    ranges: list[ByteRange] = []
+    for spec in specs.split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix:
+                    ranges.append((max(size - suffix, 0), size))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else max(size, start + 1)
+        except ValueError:
+            return None
+        if start < 0 or stop <= start:
+            return None
+        if start < size:
+            ranges.append((start, min(stop, size)))
+    if not ranges:
+        raise RangeNotSatisfiable(header)
+    return coalesce_ranges(ranges)
+
+
+def is_not_modified(request: web.BaseRequest, etag: str | None, mtime: float | None = None) -> bool:
+    # If-None-Match takes precedence; If-Modified-Since is only consulted
+    # when the client sent no entity tags (RFC 9110, 13.1.3).
+    if request.method not in (hdrs.METH_GET, hdrs.METH_HEAD):
+        return False
+    etags = request.if_none_match
+    if etags is not None:
+        return etag is not None and any(tag.value in (etag, ETAG_ANY) for tag in etags)
+    since = request.if_modified_since
+    return since is not None and mtime is not None and int(mtime) <= since.timestamp()
+
+
+def not_modified(etag: str | None, headers: dict[str, str] | None = None) -> web.Response:
+    response = web.Response(status=304, headers=headers)
+    if etag is not None:
+        response.etag = etag
+    return response
+
+
+def coalesce_ranges(ranges: Sequence[ByteRange]) -> list[ByteRange]:
+    merged: list[ByteRange] = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+class BlobResponse(web.StreamResponse):
+    _path: Path
+    _etag: str | None
+    _cache: BlobCache | None
+
+    def __init__(
+        self,
+        path: Path,
+        *,
+        etag: str | None = None,
+        status: int = 200,
+        headers: dict[str, str] | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        cache: BlobCache | None = None,
+    ) -> None:
+        # The cache is keyed by etag, which must then be the blob's hash.
+        super().__init__(status=status, headers=headers)
+        self._path = path
+        self._etag = etag
+        self._chunk_size = chunk_size
+        self._cache = cache
+
+    async def prepare(self, request: web.BaseRequest) -> AbstractStreamWriter | None:
+        if self.prepared or self._eof_sent:
+            # Sent already (by a middleware); the protocol prepares once more.
+            return await super().prepare(request)
+        if self._etag is not None:
+            self.etag = self._etag
+        if request.if_none_match is not None and is_not_modified(request, self._etag):
+            return await self._prepare_empty(request, 304)
+        loop = asyncio.get_running_loop()
+        # Cache hits are answered without a single executor job.
+        cache, hash = self._cache, self._etag
+        cached = cache.get(hash) if cache is not None and hash is not None else None
+        if cached is not None:
+            size, mtime = len(cached.data), cached.mtime
+        else:
+            try:
+                stat = await loop.run_in_executor(None, self._path.stat)
+            except FileNotFoundError:
+                return await self._prepare_missing(request)
+            size, mtime = stat.st_size, stat.st_mtime
+        content_type = self.headers.get(hdrs.CONTENT_TYPE, "application/octet-stream")
+        self.headers[hdrs.LAST_MODIFIED] = formatdate(mtime, usegmt=True)
+        if is_not_modified(request, self._etag, mtime):
+            return await self._prepare_empty(request, 304)
+        self.headers[hdrs.ACCEPT_RANGES] = "bytes"
+        if (
+            cached is None and cache is not None and hash is not None
+            and cache.admits(size) and request.method != hdrs.METH_HEAD
+        ):
+            try:
+                data = await loop.run_in_executor(None, self._path.read_bytes)
+            except FileNotFoundError:
+                return await self._prepare_missing(request)
+            cached = CachedBlob(data, mtime)
+            size = len(data)
+            cache.put(hash, cached)
+
+        ranges: list[ByteRange] | None = None
+        range_header = request.headers.get(hdrs.RANGE)
+        if range_header is not None and self._if_range_matches(request, mtime):
+            try:
+                ranges = parse_ranges(range_header, size)
+            except RangeNotSatisfiable:
+                self.headers[hdrs.CONTENT_RANGE] = f"bytes */{size}"
+                return await self._prepare_empty(request, 416)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                ranges = None
+
+        segments: list[tuple[bytes, int, int]]
+        if not ranges:
+            segments = [(b"", 0, size)]
+            self.content_length = size
+        elif len(ranges) == 1:
+            (start, stop), = ranges
+            self.set_status(206)
+            self.headers[hdrs.CONTENT_RANGE] = f"bytes {start}-{stop - 1}/{size}"
+            segments = [(b"", start, stop - start)]
+            self.content_length = stop - start
+        else:
+            boundary = uuid.uuid4().hex
+            segments = [
+                (
+                    (
+                        f"\r\n--{boundary}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+                    ).encode(),
+                    start, stop - start
+                )
+                for start, stop in ranges
+            ]
+            segments.append((f"\r\n--{boundary}--\r\n".encode(), 0, 0))
+            self.set_status(206)
+            self.headers[hdrs.CONTENT_TYPE] = f"multipart/byteranges; boundary={boundary}"
+            self.content_length = sum(len(head) + count for head, _, count in segments)
+
+        writer = await super().prepare(request)
+        if request.method == hdrs.METH_HEAD or not self.content_length:
+            return writer
+        assert writer is not None
+        if cached is not None:
+            await self._send_memory(request, writer, segments, cached.data)
+            await super().write_eof()
+            return writer
+        fobj = await loop.run_in_executor(None, self._path.open, "rb")
+        try:
+            for head, offset, count in segments:
+                await self._send(request, writer, head, fobj, offset, count)
+        finally:
+            await loop.run_in_executor(None, fobj.close)
+        await super().write_eof()
+        return writer
+
+    async def _prepare_empty(self, request: web.BaseRequest, status: int) -> AbstractStreamWriter | None:
+        self.set_status(status)
+        if status == 304:
+            # Bodiless by definition: no Content-Length, no chunked framing.
+            self._length_check = False
+            for header in (hdrs.CONTENT_TYPE, hdrs.CONTENT_DISPOSITION):
+                self.headers.pop(header, None)
+        else:
+            self.content_length = 0
+        return await super().prepare(request)
+
+    async def _prepare_missing(self, request: web.BaseRequest) -> AbstractStreamWriter | None:
+        self.etag = None
+        self.headers.pop(hdrs.CACHE_CONTROL, None)
+        return await self._prepare_empty(request, 404)
+
+    def _if_range_matches(self, request: web.BaseRequest, mtime: float) -> bool:
+        if_range = request.headers.get(hdrs.IF_RANGE)
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', "W/")):
+            return self._etag is not None and if_range == f'"{self._etag}"'
+        since = request.if_range
+        return since is not None and int(mtime) <= since.timestamp()
+
+    async def _send_memory(
+        self,
+        request: web.BaseRequest,
+        writer: AbstractStreamWriter,
+        segments: list[tuple[bytes, int, int]],
+        data: bytes,
+    ) -> None:
+        transport = request.transport
+        assert transport is not None
+        view = memoryview(data)
+        for head, offset, count in segments:
+            if head:
+                transport.write(head)
+            if count:
+                transport.write(view[offset:offset + count])
+            await writer.drain()
+
+    async def _send(
+        self,
+        request: web.BaseRequest,
+        writer: AbstractStreamWriter,
+        head: bytes,
+        fobj: IO[bytes],
+        offset: int,
+        count: int,
+    ) -> None:
+        # Body bytes bypass the payload writer: the kernel copies file pages
+        # straight into the socket, and multipart framing goes to the same
+        # transport so ordering is preserved.
+        transport = request.transport
+        assert transport is not None
+        if head:
+            transport.write(head)
+        if not count:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.sendfile(transport, fobj, offset, count, fallback=False)
+        except (NotImplementedError, asyncio.SendfileNotAvailableError):
+            await loop.run_in_executor(None, fobj.seek, offset)
+            while count > 0:
+                chunk = await loop.run_in_executor(None, fobj.read, min(self._chunk_size, count))
+                if not chunk:
+                    break
+                transport.write(chunk)
+                count -= len(chunk)
+                await writer.drain()
+
+
+async def send_blob(request: web.Request, hash: str, headers: dict[str, str]) -> web.StreamResponse:
+    blobs: BlobStore = request.app["blobs"]
+    file_path = blobs.local_path(hash)
+    if file_path is not None:
+        return BlobResponse(file_path, etag=hash, headers=headers, cache=request.app["cache"])
+    if is_not_modified(request, hash):
+        return not_modified(hash, {"Cache-Control": headers["Cache-Control"]})
+    try:
+        body = await blobs.read(hash)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    response = web.Response(body=body, headers=headers)
+    response.etag = hash
+    return response
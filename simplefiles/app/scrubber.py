@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import mmap
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt, timedelta as td
+from pathlib import Path
+from typing import Sequence
+
+from aiohttp import web
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import ScrubOptions
+from .db import Integrity, file_infos
+from .logs import log_event, logger
+from .metrics import BLOBS_SCRUBBED, SCRUBBED_BYTES
+from .repository import utcnow
+from .storage import FileSystemBlobStore
+
+
+SLICE_SIZE = 1024*1024
+BLOB_COST = 64*1024  # bytes of reading charged for opening a blob, so tiny ones are paced too
+
+# (hash, size, result) of one verified blob
+Verified = tuple[str, int, Integrity]
+
+
+def pace(started: float, done: int, rate: float) -> None:
+    if rate <= 0:
+        return
+    delay = started + done / rate - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def verify_blob(path: Path, hash: str, size: int, rate: float) -> Integrity:
+    # Runs in the pool. Reads are paced to `rate` bytes per second, and the
+    # pages are dropped from the page cache afterwards, so scrubbing neither
+    # saturates the disk nor evicts what downloads are reading.
+    started = time.monotonic()
+    try:
+        with path.open("rb") as file:
+            fd = file.fileno()
+            if os.fstat(fd).st_size != size:
+                return Integrity.CORRUPT
+            hasher = hashlib.new("sha256")
+            if size:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    if hasattr(mapped, "madvise"):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    for offset in range(0, size, SLICE_SIZE):
+                        hasher.update(view[offset:offset + SLICE_SIZE])
+                        pace(started, min(offset + SLICE_SIZE, size), rate)
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except FileNotFoundError:
+        return Integrity.MISSING
+    except OSError:
+        return Integrity.UNREADABLE
+    finally:
+        pace(started, BLOB_COST, rate)
+    return Integrity.OK if hasher.hexdigest() == hash else Integrity.CORRUPT
+
+
+class Scrubber:
+    # Re-hashes stored blobs and records the outcome in files_info. Blobs
+    # are taken least recently verified first, never verified ones before
+    # all others, so an interrupted scrub picks up where it stopped. No
+    # connection is held while hashing: a batch is read, verified, then
+    # written back in one short transaction.
+    _task: asyncio.Task[None] | None
+
+    def __init__(
+        self,
+        blobs: FileSystemBlobStore,
+        sessions: async_sessionmaker[AsyncSession],
+        options: ScrubOptions,
+    ) -> None:
+        self._blobs = blobs
+        self._sessions = sessions
+        self._options = options
+        self._pool = ProcessPoolExecutor(options.workers)
+        self._task = None
+
+    async def scrub(self, cutoff: dt) -> tuple[int, list[Verified]]:
+        # Verifies one batch of the blobs last verified before `cutoff`.
+        # Returns how many rows were taken, which is 0 only once none is
+        # due, and the results for those still present.
+        async with self._sessions() as session:
+            result = await session.execute(
+                select(file_infos.c.hash, file_infos.c.size)
+                .where(or_(file_infos.c.verified_at.is_(None), file_infos.c.verified_at < cutoff))
+                .order_by(file_infos.c.verified_at, file_infos.c.hash)
+                .limit(self._options.batch_size)
+            )
+            blobs = result.all()
+        if not blobs:
+            return 0, []
+        results = await self._verify(blobs)
+        # Rows are committed before their blob is published, so a fresh one
+        # can look missing: only a blob still missing after the batch counts.
+        missing = [index for index, result in enumerate(results) if result is Integrity.MISSING]
+        if missing:
+            again = await self._verify([blobs[index] for index in missing])
+            for index, result in zip(missing, again):
+                results[index] = result
+        verified = [(hash, size, result) for (hash, size), result in zip(blobs, results)]
+        async with self._sessions() as session:
+            await session.execute(
+                update(file_infos)
+                .where(file_infos.c.hash == bindparam("blob_hash"))
+                .values(verified_at=bindparam("verified_at"), integrity=bindparam("integrity")),
+                [{"blob_hash": hash, "verified_at": utcnow(), "integrity": result} for hash, _, result in verified],
+            )
+            await session.commit()
+            # The collector may have removed some of them meanwhile; those
+            # are gone rather than missing.
+            failed = [hash for hash, _, result in verified if result is not Integrity.OK]
+            if failed:
+                present = set(await session.scalars(select(file_infos.c.hash).where(file_infos.c.hash.in_(failed))))
+                verified = [item for item in verified if item[2] is Integrity.OK or item[0] in present]
+        for hash, size, result in verified:
+            BLOBS_SCRUBBED.inc(labels=(result,))
+            SCRUBBED_BYTES.inc(size)
+            if result is not Integrity.OK:
+                log_event(logger, logging.ERROR, "blob failed verification", hash=hash, size=size, result=result)
+        return len(blobs), verified
+
+    async def _verify(self, blobs: Sequence[tuple[str, int]]) -> list[Integrity]:
+        loop = asyncio.get_running_loop()
+        rate = self._options.rate / self._options.workers
+        return list(await asyncio.gather(*(
+            loop.run_in_executor(self._pool, verify_blob, self._blobs.locate(hash), hash, size, rate)
+            for hash, size in blobs
+        )))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, lambda: self._pool.shutdown(cancel_futures=True))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                taken, _ = await self.scrub(utcnow() - td(seconds=self._options.period))
+            except (SQLAlchemyError, OSError) as e:
+                log_event(logger, logging.WARNING, "scrub failed", error=repr(e))
+                taken = 0
+            # A full batch means more blobs are due: go on after yielding.
+            full = taken >= self._options.batch_size
+            await asyncio.sleep(0 if full else self._options.idle)
+
+
+async def start_scrubber(app: web.Application) -> None:
+    if app["config"].scrub.enabled:
+        app["scrubber"].start()
+
+
+async def close_scrubber(app: web.Application) -> None:
+    await app["scrubber"].close()
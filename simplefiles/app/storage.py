@@ -0,0 +1,378 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncContextManager, AsyncIterator, BinaryIO, Iterator, NamedTuple, TypeVar
+
+from simplefiles.config import FsyncPolicy, StorageOptions
+from simplefiles.core.entities import BlobStore, Metadata, TempFile
+from .metadata import MetadataProbe
+from .mime import MIME, sniff
+
+
+BUFFER_SIZE = 4*1024*1024
+MAP_SLICE_SIZE = 1024*1024
+SHARD_WIDTH = 2
+INCOMING_DIR = "incoming"
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+# temp files are "<uuid4>", resumable upload parts "<upload_id>.part"
+INCOMING_PATTERN = re.compile(r"(?P<id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})(?P<part>\.part)?")
+
+
+def shard_path(root: Path, hash: str, depth: int) -> Path:
+    shards = (hash[i*SHARD_WIDTH:(i+1)*SHARD_WIDTH] for i in range(depth))
+    return root.joinpath(*shards, hash)
+
+
+def fsync_directory(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MaterialTempFile(TempFile):
+    _path: Path
+    _file: BinaryIO
+    _buffer: bytearray
+    _pending: asyncio.Future[None] | None
+
+    def __init__(
+        self,
+        directory: Path | None,
+        buffer_size: int = BUFFER_SIZE,
+        fsync: FsyncPolicy = FsyncPolicy.NEVER,
+    ) -> None:
+        tmpdir = directory or (Path.cwd() / "tmp")
+        self._path = tmpdir / str(uuid.uuid4())
+        self._hasher = hashlib.new("sha256")
+        self._size = 0
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._pending = None
+        self._closed = False
+        self._fsync = fsync
+        self._probe = MetadataProbe()
+
+    @property
+    def hash(self) -> bytes:
+        return self._hasher.digest()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def metadata(self) -> Metadata:
+        return self._probe.result()
+
+    @classmethod
+    @asynccontextmanager
+    async def open(
+        cls: type[_MTF],
+        directory: Path | None = None,
+        buffer_size: int = BUFFER_SIZE,
+        fsync: FsyncPolicy = FsyncPolicy.NEVER,
+    ) -> AsyncIterator[_MTF]:
+        tempfile = cls(directory, buffer_size, fsync)
+        await tempfile._open()
+        try:
+            yield tempfile
+        finally:
+            await tempfile.close()
+            tempfile._path.unlink(missing_ok=True)
+
+    async def _open(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._file = await loop.run_in_executor(None, self._path.open, "wb")
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        self._size += len(data)
+        if len(self._buffer) >= self._buffer_size:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        # At most one buffer is in flight: the next one keeps filling from the
+        # network while a worker thread hashes and writes the previous one.
+        if self._pending is not None:
+            await self._pending
+            self._pending = None
+        if not self._buffer:
+            return
+        loop = asyncio.get_running_loop()
+        buffer, self._buffer = self._buffer, bytearray()
+        self._pending = loop.run_in_executor(None, self._consume, buffer)
+
+    def _consume(self, buffer: bytearray) -> None:
+        self._hasher.update(buffer)
+        self._probe.feed(buffer)
+        self._file.write(buffer)
+
+    def _finish(self) -> None:
+        if self._fsync is not FsyncPolicy.NEVER:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        await self._flush()
+        if self._pending is not None:
+            await self._pending
+            self._pending = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._finish)
+
+    async def materialize(self, path: str | Path, exists_ok: bool = False) -> None:
+        await self.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._materialize, Path(path), exists_ok)
+
+    def _materialize(self, target_path: Path, exists_ok: bool) -> None:
+        if target_path.exists():
+            if not exists_ok:
+                raise RuntimeError
+            return
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        self._path.rename(target_path)
+        if self._fsync is FsyncPolicy.FULL:
+            fsync_directory(target_path.parent)
+
+
+_MTF = TypeVar("_MTF", bound=MaterialTempFile)
+
+
+class FileSystemBlobStore(BlobStore):
+    root: Path
+    depth: int
+
+    def __init__(
+        self,
+        root: Path,
+        depth: int = 2,
+        fsync: FsyncPolicy = FsyncPolicy.NEVER,
+        buffer_size: int = BUFFER_SIZE,
+    ) -> None:
+        self.root = root.absolute()
+        self.depth = depth
+        self.incoming = self.root / INCOMING_DIR
+        self._fsync = fsync
+        self._buffer_size = buffer_size
+        self.incoming.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_options(cls, options: StorageOptions, buffer_size: int = BUFFER_SIZE) -> FileSystemBlobStore:
+        return cls(Path(options.root), options.depth, options.fsync, buffer_size)
+
+    def tempfile(self) -> AsyncContextManager[MaterialTempFile]:
+        return MaterialTempFile.open(self.incoming, self._buffer_size, self._fsync)
+
+    def locate(self, hash: str) -> Path:
+        return shard_path(self.root, hash, self.depth)
+
+    def local_path(self, hash: str) -> Path | None:
+        return self.locate(hash)
+
+    def adopt(self, source: Path, hash: str, copy: bool = False) -> Path:
+        # Hard links are atomic; copies go through incoming/ and are renamed
+        # so a half-written file never appears under its hash.
+        target = self.locate(hash)
+        if target.exists():
+            return target
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if not copy:
+            try:
+                os.link(source, target)
+                return target
+            except FileExistsError:
+                return target
+            except OSError:
+                pass
+        tmp_path = self.incoming / str(uuid.uuid4())
+        try:
+            shutil.copyfile(source, tmp_path)
+            if self._fsync is not FsyncPolicy.NEVER:
+                with tmp_path.open("rb") as file:
+                    os.fsync(file.fileno())
+            tmp_path.rename(target)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        if self._fsync is FsyncPolicy.FULL:
+            fsync_directory(target.parent)
+        return target
+
+    async def exists(self, hash: str) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.locate(hash).is_file)
+
+    async def read(self, hash: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.locate(hash).read_bytes)
+
+    async def delete(self, hash: str) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.locate(hash).unlink, True)
+
+
+class MemoryTempFile(TempFile):
+    _store: MemoryBlobStore
+
+    def __init__(self, store: MemoryBlobStore) -> None:
+        self._store = store
+        self._buffer = bytearray()
+        self._hasher = hashlib.new("sha256")
+        self._probe = MetadataProbe()
+
+    @property
+    def hash(self) -> bytes:
+        return self._hasher.digest()
+
+    @property
+    def size(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def metadata(self) -> Metadata:
+        return self._probe.result()
+
+    @classmethod
+    @asynccontextmanager
+    async def open(cls: type[_MemTF], store: MemoryBlobStore) -> AsyncIterator[_MemTF]:  # type: ignore[override]
+        tempfile = cls(store)
+        yield tempfile
+        await tempfile.close()
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        self._hasher.update(data)
+        self._probe.feed(data)
+
+    async def close(self) -> None:
+        pass
+
+    async def materialize(self, path: str | Path, exists_ok: bool = False) -> None:
+        hash = Path(path).name
+        if hash in self._store.blobs and not exists_ok:
+            raise RuntimeError
+        self._store.blobs[hash] = bytes(self._buffer)
+
+
+_MemTF = TypeVar("_MemTF", bound=MemoryTempFile)
+
+
+class MemoryBlobStore(BlobStore):
+    blobs: dict[str, bytes]
+
+    def __init__(self) -> None:
+        self.blobs = {}
+
+    def tempfile(self) -> AsyncContextManager[MemoryTempFile]:
+        return MemoryTempFile.open(self)
+
+    def locate(self, hash: str) -> Path:
+        return Path(hash)
+
+    async def exists(self, hash: str) -> bool:
+        return hash in self.blobs
+
+    async def read(self, hash: str) -> bytes:
+        try:
+            return self.blobs[hash]
+        except KeyError:
+            raise FileNotFoundError(hash) from None
+
+    async def delete(self, hash: str) -> None:
+        self.blobs.pop(hash, None)
+
+
+class HashedFile(NamedTuple):
+    path: Path
+    hash: str | None
+    size: int
+    metadata: Metadata
+    mime: MIME | None
+
+
+def hash_file(path: Path) -> HashedFile:
+    hasher = hashlib.new("sha256")
+    probe = MetadataProbe()
+    try:
+        with path.open("rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if hasattr(mapped, "madvise"):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    # Fed in slices so nothing downstream ever sees the whole
+                    # mapping; each slice is probed while its pages are hot.
+                    with memoryview(mapped) as view:
+                        for start in range(0, size, MAP_SLICE_SIZE):
+                            chunk = view[start:start + MAP_SLICE_SIZE]
+                            hasher.update(chunk)
+                            probe.feed(chunk)
+                            chunk.release()
+    except (OSError, ValueError):
+        return HashedFile(path, None, 0, Metadata(), None)
+    return HashedFile(path, hasher.hexdigest(), size, probe.result(), sniff(probe.head))
+
+
+def walk_files(root: Path, exclude: Path | None = None) -> Iterator[Path]:
+    for directory, dirnames, filenames in os.walk(root):
+        base = Path(directory)
+        if exclude is not None:
+            dirnames[:] = [name for name in dirnames if base / name != exclude]
+        for name in filenames:
+            path = base / name
+            if not path.is_symlink():
+                yield path
+
+
+def sweep_incoming(directory: Path, active_uploads: set[str], max_age: float) -> int:
+    # Only old files go: a fresh one may be written right now by another
+    # worker. Parts of uploads that still exist are kept however old they
+    # are, since resumable uploads can be continued at any time.
+    cutoff = time.time() - max_age
+    removed = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = INCOMING_PATTERN.fullmatch(entry.name)
+            if match is None or (match["part"] and match["id"] in active_uploads):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    continue
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return removed
+
+
+def flat_blobs(root: Path) -> Iterator[Path]:
+    for entry in root.iterdir():
+        if entry.is_file() and HASH_PATTERN.fullmatch(entry.name):
+            yield entry
+
+
+def reshard_blobs(store: FileSystemBlobStore, source: Path | None = None) -> Iterator[tuple[str, Path]]:
+    for blob in flat_blobs(source or store.root):
+        target = store.locate(blob.name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.exists():
+            blob.unlink()
+        else:
+            blob.rename(target)
+        yield blob.name, target
@@ -0,0 +1,374 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta as td
+from pathlib import Path
+from typing import AsyncIterator
+
+from aiohttp import StreamReader, web
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.config import UploadOptions
+from simplefiles.core.entities import BlobStore
+from .db import FileInfo, Upload, upload_chunks, uploads
+from .metadata import MetadataProbe, probe_blob
+from .metrics import INGESTED_BYTES, record_stored
+from .mime import MIME, MIMEConflict, parse_content_type, resolve_content_type, sniff
+from .repository import MediaRepository, utcnow
+from .storage import HASH_PATTERN, FileSystemBlobStore
+
+
+@dataclass
+class UploadProgress:
+    received: set[int]
+    hashed: int = 0
+    hasher: hashlib._Hash = field(default_factory=lambda: hashlib.new("sha256"))
+    probe: MetadataProbe = field(default_factory=MetadataProbe)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    writers: int = 0
+    finalizing: bool = False
+    finalized: bool = False
+
+
+class UploadManager:
+    directory: Path
+
+    def __init__(self, blobs: FileSystemBlobStore, options: UploadOptions) -> None:
+        self.directory = blobs.incoming
+        self._blobs = blobs
+        self._chunk_size = options.resumable_chunk_size
+        self._buffer_size = options.buffer_size
+        self._progress: dict[str, UploadProgress] = {}
+
+    def part_path(self, upload_id: str) -> Path:
+        return self.directory / f"{upload_id}.part"
+
+    async def create(self, session: AsyncSession, name: str, content_type: str, size: int) -> Upload:
+        upload = Upload(str(uuid.uuid4()), name, content_type, size, self._chunk_size, utcnow())
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._allocate, self.part_path(upload.upload_id), size)
+        session.add(upload)
+        await session.commit()
+        self._progress[upload.upload_id] = UploadProgress(set())
+        return upload
+
+    async def received(self, session: AsyncSession, upload: Upload) -> set[int]:
+        progress = await self._get_progress(session, upload, refresh=True)
+        return progress.received
+
+    async def write_chunk(self, upload: Upload, offset: int, content: StreamReader) -> None:
+        # Chunks are written without the lock, so several can arrive at once;
+        # none starts while the upload is finalized, and finalize does not
+        # start while one is written.
+        progress = self._progress.get(upload.upload_id)
+        if progress is None:
+            # not known here since a restart, or created by another worker
+            await self._write(upload, offset, content)
+            return
+        if progress.finalized:
+            raise web.HTTPNotFound()
+        if progress.finalizing:
+            raise web.HTTPConflict(text="Upload is being finalized")
+        progress.writers += 1
+        try:
+            await self._write(upload, offset, content)
+        finally:
+            progress.writers -= 1
+
+    async def record_chunk(self, session: AsyncSession, upload: Upload, offset: int) -> None:
+        # The commit comes last, so no connection is held while the
+        # contiguous prefix is hashed.
+        progress = await self._get_progress(session, upload)
+        async with progress.lock:
+            # finalized while this chunk was written again
+            if progress.finalized:
+                raise web.HTTPNotFound()
+            statement = insert(upload_chunks).values(upload_id=upload.upload_id, chunk_offset=offset)
+            await session.execute(statement.on_conflict_do_nothing())
+            await session.commit()
+            progress.received.add(offset)
+            await self._advance(upload, progress)
+
+    @asynccontextmanager
+    async def finalize(self, session: AsyncSession, upload: Upload) -> AsyncIterator[tuple[FileInfo, MetadataProbe]]:
+        # The body checks the content and stores its row; the part is only
+        # published and the upload forgotten once that succeeded, so a
+        # refused upload stays as it was and can still be aborted.
+        progress = await self._get_progress(session, upload, refresh=True)
+        missing = sorted(set(range(0, upload.size, upload.chunk_size)) - progress.received)
+        if missing:
+            raise web.HTTPConflict(text=f"Missing chunks at offsets {missing[:16]}")
+        async with progress.lock:
+            if progress.finalized:
+                raise web.HTTPNotFound()
+            if progress.writers:
+                raise web.HTTPConflict(text="Chunks are still being written")
+            progress.finalizing = True
+            try:
+                await self._advance(upload, progress)
+                file_hash = progress.hasher.hexdigest()
+                file_path = self._blobs.locate(file_hash)
+                yield FileInfo(file_path, file_hash, upload.size), progress.probe
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._publish, self.part_path(upload.upload_id), file_path)
+                progress.finalized = True
+            finally:
+                progress.finalizing = False
+        await self._forget(session, upload)
+
+    async def expire(self, session: AsyncSession, max_age: float) -> int:
+        # Uploads left unfinished for max_age are aborted. Progress is kept
+        # only for uploads that still exist, as other workers finalize,
+        # abort and expire them too.
+        query = delete(uploads).where(uploads.c.created_at < utcnow() - td(seconds=max_age))
+        expired = list(await session.scalars(query.returning(uploads.c.upload_id)))
+        await session.execute(delete(upload_chunks).where(upload_chunks.c.upload_id.in_(expired)))
+        await session.commit()
+        active = set(await session.scalars(select(uploads.c.upload_id)))
+        for upload_id in self._progress.keys() - active:
+            del self._progress[upload_id]
+        loop = asyncio.get_running_loop()
+        for upload_id in expired:
+            await loop.run_in_executor(None, self.part_path(upload_id).unlink, True)
+        return len(expired)
+
+    async def sniffed(self, session: AsyncSession, upload: Upload) -> MIME | None:
+        progress = await self._get_progress(session, upload)
+        return sniff(progress.probe.head)
+
+    async def abort(self, session: AsyncSession, upload: Upload) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.part_path(upload.upload_id).unlink, True)
+        await self._forget(session, upload)
+
+    async def _forget(self, session: AsyncSession, upload: Upload) -> None:
+        await session.execute(delete(upload_chunks).where(upload_chunks.c.upload_id == upload.upload_id))
+        await session.delete(upload)
+        await session.commit()
+        self._progress.pop(upload.upload_id, None)
+
+    async def _get_progress(self, session: AsyncSession, upload: Upload, refresh: bool = False) -> UploadProgress:
+        # Hasher state lives only in memory; after a restart the received set
+        # is reloaded from the DB and the contiguous prefix is re-hashed.
+        # With several workers, chunks may have been written by another
+        # process, so callers that answer for the whole upload refresh it.
+        progress = self._progress.get(upload.upload_id)
+        if progress is None or refresh:
+            query = select(upload_chunks.c.chunk_offset).where(upload_chunks.c.upload_id == upload.upload_id)
+            offsets = set(await session.scalars(query))
+            progress = self._progress.setdefault(upload.upload_id, UploadProgress(offsets))
+            progress.received |= offsets
+        return progress
+
+    async def _write(self, upload: Upload, offset: int, content: StreamReader) -> None:
+        length = upload.chunk_length(offset)
+        path = self.part_path(upload.upload_id)
+        loop = asyncio.get_running_loop()
+        try:
+            fd = await loop.run_in_executor(None, os.open, path, os.O_WRONLY)
+        except FileNotFoundError:
+            # finalized or aborted by another worker
+            raise web.HTTPNotFound()
+        try:
+            written = 0
+            buffer = bytearray()
+            async for data in content.iter_chunked(self._buffer_size):
+                buffer += data
+                if written + len(buffer) > length:
+                    raise web.HTTPBadRequest(text="Chunk is larger than expected")
+                if len(buffer) >= self._buffer_size:
+                    await loop.run_in_executor(None, os.pwrite, fd, buffer, offset + written)
+                    written += len(buffer)
+                    buffer = bytearray()
+            if buffer:
+                await loop.run_in_executor(None, os.pwrite, fd, buffer, offset + written)
+                written += len(buffer)
+        finally:
+            await loop.run_in_executor(None, os.close, fd)
+        if written != length:
+            raise web.HTTPBadRequest(text=f"Expected {length} bytes, got {written}")
+
+    async def _advance(self, upload: Upload, progress: UploadProgress) -> None:
+        loop = asyncio.get_running_loop()
+        path = self.part_path(upload.upload_id)
+        while progress.hashed < upload.size and progress.hashed in progress.received:
+            length = upload.chunk_length(progress.hashed)
+            await loop.run_in_executor(None, self._hash_range, path, progress, progress.hashed, length)
+            progress.hashed += length
+
+    def _hash_range(self, path: Path, progress: UploadProgress, offset: int, length: int) -> None:
+        with path.open("rb") as file:
+            file.seek(offset)
+            while length > 0:
+                data = file.read(min(self._buffer_size, length))
+                if not data:
+                    raise EOFError(path)
+                progress.hasher.update(data)
+                progress.probe.feed(data)
+                length -= len(data)
+
+    @staticmethod
+    def _allocate(path: Path, size: int) -> None:
+        with path.open("wb") as file:
+            file.truncate(size)
+
+    @staticmethod
+    def _publish(part_path: Path, target_path: Path) -> None:
+        if target_path.exists():
+            part_path.unlink()
+            return
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        part_path.rename(target_path)
+
+
+def resolve_upload_type(request: web.Request, declared: MIME, sniffed: MIME | None) -> MIME:
+    options: UploadOptions = request.app["config"].upload
+    try:
+        return resolve_content_type(declared, sniffed, options.sniff)
+    except MIMEConflict as e:
+        raise web.HTTPUnsupportedMediaType(text=str(e))
+
+
+async def get_upload(request: web.Request, session: AsyncSession) -> Upload:
+    upload = await session.get(Upload, request.match_info["upload_id"])
+    if upload is None:
+        raise web.HTTPNotFound()
+    return upload
+
+
+def describe(upload: Upload, received: set[int]) -> dict[str, object]:
+    return {
+        "upload_id": upload.upload_id,
+        "size": upload.size,
+        "chunk_size": upload.chunk_size,
+        "received": sorted(received),
+    }
+
+
+async def instant_upload(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    blobs: BlobStore = request.app["blobs"]
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest()
+    name = data.get("name")
+    size = data.get("size")
+    file_hash = data.get("hash")
+    content_type = data.get("type") or "application/octet-stream"
+    if not isinstance(name, str) or not isinstance(size, int) or not isinstance(file_hash, str):
+        raise web.HTTPBadRequest()
+    file_hash = file_hash.lower()
+    if not HASH_PATTERN.fullmatch(file_hash):
+        raise web.HTTPBadRequest(text="'hash' must be a hex-encoded SHA-256 digest")
+    try:
+        declared = parse_content_type(content_type)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{content_type!r} is not valid MIME type")
+    # Reclaimed like a stored duplicate, so the grace period starts over;
+    # content being collected is answered 404 and the client uploads it.
+    repository = MediaRepository(session)
+    file = await repository.reclaim_file_info(file_hash)
+    if file is None or file.size != size or not await blobs.exists(file_hash):
+        raise web.HTTPNotFound()
+    probe = await probe_blob(blobs, file_hash)
+    mime_type, mime_subtype = resolve_upload_type(request, declared, sniff(probe.head))
+    try:
+        media = await repository.add(name, mime_type, mime_subtype, file, probe.result())
+    except IntegrityError:
+        # collected since the reclaim, which only a zero grace period allows
+        await session.rollback()
+        raise web.HTTPNotFound()
+    record_stored(deduplicated=True)
+    request.app["previews"].schedule(media)
+    return web.json_response({"id": media.media_id, "hash": file.hash})
+
+
+async def create_upload(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    uploads: UploadManager = request.app["uploads"]
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise web.HTTPBadRequest()
+    name = data.get("name")
+    size = data.get("size")
+    content_type = data.get("type") or "application/octet-stream"
+    if not isinstance(name, str) or not isinstance(size, int) or size < 0:
+        raise web.HTTPBadRequest()
+    max_size = request.app["config"].upload.max_file_size
+    if size > max_size:
+        raise web.HTTPRequestEntityTooLarge(max_size, size)
+    try:
+        parse_content_type(content_type)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"{content_type!r} is not valid MIME type")
+    upload = await uploads.create(session, name, content_type, size)
+    return web.json_response(describe(upload, set()), status=201)
+
+
+async def upload_status(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    uploads: UploadManager = request.app["uploads"]
+    upload = await get_upload(request, session)
+    received = await uploads.received(session, upload)
+    return web.json_response(describe(upload, received))
+
+
+async def put_chunk(request: web.Request) -> web.StreamResponse:
+    uploads: UploadManager = request.app["uploads"]
+    sessions: async_sessionmaker[AsyncSession] = request.app["sessions"]
+    # Sessions are held for the lookups and the commit, never while the
+    # chunk is transferred.
+    async with sessions() as session:
+        upload = await get_upload(request, session)
+    try:
+        offset = int(request.query["offset"])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(text="'offset' query parameter is required")
+    if offset < 0 or offset >= upload.size or offset % upload.chunk_size:
+        raise web.HTTPBadRequest(text=f"Offset must be a multiple of {upload.chunk_size} below {upload.size}")
+    length = upload.chunk_length(offset)
+    async with request.app["admission"].admit(length):
+        await uploads.write_chunk(upload, offset, request.content)
+    INGESTED_BYTES.inc(length)
+    async with sessions() as session:
+        # looked up again: the upload may have been finalized meanwhile
+        upload = await get_upload(request, session)
+        await uploads.record_chunk(session, upload, offset)
+        if offset == 0:
+            # Refuse mislabelled content as soon as its signature is known
+            # rather than after the whole file has been sent.
+            declared = parse_content_type(upload.content_type)
+            sniffed = await uploads.sniffed(session, upload)
+            try:
+                resolve_upload_type(request, declared, sniffed)
+            except web.HTTPUnsupportedMediaType:
+                await uploads.abort(session, upload)
+                raise
+    return web.Response(status=204)
+
+
+async def finalize_upload(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    uploads: UploadManager = request.app["uploads"]
+    upload = await get_upload(request, session)
+    name, content_type = upload.name, upload.content_type
+    repository = MediaRepository(session)
+    async with uploads.finalize(session, upload) as (info, probe):
+        declared = parse_content_type(content_type)
+        mime_type, mime_subtype = resolve_upload_type(request, declared, sniff(probe.head))
+        file = await repository.add_file_info(info)
+        record_stored(deduplicated=file is not info)
+    media = await repository.add(name, mime_type, mime_subtype, file, probe.result())
+    request.app["previews"].schedule(media)
+    return web.json_response({"id": media.media_id, "hash": file.hash})
+
+
+async def abort_upload(request: web.Request, session: AsyncSession) -> web.StreamResponse:
+    uploads: UploadManager = request.app["uploads"]
+    upload = await get_upload(request, session)
+    await uploads.abort(session, upload)
+    return web.Response(status=204)
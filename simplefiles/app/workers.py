@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from dataclasses import dataclass, replace
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from types import FrameType
+
+from aiohttp import web
+from sqlalchemy.engine import make_url
+
+from simplefiles.config import ApplicationOptions, Config
+from . import create_app, create_schema
+from .logs import log_event, logger, start_logging
+from .metrics import REGISTRY
+
+
+BACKLOG = 128
+POLL_INTERVAL = 1.0   # seconds between liveness checks
+MIN_UPTIME = 5.0      # workers dying sooner than this are restarted after a delay
+RESTART_DELAY = 1.0
+EXIT_GRACE = 10.0     # on top of shutdown_timeout, for the app's cleanup hooks
+
+
+def check_database(config: Config) -> None:
+    url = make_url(config.db.url)
+    if url.get_backend_name() != "sqlite":
+        return
+    if url.database in (None, "", ":memory:"):
+        raise ValueError("An in-memory database cannot be shared between worker processes")
+    if config.db.journal_mode.upper() != "WAL":
+        # Rollback journals lock the whole file for every write, so workers
+        # mostly end up waiting out each other's busy_timeout.
+        log_event(logger, logging.WARNING, "workers without WAL", journal_mode=config.db.journal_mode)
+
+
+def bind_sockets(options: ApplicationOptions) -> list[socket.socket]:
+    # With SO_REUSEPORT every worker gets a socket of its own and the kernel
+    # spreads connections between them; otherwise they all accept from one.
+    # The supervisor keeps the sockets open, so connections queued for a
+    # worker that died wait for its replacement instead of being refused.
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    family, kind, proto, _, address = socket.getaddrinfo(
+        options.host, options.port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    sockets: list[socket.socket] = []
+    try:
+        for _ in range(options.workers if reuse_port else 1):
+            sock = socket.socket(family, kind, proto)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(address)
+            sock.listen(BACKLOG)
+            # with port 0 the rest join whichever port the first one got
+            address = sock.getsockname()
+    except OSError:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+def serve_worker(config: Config, sock: socket.socket, index: int) -> None:
+    # run_app turns SIGTERM (sent by the supervisor) and SIGINT (Ctrl-C
+    # reaches the whole process group) into a graceful shutdown.
+    # The index outlives restarts, so a worker's series continue (as
+    # counter resets) rather than starting under a new pid.
+    REGISTRY.constant_labels["worker"] = str(index)
+    web.run_app(
+        create_app(config, init_schema=False), sock=sock, access_log=None,
+        shutdown_timeout=config.app.shutdown_timeout, print=None,
+    )
+
+
+@dataclass
+class Worker:
+    process: BaseProcess
+    started: float
+
+
+class Supervisor:
+    def __init__(self, config: Config, sockets: list[socket.socket]) -> None:
+        self._config = config
+        self._sockets = sockets
+        # Spawned rather than forked: the supervisor runs the log listener
+        # thread, and workers must not inherit its locks or the schema
+        # engine's connections.
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: dict[int, Worker] = {}
+        self._restarts: dict[int, float] = {}  # index -> when to start it again
+        self._stopping = False
+
+    def run(self) -> None:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._stop)
+        for index in range(self._config.app.workers):
+            self._spawn(index)
+        while not self._stopping:
+            wait([worker.process.sentinel for worker in self._workers.values()], POLL_INTERVAL)
+            self._reap()
+            now = time.monotonic()
+            for index, due in list(self._restarts.items()):
+                if due <= now and not self._stopping:
+                    del self._restarts[index]
+                    self._spawn(index)
+        self._shutdown()
+
+    def _stop(self, signum: int, frame: FrameType | None) -> None:
+        self._stopping = True
+
+    def _spawn(self, index: int) -> None:
+        sock = self._sockets[index % len(self._sockets)]
+        config = self._config
+        if index:
+            # One scrubber is enough, and more would multiply its I/O budget;
+            # a restarted worker 0 resumes it.
+            config = replace(config, scrub=replace(config.scrub, enabled=False))
+        process = self._context.Process(
+            target=serve_worker, args=(config, sock, index), name=f"simplefiles-worker-{index}",
+        )
+        process.start()
+        self._workers[index] = Worker(process, time.monotonic())
+        log_event(logger, logging.INFO, "worker started", worker=index, pid=process.pid)
+
+    def _reap(self) -> None:
+        now = time.monotonic()
+        for index, worker in list(self._workers.items()):
+            if worker.process.is_alive():
+                continue
+            del self._workers[index]
+            if self._stopping:
+                continue
+            # A worker that keeps failing on startup (bad config, missing
+            # directory) must not turn the supervisor into a busy loop.
+            delay = RESTART_DELAY if now - worker.started < MIN_UPTIME else 0.0
+            self._restarts[index] = now + delay
+            log_event(
+                logger, logging.WARNING, "worker exited",
+                worker=index, pid=worker.process.pid, exitcode=worker.process.exitcode, restart_in=delay,
+            )
+
+    def _shutdown(self) -> None:
+        for worker in self._workers.values():
+            worker.process.terminate()
+        deadline = time.monotonic() + self._config.app.shutdown_timeout + EXIT_GRACE
+        for index, worker in self._workers.items():
+            worker.process.join(max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                log_event(logger, logging.WARNING, "worker killed", worker=index, pid=worker.process.pid)
+                worker.process.kill()
+                worker.process.join()
+
+
+def serve_workers(config: Config) -> None:
+    listener = start_logging(config.log)
+    try:
+        check_database(config)
+        # Once, here: workers skip create_all so they never race on DDL.
+        asyncio.run(create_schema(config))
+        sockets = bind_sockets(config.app)
+        try:
+            host, port = sockets[0].getsockname()[:2]
+            log_event(logger, logging.INFO, "listening", host=host, port=port, workers=config.app.workers)
+            Supervisor(config, sockets).run()
+        finally:
+            for sock in sockets:
+                sock.close()
+    finally:
+        listener.stop()
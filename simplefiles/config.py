@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from enum import StrEnum
 
 from typing import Any, Mapping
 
@@ -14,6 +15,14 @@ FACTORY = dataclass_factory.Factory()
 class Config:
     app: ApplicationOptions
     db: DBOptions
+    upload: UploadOptions = field(default_factory=lambda: UploadOptions())
+    storage: StorageOptions = field(default_factory=lambda: StorageOptions())
+    preview: PreviewOptions = field(default_factory=lambda: PreviewOptions())
+    log: LogOptions = field(default_factory=lambda: LogOptions())
+    gc: GCOptions = field(default_factory=lambda: GCOptions())
+    compression: CompressionOptions = field(default_factory=lambda: CompressionOptions())
+    cache: CacheOptions = field(default_factory=lambda: CacheOptions())
+    scrub: ScrubOptions = field(default_factory=lambda: ScrubOptions())
     serve_static: bool = False
 
 
@@ -21,11 +30,129 @@ class Config:
 class ApplicationOptions:
     host: str = "localhost"
     port: int = 8080
+    workers: int = 1                # server processes sharing the port
+    shutdown_timeout: float = 60    # seconds in-flight requests get on shutdown
 
 
 @dataclass
 class DBOptions:
-    pass
+    url: str = "sqlite+aiosqlite:///tmp/test.db"
+    echo: bool = False
+    pool_size: int = 8
+    max_overflow: int = 8
+    pool_timeout: float = 30
+    # SQLite per-connection PRAGMAs
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    busy_timeout: int = 5000          # milliseconds
+    cache_size: int = -64*1024        # negative value is KiB
+    mmap_size: int = 256*1024*1024
+    temp_store: str = "MEMORY"
+    foreign_keys: bool = False
+
+
+class SniffPolicy(StrEnum):
+    DECLARED = "declared"  # trust the client's Content-Type, never sniff
+    SNIFFED = "sniffed"    # content signature wins over the declared type
+    REJECT = "reject"      # refuse uploads whose signature contradicts the declared type
+
+
+@dataclass
+class UploadOptions:
+    chunk_size: int = 64*1024
+    buffer_size: int = 4*1024*1024
+    resumable_chunk_size: int = 8*1024*1024
+    sniff: SniffPolicy = SniffPolicy.SNIFFED
+    max_file_size: int = 16*1024**3     # per multipart file part and per resumable upload
+    max_request_size: int = 16*1024**3  # whole /api/store request body
+    # Admission control, per process: transfers beyond these limits wait in
+    # a queue, and are refused with 503 when it is full or they waited too long.
+    max_concurrent: int = 16
+    max_bytes_in_flight: int = 1024**3  # by declared size; a larger upload is admitted alone
+    # /api/store bodies sent without Content-Length (chunked) are admitted as
+    # this many bytes and refused with 413 once they grow past it; 0 refuses
+    # them with 411 instead. Larger files need a Content-Length or resumable uploads.
+    unknown_length_size: int = 64*1024**2
+    queue_size: int = 64
+    queue_timeout: float = 30           # seconds
+    retry_after: int = 5                # seconds, sent with 503s
+
+
+class FsyncPolicy(StrEnum):
+    NEVER = "never"  # leave flushing to the OS
+    FILE = "file"    # fsync blob data before it is published
+    FULL = "full"    # also fsync the shard directory after rename
+
+
+@dataclass
+class StorageOptions:
+    root: str = "tmp"
+    depth: int = 2
+    fsync: FsyncPolicy = FsyncPolicy.NEVER
+
+
+@dataclass
+class PreviewOptions:
+    workers: int = 2
+    # longest edge in pixels for each preset
+    presets: dict[str, int] = field(default_factory=lambda: {"small": 160, "medium": 480, "large": 1280})
+    default: str = "small"  # generated right after upload and linked via preview_id
+    quality: int = 80
+    ffmpeg: str = "ffmpeg"  # used to grab video frames; videos get no previews without it
+
+
+@dataclass
+class CompressionOptions:
+    workers: int = 1
+    # Content-Encodings in order of preference; zstd and br need the
+    # zstandard and brotli packages and are skipped without them
+    encodings: list[str] = field(default_factory=lambda: ["zstd", "br", "gzip"])
+    # variants are computed once, so levels lean towards ratio over speed
+    levels: dict[str, int] = field(default_factory=lambda: {"zstd": 12, "br": 9, "gzip": 9})
+    min_size: int = 1024      # smaller blobs are always sent as they are
+    max_ratio: float = 0.9    # variants larger than this share of the original are not kept
+
+
+@dataclass
+class CacheOptions:
+    max_bytes: int = 64*1024*1024     # memory for cached blobs per process; 0 disables the cache
+    max_blob_size: int = 64*1024      # larger blobs are always sent from disk
+
+
+@dataclass
+class GCOptions:
+    interval: float = 60        # seconds between collection rounds
+    batch_size: int = 100       # blobs removed per transaction
+    grace: float = 3600         # seconds a blob stays unreferenced before it is removed
+    temp_max_age: float = 3600  # incoming/ leftovers older than this are swept at startup
+    upload_max_age: float = 7*24*3600  # resumable uploads not finalized by then are aborted
+
+
+@dataclass
+class ScrubOptions:
+    enabled: bool = True           # in the server (its first worker); the scrub command runs regardless
+    workers: int = 1               # hashing processes
+    rate: int = 32*1024*1024       # bytes per second read from disk by all of them together; 0 is unlimited
+    batch_size: int = 64           # blobs recorded per transaction
+    period: float = 30*24*3600     # seconds after which a blob is verified again
+    idle: float = 600              # seconds between checks while no blob is due
+
+
+class LogFormat(StrEnum):
+    JSON = "json"  # one JSON object per line
+    TEXT = "text"  # "time level logger message key=value ..."
+
+
+@dataclass
+class LogOptions:
+    level: str = "INFO"
+    format: LogFormat = LogFormat.JSON
+    sample_rate: float = 1.0  # fraction of records below WARNING that are kept
+    queue_size: int = 10000   # records are dropped while the writer thread lags this far behind
+    # field names (case-insensitive) whose values never reach the output
+    redact: list[str] = field(default_factory=lambda: [
+        "authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key",
+    ])
 
 
 def create_from_mapping(mapping: Mapping[str, Any]) -> Config:
@@ -6,7 +6,7 @@ from dataclasses import dataclass
 from datetime import datetime as dt, timedelta as td
 from pathlib import Path
 
-from typing import AsyncIterator, ClassVar, Literal, NamedTuple
+from typing import AsyncContextManager, AsyncIterator, ClassVar, Literal, NamedTuple
 from typing import TypeVar
 
 from ._types import MIMEType, MIMESubtype
@@ -78,6 +78,15 @@ class Preview(Media):
     subtype: Literal[ImagesMIME.WEBP]
 
 
+@dataclass
+class Metadata:
+    resolution: Resolution | None = None
+    length: td | None = None
+    artist: str | None = None
+    album: str | None = None
+    track: str | None = None  # track title
+
+
 @dataclass
 class FileInfo:
     path: Path
@@ -97,6 +106,11 @@ class TempFile(ABC):
     def size(self) -> int:
         pass
 
+    @property
+    @abstractmethod
+    def metadata(self) -> Metadata:
+        pass
+
     @asynccontextmanager
     @classmethod
     @abstractmethod
@@ -119,3 +133,29 @@ class TempFile(ABC):
 
 
 _TF = TypeVar("_TF", bound=TempFile)
+
+
+class BlobStore(ABC):
+
+    @abstractmethod
+    def tempfile(self) -> AsyncContextManager[TempFile]:
+        pass
+
+    @abstractmethod
+    def locate(self, hash: str) -> Path:
+        pass
+
+    def local_path(self, hash: str) -> Path | None:
+        return None
+
+    @abstractmethod
+    async def exists(self, hash: str) -> bool:
+        pass
+
+    @abstractmethod
+    async def read(self, hash: str) -> bytes:
+        pass
+
+    @abstractmethod
+    async def delete(self, hash: str) -> None:
+        pass
@@ -0,0 +1,41 @@
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Any
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from simplefiles.app import create_app
+from simplefiles.config import Config, create_from_mapping
+
+
+class AppTestCase(unittest.IsolatedAsyncioTestCase):
+    # Runs the whole application on a temporary database and blob store.
+    # Background work is left to the tests: the collector waits an hour
+    # between rounds and the scrubber is off.
+    options: dict[str, dict[str, Any]] = {}
+
+    config: Config
+    app: web.Application
+    client: TestClient
+
+    async def asyncSetUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        sections: dict[str, dict[str, Any]] = {
+            "app": {},
+            "db": {"url": f"sqlite+aiosqlite:///{self.root / 'simplefiles.db'}"},
+            "storage": {"root": str(self.root / "blobs")},
+            "log": {"level": "WARNING"},
+            "gc": {"interval": 3600},
+            "scrub": {"enabled": False},
+        }
+        for name, values in self.options.items():
+            sections[name] = {**sections.get(name, {}), **values}
+        self.config = create_from_mapping(sections)
+        self.app = await create_app(self.config)
+        self.client = TestClient(TestServer(self.app))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
@@ -0,0 +1,65 @@
+import hashlib
+import sqlite3
+from typing import Any
+
+from aiohttp import FormData
+
+from simplefiles.app.collector import GarbageCollector
+from tests.support import AppTestCase
+
+
+class GarbageCollectorTest(AppTestCase):
+    options = {"gc": {"grace": 0}}
+
+    async def store(self, data: bytes, name: str) -> int:
+        form = FormData()
+        form.add_field("file", data, filename=name, content_type="application/octet-stream")
+        self.assertEqual((await self.client.post("/api/store", data=form)).status, 200)
+        items = (await (await self.client.get("/api/medias")).json())["items"]
+        return next(item["media_id"] for item in items if item["name"] == name)
+
+    async def delete(self, media_id: int) -> None:
+        self.assertEqual((await self.client.delete(f"/api/medias/{media_id}")).status, 204)
+
+    def query(self, sql: str) -> list[tuple[Any, ...]]:
+        with sqlite3.connect(self.root / "simplefiles.db") as connection:
+            rows = connection.execute(sql).fetchall()
+        connection.close()
+        return rows
+
+    def exists(self, data: bytes) -> bool:
+        return bool(self.app["blobs"].locate(hashlib.sha256(data).hexdigest()).exists())
+
+    async def test_collects_unreferenced(self) -> None:
+        collector: GarbageCollector = self.app["collector"]
+        first = await self.store(b"shared", "first")
+        await self.store(b"shared", "second")
+        unique = await self.store(b"unique", "unique")
+        await self.delete(first)
+        await self.delete(unique)
+        collected = await collector.collect()
+        self.assertEqual(collected, [hashlib.sha256(b"unique").hexdigest()])
+        self.assertFalse(self.exists(b"unique"))
+        self.assertTrue(self.exists(b"shared"))
+        self.assertEqual(await collector.collect(), [])
+        # content stored again after collection gets a new row and blob
+        await self.store(b"unique", "again")
+        self.assertTrue(self.exists(b"unique"))
+
+    async def test_grace_period(self) -> None:
+        self.config.gc.grace = 3600
+        await self.delete(await self.store(b"recent", "recent"))
+        self.assertEqual(await self.app["collector"].collect(), [])
+        self.assertTrue(self.exists(b"recent"))
+
+    async def test_claimed_row_is_taken_back(self) -> None:
+        # The collector claimed the row, then the same content is stored
+        # before it deletes: the row and the blob must both survive.
+        await self.delete(await self.store(b"revived", "old"))
+        with sqlite3.connect(self.root / "simplefiles.db") as connection:
+            connection.execute("UPDATE files_info SET collecting_since = CURRENT_TIMESTAMP WHERE refs = 0")
+        connection.close()
+        await self.store(b"revived", "new")
+        self.assertEqual(self.query("SELECT refs, collecting_since FROM files_info"), [(1, None)])
+        self.assertEqual(await self.app["collector"].collect(), [])
+        self.assertTrue(self.exists(b"revived"))
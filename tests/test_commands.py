@@ -0,0 +1,51 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.app.commands import import_tree
+from simplefiles.app.db import Media, file_infos
+from simplefiles.app.engine import create_engine
+from simplefiles.config import Config, create_from_mapping
+
+
+class ImportTest(unittest.IsolatedAsyncioTestCase):
+    config: Config
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        root = Path(directory.name)
+        self.source = root / "source"
+        (self.source / "nested").mkdir(parents=True)
+        self.config = create_from_mapping({
+            "app": {},
+            "db": {"url": f"sqlite+aiosqlite:///{root / 'simplefiles.db'}"},
+            "storage": {"root": str(root / "blobs")},
+        })
+
+    async def counts(self) -> tuple[list[str], int]:
+        engine = create_engine(self.config)
+        self.addAsyncCleanup(engine.dispose)
+        async with async_sessionmaker(engine, class_=AsyncSession)() as session:
+            names = list(await session.scalars(select(Media.name).order_by(Media.name)))
+            blobs = await session.scalar(select(func.count()).select_from(file_infos))
+        assert blobs is not None
+        return names, blobs
+
+    async def test_duplicates_and_reruns(self) -> None:
+        (self.source / "a.txt").write_bytes(b"same")
+        (self.source / "nested" / "b.txt").write_bytes(b"same")
+        (self.source / "c.txt").write_bytes(b"other")
+        stats = await import_tree(self.config, self.source, workers=1)
+        self.assertEqual((stats.scanned, stats.imported, stats.skipped), (3, 3, 0))
+        self.assertEqual(await self.counts(), (["a.txt", "b.txt", "c.txt"], 2))
+
+        # content already stored still gets a media; imported paths are not
+        # imported again
+        (self.source / "nested" / "d.txt").write_bytes(b"other")
+        stats = await import_tree(self.config, self.source, workers=1)
+        self.assertEqual((stats.scanned, stats.imported, stats.skipped), (4, 1, 3))
+        self.assertEqual(await self.counts(), (["a.txt", "b.txt", "c.txt", "d.txt"], 2))
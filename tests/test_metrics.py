@@ -0,0 +1,24 @@
+import unittest
+
+from simplefiles.app.metrics import Counter, Histogram, Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_constant_labels(self) -> None:
+        registry = Registry()
+        requests = registry.register(Counter("requests", "Requests", ("status",)))
+        latency = registry.register(Histogram("latency", "Latency", buckets=(1.0,)))
+        assert isinstance(requests, Counter) and isinstance(latency, Histogram)
+        requests.inc(labels=("200",))
+        latency.observe(0.5)
+        registry.constant_labels["worker"] = "1"
+        lines = registry.render().splitlines()
+        self.assertIn('requests_total{worker="1",status="200"} 1', lines)
+        self.assertIn('latency_bucket{worker="1",le="1"} 1', lines)
+        self.assertIn('latency_bucket{worker="1",le="+Inf"} 1', lines)
+        self.assertIn('latency_count{worker="1"} 1', lines)
+
+    def test_without_labels(self) -> None:
+        registry = Registry()
+        registry.register(Counter("stored", "Stored files"))
+        self.assertIn("stored_total 0", registry.render().splitlines())
@@ -0,0 +1,85 @@
+import unittest
+
+from aiohttp import FormData
+
+from simplefiles.app.compression import compressible
+from simplefiles.app.mime import MIMEConflict, parse_content_type, resolve_content_type, sniff
+from simplefiles.config import SniffPolicy
+from simplefiles.core.entities import AudiosMIME, ImagesMIME, MIMEType, VideosMIME
+from tests.support import AppTestCase
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(24)
+ZIP = b"PK\x03\x04" + bytes(26)
+OGG_VORBIS = b"OggS" + bytes(24) + b"\x01vorbis"
+MP4 = b"\x00\x00\x00\x18ftypisom"
+
+
+def resolve(content_type: str, data: bytes, policy: SniffPolicy = SniffPolicy.SNIFFED) -> str:
+    mime_type, subtype = resolve_content_type(parse_content_type(content_type), sniff(data), policy)
+    return f"{mime_type}/{subtype}"
+
+
+class SniffTest(unittest.TestCase):
+    def test_signatures(self) -> None:
+        self.assertEqual(sniff(PNG), (MIMEType.IMAGE, ImagesMIME.PNG))
+        self.assertEqual(sniff(OGG_VORBIS), (MIMEType.AUDIO, AudiosMIME.OGG))
+        self.assertEqual(sniff(MP4), (MIMEType.VIDEO, VideosMIME.MP4))
+        self.assertIsNone(sniff(b"plain text"))
+
+
+class ResolveTest(unittest.TestCase):
+    def test_generic_and_aliases(self) -> None:
+        self.assertEqual(resolve("application/octet-stream", PNG), "image/png")
+        self.assertEqual(resolve("application/x-zip-compressed", ZIP), "application/zip")
+        self.assertEqual(resolve("audio/vorbis", OGG_VORBIS, SniffPolicy.REJECT), "audio/ogg")
+
+    def test_contained_formats(self) -> None:
+        for content_type in (
+            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            "application/vnd.oasis.opendocument.text",
+            "application/epub+zip",
+            "application/java-archive",
+        ):
+            with self.subTest(content_type):
+                self.assertEqual(resolve(content_type, ZIP, SniffPolicy.REJECT), content_type)
+        self.assertEqual(resolve("video/ogg", OGG_VORBIS), "video/ogg")
+        self.assertEqual(resolve("audio/mp4", MP4), "audio/mp4")
+
+    def test_conflicts(self) -> None:
+        self.assertEqual(resolve("image/jpeg", PNG), "image/png")
+        self.assertEqual(resolve("image/jpeg", PNG, SniffPolicy.DECLARED), "image/jpeg")
+        self.assertEqual(resolve("text/plain", ZIP), "application/zip")
+        with self.assertRaises(MIMEConflict):
+            resolve("image/png", ZIP, SniffPolicy.REJECT)
+
+    def test_compressible(self) -> None:
+        self.assertFalse(compressible(parse_content_type("application/vnd.oasis.opendocument.text")))
+        self.assertFalse(compressible(parse_content_type("application/java-archive")))
+        self.assertTrue(compressible(parse_content_type("application/json")))
+
+
+class StoredTypeTest(AppTestCase):
+    async def store(self, data: bytes, content_type: str) -> str:
+        form = FormData()
+        form.add_field("file", data, filename="upload", content_type=content_type)
+        response = await self.client.post("/api/store", data=form)
+        self.assertEqual(response.status, 200)
+        items = (await (await self.client.get("/api/medias", params={"limit": "1"})).json())["items"]
+        response = await self.client.get("/api/download", params={"id": items[0]["media_id"]})
+        return response.content_type
+
+    async def test_stored_types(self) -> None:
+        docx = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        self.assertEqual(await self.store(PNG, "application/octet-stream"), "image/png")
+        self.assertEqual(await self.store(ZIP, docx), docx)
+        self.assertEqual(await self.store(OGG_VORBIS + b"video", "video/ogg"), "video/ogg")
+        self.assertEqual(await self.store(PNG + b"jpeg", "image/jpeg"), "image/png")
+
+    async def test_rejected(self) -> None:
+        self.config.upload.sniff = SniffPolicy.REJECT
+        form = FormData()
+        form.add_field("file", ZIP, filename="upload", content_type="image/png")
+        response = await self.client.post("/api/store", data=form)
+        self.assertEqual(response.status, 415)
+        self.assertEqual((await (await self.client.get("/api/medias")).json())["items"], [])
@@ -0,0 +1,67 @@
+import asyncio
+import io
+
+from aiohttp import FormData
+from PIL import Image as PILImage
+
+from simplefiles.app.db import FileInfo, Image, Preview, Video
+from simplefiles.app.repository import MediaRepository, utcnow
+from simplefiles.core.entities import ImagesMIME, Resolution
+from tests.support import AppTestCase
+
+
+def png(width: int, height: int) -> bytes:
+    output = io.BytesIO()
+    PILImage.new("RGB", (width, height), "teal").save(output, "PNG")
+    return output.getvalue()
+
+
+class PreviewTest(AppTestCase):
+    async def store(self, data: bytes, name: str, content_type: str) -> int:
+        form = FormData()
+        form.add_field("file", data, filename=name, content_type=content_type)
+        self.assertEqual((await self.client.post("/api/store", data=form)).status, 200)
+        items = (await (await self.client.get("/api/medias")).json())["items"]
+        return next(item["media_id"] for item in items if item["name"] == name)
+
+    async def test_image_preview(self) -> None:
+        media_id = await self.store(png(400, 200), "wide.png", "image/png")
+        # the default preset is rendered and linked in the background
+        await asyncio.gather(*self.app["previews"]._tasks)
+        async with self.app["sessions"]() as session:
+            image = await MediaRepository(session).get(media_id)
+            assert isinstance(image, Image)
+            preview = await image.preview
+        assert preview is not None
+        self.assertEqual((preview.preset, preview.resolution), ("small", Resolution(160, 80)))
+
+        response = await self.client.get("/api/preview", params={"id": media_id, "size": "medium"})
+        self.assertEqual((response.status, response.content_type), (200, "image/webp"))
+        with PILImage.open(io.BytesIO(await response.read())) as rendered:
+            self.assertEqual(rendered.size, (400, 200))
+
+    async def test_video_preview(self) -> None:
+        media_id = await self.store(b"\x00\x00\x00\x18ftypisom" + bytes(64), "clip.mp4", "video/mp4")
+        async with self.app["sessions"]() as session:
+            repository = MediaRepository(session)
+            video = await repository.get(media_id)
+            assert isinstance(video, Video)
+            self.assertIsNone(await video.preview)
+            file = await repository.add_file_info(FileInfo(self.root / "frame", "f" * 64, 10))
+            # rendered first, but only the default preset is the preview
+            await repository.add_preview(
+                Preview("medium.webp", file, ImagesMIME.WEBP, utcnow(), video.info.hash, "medium", Resolution(64, 36))
+            )
+            self.assertIsNone(await video.preview)
+            small = await repository.add_preview(
+                Preview("small.webp", file, ImagesMIME.WEBP, utcnow(), video.info.hash, "small", Resolution(16, 9))
+            )
+            await repository.link_preview(video.media_id, video.type, small.preview_id)
+            preview = await video.preview
+        assert preview is not None
+        self.assertEqual(preview.preset, "small")
+
+    async def test_not_previewable(self) -> None:
+        media_id = await self.store(b"plain text", "notes.txt", "text/plain")
+        response = await self.client.get("/api/preview", params={"id": media_id})
+        self.assertEqual(response.status, 404)
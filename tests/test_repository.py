@@ -0,0 +1,97 @@
+import hashlib
+import sqlite3
+from typing import Any
+
+from aiohttp import FormData
+from sqlalchemy import event
+
+from tests.support import AppTestCase
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(64)
+
+
+class MediaRepositoryTest(AppTestCase):
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.statements: list[str] = []
+        engine = self.app["engine"].sync_engine
+        event.listen(engine, "before_cursor_execute", self.count)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", self.count)
+
+    def count(self, connection: Any, cursor: Any, statement: str, *args: Any) -> None:
+        # connections run their PRAGMAs when they are opened, not per request
+        if not statement.startswith("PRAGMA"):
+            self.statements.append(statement)
+
+    async def store(self, data: bytes, name: str, content_type: str = "application/octet-stream") -> None:
+        form = FormData()
+        form.add_field("file", data, filename=name, content_type=content_type)
+        response = await self.client.post("/api/store", data=form)
+        self.assertEqual(response.status, 200)
+
+    async def media_ids(self) -> dict[str, int]:
+        items = (await (await self.client.get("/api/medias")).json())["items"]
+        return {item["name"]: item["media_id"] for item in items}
+
+    async def fill(self) -> dict[str, int]:
+        await self.store(PNG, "image.png", "image/png")
+        await self.store(b"ID3" + bytes(64), "song.mp3", "audio/mpeg")
+        await self.store(b"plain text", "notes.txt", "text/plain")
+        return await self.media_ids()
+
+    def query(self, sql: str) -> list[tuple[Any, ...]]:
+        with sqlite3.connect(self.root / "simplefiles.db") as connection:
+            rows = connection.execute(sql).fetchall()
+        connection.close()
+        return rows
+
+    async def test_show_is_one_statement(self) -> None:
+        ids = await self.fill()
+        for name, media_id in ids.items():
+            with self.subTest(name):
+                self.statements.clear()
+                response = await self.client.get("/api/show", json={"id": media_id})
+                self.assertEqual(response.status, 200)
+                self.assertEqual((await response.json())["name"], name)
+                self.assertEqual(len(self.statements), 1, self.statements)
+
+    async def test_batch_show_is_one_statement(self) -> None:
+        ids = await self.fill()
+        self.statements.clear()
+        response = await self.client.post("/api/show/batch", json={"ids": [*ids.values(), 999]})
+        items = (await response.json())["items"]
+        self.assertEqual([item.get("name") for item in items], [*ids, None])
+        self.assertEqual(items[-1]["error"], "not found")
+        self.assertEqual(len(self.statements), 1, self.statements)
+
+    async def test_list_is_one_statement(self) -> None:
+        await self.fill()
+        self.statements.clear()
+        response = await self.client.get("/api/medias", params={"limit": "2"})
+        page = await response.json()
+        self.assertEqual([item["name"] for item in page["items"]], ["notes.txt", "song.mp3"])
+        self.assertEqual(len(self.statements), 1, self.statements)
+        response = await self.client.get("/api/medias", params={"limit": "2", "cursor": page["next"]})
+        page = await response.json()
+        self.assertEqual(([item["name"] for item in page["items"]], page["next"]), (["image.png"], None))
+
+    async def test_download_is_one_statement(self) -> None:
+        ids = await self.fill()
+        self.statements.clear()
+        response = await self.client.get("/api/download", params={"id": ids["image.png"]})
+        self.assertEqual(await response.read(), PNG)
+        self.assertEqual(response.content_type, "image/png")
+        self.assertEqual(len(self.statements), 1, self.statements)
+
+    async def test_deduplication(self) -> None:
+        await self.store(PNG, "first.png", "image/png")
+        await self.store(PNG, "second.png", "image/png")
+        file_hash = hashlib.sha256(PNG).hexdigest()
+        self.assertEqual(self.query("SELECT hash, refs FROM files_info"), [(file_hash, 2)])
+        blobs = [path for path in (self.root / "blobs").rglob("*") if path.name == file_hash]
+        self.assertEqual(len(blobs), 1)
+        ids = await self.media_ids()
+        response = await self.client.delete(f"/api/medias/{ids['first.png']}")
+        self.assertEqual(response.status, 204)
+        self.assertEqual(self.query("SELECT refs, unreferenced_at IS NULL FROM files_info"), [(1, 1)])
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import unittest
+
+from aiohttp import FormData
+
+from simplefiles.app.responses import RangeNotSatisfiable, parse_ranges
+from tests.support import AppTestCase
+
+
+class ParseRangesTest(unittest.TestCase):
+    def test_ranges(self) -> None:
+        self.assertEqual(parse_ranges("bytes=0-9", 100), [(0, 10)])
+        self.assertEqual(parse_ranges("bytes=90-", 100), [(90, 100)])
+        self.assertEqual(parse_ranges("bytes=-10", 100), [(90, 100)])
+        self.assertEqual(parse_ranges("bytes=50-200", 100), [(50, 100)])
+        # overlapping and adjacent ranges are merged
+        self.assertEqual(parse_ranges("bytes=20-29, 0-9, 5-14, 30-39", 100), [(0, 15), (20, 40)])
+
+    def test_invalid(self) -> None:
+        self.assertIsNone(parse_ranges("items=0-9", 100))
+        self.assertIsNone(parse_ranges("bytes=9-0", 100))
+        self.assertIsNone(parse_ranges("bytes=a-b", 100))
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_ranges("bytes=100-", 100)
+
+
+class RangeServingTest(AppTestCase):
+    # one blob small enough for the memory cache and one served from disk
+    SIZES = (1000, 200_000)
+
+    async def asyncSetUp(self) -> None:
+        await super().asyncSetUp()
+        self.blobs: dict[int, tuple[str, bytes]] = {}
+        for size in self.SIZES:
+            data = os.urandom(size)
+            form = FormData()
+            form.add_field("file", data, filename=f"{size}.bin", content_type="application/octet-stream")
+            self.assertEqual((await self.client.post("/api/store", data=form)).status, 200)
+            self.blobs[size] = (hashlib.sha256(data).hexdigest(), data)
+
+    async def test_single_range(self) -> None:
+        for size, (file_hash, data) in self.blobs.items():
+            for attempt in range(2):  # the second answer may come from the cache
+                with self.subTest(size=size, attempt=attempt):
+                    response = await self.client.get(f"/blob/{file_hash}", headers={"Range": "bytes=100-199"})
+                    self.assertEqual(response.status, 206)
+                    self.assertEqual(response.headers["Content-Range"], f"bytes 100-199/{size}")
+                    self.assertEqual(await response.read(), data[100:200])
+
+    async def test_multiple_ranges(self) -> None:
+        for size, (file_hash, data) in self.blobs.items():
+            with self.subTest(size=size):
+                response = await self.client.get(f"/blob/{file_hash}", headers={"Range": "bytes=0-9,-10"})
+                self.assertEqual(response.status, 206)
+                self.assertEqual(response.content_type, "multipart/byteranges")
+                body = await response.read()
+                self.assertIn(f"Content-Range: bytes 0-9/{size}".encode(), body)
+                self.assertIn(f"Content-Range: bytes {size - 10}-{size - 1}/{size}".encode(), body)
+                self.assertIn(b"\r\n\r\n" + data[:10] + b"\r\n", body)
+                self.assertIn(b"\r\n\r\n" + data[-10:] + b"\r\n", body)
+
+    async def test_unsatisfiable(self) -> None:
+        file_hash, _ = self.blobs[1000]
+        response = await self.client.get(f"/blob/{file_hash}", headers={"Range": "bytes=5000-"})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */1000")
+
+    async def test_conditional(self) -> None:
+        file_hash, data = self.blobs[1000]
+        response = await self.client.get(f"/blob/{file_hash}")
+        etag = response.headers["ETag"]
+        response = await self.client.get(f"/blob/{file_hash}", headers={"If-None-Match": etag})
+        self.assertEqual(response.status, 304)
+        # a stale If-Range gets the whole blob instead of the range
+        headers = {"Range": "bytes=0-9", "If-Range": '"stale"'}
+        response = await self.client.get(f"/blob/{file_hash}", headers=headers)
+        self.assertEqual((response.status, await response.read()), (200, data))
+        headers = {"Range": "bytes=0-9", "If-Range": etag}
+        response = await self.client.get(f"/blob/{file_hash}", headers=headers)
+        self.assertEqual((response.status, await response.read()), (206, data[:10]))
+
+    async def test_missing_blob(self) -> None:
+        response = await self.client.get(f"/blob/{'0' * 64}")
+        self.assertEqual(response.status, 404)
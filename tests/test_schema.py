@@ -0,0 +1,148 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.app import create_schema
+from simplefiles.app.commands import scrub
+from simplefiles.app.db import Audio, Image
+from simplefiles.app.engine import create_engine
+from simplefiles.app.repository import MediaRepository
+from simplefiles.config import Config, create_from_mapping
+from simplefiles.core.entities import ImagesMIME
+
+
+# Tables as the first release created them, before any upgrade step.
+BASELINE_SCHEMA = """
+CREATE TABLE files_info (
+    hash VARCHAR NOT NULL,
+    path VARCHAR,
+    size INTEGER,
+    CONSTRAINT primary_files_info PRIMARY KEY (hash)
+);
+CREATE TABLE medias (
+    media_id INTEGER NOT NULL,
+    media_type VARCHAR(11),
+    name VARCHAR,
+    file_hash VARCHAR,
+    loaded_at DATETIME,
+    CONSTRAINT primary_medias PRIMARY KEY (media_id),
+    CONSTRAINT foreign_medias_file_hash_files_info_hash FOREIGN KEY(file_hash) REFERENCES files_info (hash)
+);
+CREATE TABLE audios (
+    audio_id INTEGER NOT NULL,
+    media_type VARCHAR(11),
+    subtype VARCHAR(12),
+    length VARCHAR,
+    CONSTRAINT primary_audios PRIMARY KEY (audio_id),
+    CONSTRAINT foreign_audios_audio_id_media_type_medias_media_id_media_type
+        FOREIGN KEY(audio_id, media_type) REFERENCES medias (media_id, media_type),
+    CONSTRAINT check_audios_ CHECK (subtype IN ('MPEG', 'OGG'))
+);
+CREATE TABLE images (
+    image_id INTEGER NOT NULL,
+    media_type VARCHAR(11),
+    subtype VARCHAR(8),
+    resolution VARCHAR,
+    preview_id INTEGER,
+    CONSTRAINT primary_images PRIMARY KEY (image_id),
+    CONSTRAINT foreign_images_image_id_media_type_medias_media_id_media_type
+        FOREIGN KEY(image_id, media_type) REFERENCES medias (media_id, media_type),
+    CONSTRAINT check_images_ CHECK (subtype IN ('JPEG', 'PNG'))
+);
+CREATE TABLE videos (
+    video_id INTEGER NOT NULL,
+    media_type VARCHAR(11),
+    subtype VARCHAR(9),
+    resolution VARCHAR,
+    length VARCHAR,
+    CONSTRAINT primary_videos PRIMARY KEY (video_id),
+    CONSTRAINT foreign_videos_video_id_media_type_medias_media_id_media_type
+        FOREIGN KEY(video_id, media_type) REFERENCES medias (media_id, media_type),
+    CONSTRAINT check_videos_ CHECK (subtype IN ('MP4', 'MPEG', 'OGG'))
+);
+CREATE TABLE files (
+    file_id INTEGER NOT NULL,
+    media_type VARCHAR(11),
+    subtype VARCHAR,
+    CONSTRAINT primary_files PRIMARY KEY (file_id),
+    CONSTRAINT foreign_files_file_id_media_type_medias_media_id_media_type
+        FOREIGN KEY(file_id, media_type) REFERENCES medias (media_id, media_type)
+);
+INSERT INTO files_info VALUES ('aaaa', '/blobs/aaaa', 3), ('bbbb', '/blobs/bbbb', 5), ('cccc', '/blobs/cccc', 7);
+INSERT INTO medias VALUES
+    (1, 'IMAGE', 'Holiday photo.png', 'aaaa', '2020-01-01 00:00:00'),
+    (2, 'AUDIO', 'song.mp3', 'bbbb', '2020-01-02 00:00:00');
+INSERT INTO images VALUES (1, 'IMAGE', 'PNG', '10x10', NULL);
+INSERT INTO audios VALUES (2, 'AUDIO', 'MPEG', '0:0:3:0.000000');
+"""
+
+
+class SchemaUpgradeTest(unittest.IsolatedAsyncioTestCase):
+    config: Config
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / "simplefiles.db"
+        with sqlite3.connect(self.path) as connection:
+            connection.executescript(BASELINE_SCHEMA)
+        connection.close()
+        self.config = create_from_mapping({
+            "app": {},
+            "db": {"url": f"sqlite+aiosqlite:///{self.path}"},
+            "storage": {"root": directory.name},
+        })
+
+    async def upgrade(self) -> None:
+        # twice: the second run must find nothing left to do
+        await create_schema(self.config)
+        await create_schema(self.config)
+
+    def query(self, sql: str) -> list[tuple]:
+        with sqlite3.connect(self.path) as connection:
+            rows = connection.execute(sql).fetchall()
+        connection.close()
+        return rows
+
+    def columns(self, table: str) -> set[str]:
+        return {row[1] for row in self.query(f"PRAGMA table_info({table})")}
+
+    def sessions(self) -> async_sessionmaker[AsyncSession]:
+        engine = create_engine(self.config)
+        self.addAsyncCleanup(engine.dispose)
+        return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def test_audio_tags(self) -> None:
+        await self.upgrade()
+        self.assertLessEqual({"artist", "album", "track"}, self.columns("audios"))
+        async with self.sessions()() as session:
+            audio = await MediaRepository(session).get(2)
+            found = await MediaRepository(session).search("song")
+        assert isinstance(audio, Audio)
+        self.assertEqual((audio.artist, audio.album, audio.track), (None, None, None))
+        self.assertEqual([media.media_id for media, _ in found], [2])
+
+    async def test_subtype_checks(self) -> None:
+        await self.upgrade()
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("INSERT INTO medias VALUES (3, 'IMAGE', 'anim.gif', 'cccc', '2020-01-03 00:00:00')")
+            connection.execute("INSERT INTO images (image_id, media_type, subtype) VALUES (3, 'IMAGE', 'GIF')")
+        connection.close()
+        async with self.sessions()() as session:
+            images = await MediaRepository(session).get_many([1, 3])
+        self.assertEqual({id: image.subtype for id, image in images.items()}, {1: ImagesMIME.PNG, 3: ImagesMIME.GIF})
+        self.assertTrue(all(isinstance(image, Image) for image in images.values()))
+        with self.assertRaises(sqlite3.IntegrityError), sqlite3.connect(self.path) as connection:
+            connection.execute("INSERT INTO images (image_id, media_type, subtype) VALUES (4, 'IMAGE', 'BMP')")
+        connection.close()
+
+    async def test_integrity_columns(self) -> None:
+        await self.upgrade()
+        self.assertLessEqual({"verified_at", "integrity"}, self.columns("files_info"))
+        stats = await scrub(self.config, everything=True)
+        self.assertEqual((stats.checked, stats.failed), (3, 3))
+        rows = self.query("SELECT integrity, verified_at IS NOT NULL FROM files_info")
+        self.assertEqual(rows, [("MISSING", 1)] * 3)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import io
+import struct
+import tempfile
+import unittest
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image as PILImage
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from simplefiles.app import create_schema
+from simplefiles.app.collector import GarbageCollector
+from simplefiles.app.db import FileInfo
+from simplefiles.app.engine import create_engine
+from simplefiles.app.metadata import MetadataProbe
+from simplefiles.app.previews import PreviewManager
+from simplefiles.app.repository import MediaRepository
+from simplefiles.app.storage import MAP_SLICE_SIZE, FileSystemBlobStore, MemoryBlobStore, hash_file
+from simplefiles.config import GCOptions, PreviewOptions, create_from_mapping
+from simplefiles.core.entities import BlobStore, ImagesMIME, Metadata, MIMEType, Resolution
+
+
+class BlobStoreContract:
+    # Behaviour every BlobStore must share; mixed into a test case per store.
+    store: BlobStore
+
+    async def put(self, data: bytes) -> str:
+        async with self.store.tempfile() as tmp:
+            await tmp.write(data[:3])
+            await tmp.write(data[3:])
+            await tmp.close()
+            hash = tmp.hash.hex()
+            assert isinstance(self, unittest.TestCase)
+            self.assertEqual((hash, tmp.size), (hashlib.sha256(data).hexdigest(), len(data)))
+            await tmp.materialize(self.store.locate(hash), exists_ok=True)
+        return hash
+
+    async def test_round_trip(self) -> None:
+        assert isinstance(self, unittest.TestCase)
+        hash = await self.put(b"some content")
+        self.assertTrue(await self.store.exists(hash))
+        self.assertEqual(await self.store.read(hash), b"some content")
+        await self.store.delete(hash)
+        self.assertFalse(await self.store.exists(hash))
+        with self.assertRaises(FileNotFoundError):
+            await self.store.read(hash)
+        await self.store.delete(hash)  # deleting twice is fine
+
+    async def test_existing_blob(self) -> None:
+        assert isinstance(self, unittest.TestCase)
+        hash = await self.put(b"twice")
+        self.assertEqual(await self.put(b"twice"), hash)
+        async with self.store.tempfile() as tmp:
+            await tmp.write(b"twice")
+            await tmp.close()
+            with self.assertRaises(RuntimeError):
+                await tmp.materialize(self.store.locate(hash))
+        self.assertEqual(await self.store.read(hash), b"twice")
+
+
+class FileSystemBlobStoreTest(BlobStoreContract, unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = FileSystemBlobStore(Path(directory.name))
+
+
+class MemoryBlobStoreTest(BlobStoreContract, unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.store = MemoryBlobStore()
+
+
+def box(kind: bytes, body: bytes = b"", size: int | None = None) -> bytes:
+    return struct.pack(">I4s", 8 + len(body) if size is None else size, kind) + body
+
+
+class HashFileTest(unittest.TestCase):
+    def test_large_mp4(self) -> None:
+        # moov sits after several slices of mdat and straddles a slice boundary
+        mvhd = box(b"mvhd", bytes(12) + struct.pack(">II", 1000, 90_000) + bytes(80))
+        tkhd = box(b"tkhd", bytes(76) + struct.pack(">II", 1280 << 16, 720 << 16))
+        moov = box(b"moov", mvhd + box(b"trak", tkhd))
+        ftyp = box(b"ftyp", b"isom" + bytes(4))
+        mdat_size = 6*MAP_SLICE_SIZE - len(ftyp) - 50
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "movie.mp4"
+            with path.open("wb") as file:
+                file.write(ftyp + box(b"mdat", size=mdat_size))
+                file.truncate(len(ftyp) + mdat_size)
+                file.seek(0, 2)
+                file.write(moov)
+            fed: list[int] = []
+            feed = MetadataProbe.feed
+
+            def record(probe: MetadataProbe, data: memoryview) -> None:
+                fed.append(len(data))
+                feed(probe, data)
+
+            with mock.patch.object(MetadataProbe, "feed", record):
+                hashed = hash_file(path)
+            expected = hashlib.sha256(path.read_bytes()).hexdigest()
+        self.assertEqual(hashed.metadata, Metadata(Resolution(1280, 720), timedelta(seconds=90)))
+        self.assertEqual((hashed.hash, hashed.size), (expected, len(ftyp) + mdat_size + len(moov)))
+        self.assertEqual(max(fed), MAP_SLICE_SIZE)
+        self.assertEqual(sum(fed), hashed.size)
+
+
+class MemoryStoreServicesTest(unittest.IsolatedAsyncioTestCase):
+    # The collector and preview manager only need the BlobStore interface;
+    # the memory store also covers their path for blobs with no local file.
+    async def asyncSetUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = create_from_mapping({
+            "app": {}, "db": {"url": f"sqlite+aiosqlite:///{Path(directory.name) / 'simplefiles.db'}"},
+        })
+        await create_schema(config)
+        engine = create_engine(config)
+        self.addAsyncCleanup(engine.dispose)
+        self.sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        self.blobs = MemoryBlobStore()
+
+    async def add(self, data: bytes, name: str, mime_type: MIMEType, subtype: str) -> int:
+        async with self.blobs.tempfile() as tmp:
+            await tmp.write(data)
+            hash = tmp.hash.hex()
+            async with self.sessions() as session:
+                repository = MediaRepository(session)
+                file = await repository.add_file_info(FileInfo(self.blobs.locate(hash), hash, len(data)))
+                await tmp.materialize(self.blobs.locate(hash), exists_ok=True)
+                media = await repository.add(name, mime_type, subtype, file)
+        return media.media_id
+
+    async def test_collector(self) -> None:
+        collector = GarbageCollector(self.blobs, self.sessions, GCOptions(grace=0))
+        kept = await self.add(b"kept", "kept", MIMEType.TEXT, "plain")
+        removed = await self.add(b"removed", "removed", MIMEType.TEXT, "plain")
+        async with self.sessions() as session:
+            self.assertTrue(await MediaRepository(session).delete(removed))
+        self.assertEqual(await collector.collect(), [hashlib.sha256(b"removed").hexdigest()])
+        self.assertEqual(list(self.blobs.blobs), [hashlib.sha256(b"kept").hexdigest()])
+        async with self.sessions() as session:
+            self.assertIsNotNone(await MediaRepository(session).get(kept))
+
+    async def test_previews(self) -> None:
+        output = io.BytesIO()
+        PILImage.new("RGB", (300, 300), "navy").save(output, "PNG")
+        media_id = await self.add(output.getvalue(), "square.png", MIMEType.IMAGE, ImagesMIME.PNG)
+        previews = PreviewManager(self.blobs, self.sessions, PreviewOptions(workers=1))
+        self.addAsyncCleanup(previews.close)
+        async with self.sessions() as session:
+            media = await MediaRepository(session).get(media_id)
+        assert media is not None
+        preview = await previews.ensure(media.info.hash, MIMEType.IMAGE, "small")
+        assert preview is not None
+        self.assertEqual(preview.resolution, Resolution(160, 160))
+        self.assertIn(preview.info.hash, self.blobs.blobs)
+        # a second request finds the stored preview instead of rendering
+        again = await asyncio.wait_for(previews.ensure(media.info.hash, MIMEType.IMAGE, "small"), 1)
+        assert again is not None
+        self.assertEqual(again.preview_id, preview.preview_id)
@@ -0,0 +1,147 @@
+import hashlib
+import os
+from typing import AsyncIterator
+
+from aiohttp import FormData
+from sqlalchemy import select, update
+
+from simplefiles.app.collector import GarbageCollector
+from simplefiles.app.db import Media, file_infos
+from simplefiles.app.repository import MediaRepository, utcnow
+from simplefiles.config import SniffPolicy
+from tests.support import AppTestCase
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + os.urandom(1000)
+
+
+class ResumableUploadTest(AppTestCase):
+    options = {"upload": {"resumable_chunk_size": 256}}
+
+    async def start(self, data: bytes, content_type: str) -> str:
+        response = await self.client.post("/api/uploads", json={"name": "up", "size": len(data), "type": content_type})
+        self.assertEqual(response.status, 201)
+        upload_id: str = (await response.json())["upload_id"]
+        return upload_id
+
+    async def send(self, upload_id: str, data: bytes, offsets: range) -> None:
+        for offset in offsets:
+            response = await self.client.put(
+                f"/api/uploads/{upload_id}", params={"offset": offset}, data=data[offset:offset + 256],
+            )
+            self.assertEqual(response.status, 204)
+
+    async def test_resume(self) -> None:
+        data = os.urandom(2000)
+        upload_id = await self.start(data, "application/octet-stream")
+        await self.send(upload_id, data, range(1024, 2000, 256))
+        await self.send(upload_id, data, range(0, 512, 256))
+        response = await self.client.post(f"/api/uploads/{upload_id}/finalize")
+        self.assertEqual(response.status, 409)
+        # a restart loses the in-memory hashing state; it is rebuilt from
+        # the recorded chunks and the part file
+        self.app["uploads"]._progress.clear()
+        response = await self.client.get(f"/api/uploads/{upload_id}")
+        self.assertEqual((await response.json())["received"], [0, 256, 1024, 1280, 1536, 1792])
+        await self.send(upload_id, data, range(512, 1024, 256))
+        response = await self.client.post(f"/api/uploads/{upload_id}/finalize")
+        self.assertEqual(response.status, 200)
+        result = await response.json()
+        self.assertEqual(result["hash"], hashlib.sha256(data).hexdigest())
+        response = await self.client.get("/api/download", params={"id": result["id"]})
+        self.assertEqual(await response.read(), data)
+        self.assertEqual((await self.client.get(f"/api/uploads/{upload_id}")).status, 404)
+        self.assertEqual((await self.client.post(f"/api/uploads/{upload_id}/finalize")).status, 404)
+
+    async def test_chunk_after_finalize(self) -> None:
+        data = os.urandom(600)
+        upload_id = await self.start(data, "application/octet-stream")
+        await self.send(upload_id, data, range(0, 600, 256))
+        self.app["uploads"]._progress[upload_id].finalizing = True
+        response = await self.client.put(f"/api/uploads/{upload_id}", params={"offset": 0}, data=data[:256])
+        self.assertEqual(response.status, 409)
+        self.app["uploads"]._progress[upload_id].finalizing = False
+        self.assertEqual((await self.client.post(f"/api/uploads/{upload_id}/finalize")).status, 200)
+        response = await self.client.put(f"/api/uploads/{upload_id}", params={"offset": 0}, data=data[:256])
+        self.assertEqual(response.status, 404)
+
+    async def test_refused_type_keeps_upload(self) -> None:
+        self.config.upload.sniff = SniffPolicy.DECLARED
+        upload_id = await self.start(PNG, "image/jpeg")
+        await self.send(upload_id, PNG, range(0, len(PNG), 256))
+        self.config.upload.sniff = SniffPolicy.REJECT
+        response = await self.client.post(f"/api/uploads/{upload_id}/finalize")
+        self.assertEqual(response.status, 415)
+        file_hash = hashlib.sha256(PNG).hexdigest()
+        self.assertFalse(self.app["blobs"].locate(file_hash).exists())
+        self.assertTrue(self.app["uploads"].part_path(upload_id).exists())
+
+        self.config.upload.sniff = SniffPolicy.SNIFFED
+        response = await self.client.post(f"/api/uploads/{upload_id}/finalize")
+        self.assertEqual(response.status, 200)
+        self.assertEqual((await response.json())["hash"], file_hash)
+        self.assertEqual(self.app["blobs"].locate(file_hash).read_bytes(), PNG)
+        self.assertFalse(self.app["uploads"].part_path(upload_id).exists())
+
+    async def test_expiry(self) -> None:
+        upload_id = await self.start(PNG, "image/png")
+        await self.send(upload_id, PNG, range(0, 512, 256))
+        collector: GarbageCollector = self.app["collector"]
+        self.assertEqual(await collector.expire_uploads(), 0)
+        self.config.gc.upload_max_age = 0
+        self.assertEqual(await collector.expire_uploads(), 1)
+        self.assertEqual((await self.client.get(f"/api/uploads/{upload_id}")).status, 404)
+        self.assertFalse(self.app["uploads"].part_path(upload_id).exists())
+        self.assertEqual(self.app["uploads"]._progress, {})
+
+
+class InstantUploadTest(AppTestCase):
+    async def instant(self) -> int:
+        response = await self.client.post("/api/uploads/instant", json={
+            "name": "again.png", "size": len(PNG), "hash": hashlib.sha256(PNG).hexdigest(), "type": "image/png",
+        })
+        return response.status
+
+    async def test_unreferenced_content(self) -> None:
+        form = FormData()
+        form.add_field("file", PNG, filename="first.png", content_type="image/png")
+        self.assertEqual((await self.client.post("/api/store", data=form)).status, 200)
+        async with self.app["sessions"]() as session:
+            repository = MediaRepository(session)
+            self.assertTrue(await repository.delete(await session.scalar(select(Media.media_id))))
+            await session.execute(update(file_infos).values(collecting_since=utcnow()))
+            await session.commit()
+        # the collector has claimed the row: the client has to send the bytes
+        self.assertEqual(await self.instant(), 404)
+        async with self.app["sessions"]() as session:
+            await session.execute(update(file_infos).values(collecting_since=None))
+            await session.commit()
+        self.assertEqual(await self.instant(), 200)
+        self.config.gc.grace = 0
+        self.assertEqual(await self.app["collector"].collect(), [])
+        self.assertTrue(self.app["blobs"].locate(hashlib.sha256(PNG).hexdigest()).exists())
+
+
+class UnknownLengthStoreTest(AppTestCase):
+    options = {"upload": {"unknown_length_size": 1000}}
+
+    async def store_chunked(self, data: bytes) -> int:
+        body = (
+            b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="streamed.bin"\r\n'
+            b"Content-Type: application/octet-stream\r\n\r\n" + data + b"\r\n--boundary--\r\n"
+        )
+
+        async def chunks() -> AsyncIterator[bytes]:
+            yield body
+
+        response = await self.client.post(
+            "/api/store", data=chunks(), headers={"Content-Type": "multipart/form-data; boundary=boundary"},
+        )
+        return response.status
+
+    async def test_reservation(self) -> None:
+        self.assertEqual(await self.store_chunked(os.urandom(500)), 200)
+        # held to what it was admitted as
+        self.assertEqual(await self.store_chunked(os.urandom(5000)), 413)
+        self.config.upload.unknown_length_size = 0
+        self.assertEqual(await self.store_chunked(os.urandom(500)), 411)
@@ -67,6 +67,81 @@ function getRetryButton(onclick) {
 	return retryBtn;
 }
 
+const CHUNK_CONCURRENCY = 4;
+
+function sendRequest(method, url, {body, json, onprogress, onxhr} = {}) {
+	return new Promise((resolve, reject) => {
+		const xhr = new XMLHttpRequest();
+		xhr.open(method, url);
+		xhr.setRequestHeader('Authorization', `Bearer ${localStorage.getItem("token")}`);
+		if (json !== undefined) {
+			xhr.setRequestHeader('Content-Type', 'application/json');
+			body = JSON.stringify(json);
+		};
+		if (onprogress) {
+			xhr.upload.onprogress = onprogress;
+		};
+		xhr.onload = () => {
+			if (xhr.status < 200 || xhr.status >= 300) {
+				reject(new Error(`${method} ${url} failed with status ${xhr.status} (${xhr.statusText})`));
+				return;
+			};
+			resolve(xhr.response ? JSON.parse(xhr.response) : null);
+		};
+		xhr.onerror = () => reject(new Error(`${method} ${url} failed`));
+		xhr.onabort = () => reject(new Error(`${method} ${url} aborted`));
+		if (onxhr) {
+			onxhr(xhr);
+		};
+		xhr.send(body);
+	});
+}
+
+async function uploadChunks(blob, upload, {onprogress, requests}) {
+	const {upload_id, size, chunk_size} = upload;
+	const received = new Set(upload.received);
+	const pending = [];
+	for (let offset = 0; offset < size; offset += chunk_size) {
+		if (!received.has(offset)) {
+			pending.push(offset);
+		};
+	};
+	const loaded = new Map();
+	received.forEach(offset => loaded.set(offset, Math.min(chunk_size, size - offset)));
+	const report = () => {
+		let total = 0;
+		loaded.forEach(value => total += value);
+		onprogress(total, size);
+	};
+	report();
+	let stopped = false;
+	const worker = async () => {
+		while (pending.length && !stopped) {
+			const offset = pending.shift();
+			const chunk = blob.slice(offset, offset + chunk_size);
+			await sendRequest('PUT', `/api/uploads/${upload_id}?offset=${offset}`, {
+				body: chunk,
+				onprogress: (progress) => {
+					loaded.set(offset, progress.loaded);
+					report();
+				},
+				onxhr: (xhr) => requests.add(xhr),
+			}).catch((error) => {
+				stopped = true;
+				throw error;
+			});
+			loaded.set(offset, chunk.size);
+			report();
+		};
+	};
+	const workers = [];
+	for (let i = 0; i < CHUNK_CONCURRENCY; i++) {
+		workers.push(worker());
+	};
+	await Promise.all(workers);
+	return await sendRequest('POST', `/api/uploads/${upload_id}/finalize`);
+}
+
 document.getElementById("fileLoadButton").onclick = (click) => {
 	click.preventDefault();
 	const form = document.createElement('form');
@@ -76,9 +151,8 @@ document.getElementById("fileLoadButton").onclick = (click) => {
 	form.append(file);
 	file.onchange = (change) => {
 		explanation.remove();
-		const name = file.files[0].name;
-		const data = new FormData(form);
-		const xhr = new XMLHttpRequest();
+		const blob = file.files[0];
+		const name = blob.name;
 		const container = createElement('div', {class: 'file-container'});
 		const progressEl = createElement('progress', {class: 'upload-progress'});
 		const speedEl = createElement('pre', {style: {'grid-area': 'speed'}});
@@ -91,34 +165,36 @@ document.getElementById("fileLoadButton").onclick = (click) => {
 		container.append(fileLink, progressEl, speedEl, cancelBtn);
 		files.append(container);
 		files.hidden = false;
-		xhr.open("POST", "/api/store");
-		cancelBtn.onclick = (click) => {
-			xhr.abort();
-		}
-		xhr.setRequestHeader('Authorization', `Bearer ${localStorage.getItem("token")}`);
-		xhr.upload.onprogress = (progress) => {
-			const {loaded, total} = progress;
+		const requests = new Set();
+		let uploadId = null;
+		let lastActve = new Date();
+		let lastLoaded = 0;
+		const onprogress = (loaded, total) => {
 			progressEl.max = total;
 			progressEl.value = loaded;
 			const currentTime = new Date();
 			const timeDeltaMs = currentTime - lastActve;
 			const loadedDelta = loaded - lastLoaded;
-			const speed = loadedDelta*1000 / timeDeltaMs;
-			speedEl.innerHTML = asHumanReadable(speed, 'B/s');
-			//let percents = (loaded/total*100).toFixed(2);
-			//console.log(`Loaded ${percents}% (${loaded}/${total})`);
+			if (timeDeltaMs > 0) {
+				const speed = loadedDelta*1000 / timeDeltaMs;
+				speedEl.innerHTML = asHumanReadable(Math.max(speed, 0), 'B/s');
+			};
 			lastActve = currentTime;
 			lastLoaded = loaded;
 		};
-		xhr.onload = (event) => {
-			if (xhr.status!=200) {
-				console.error(`File load request failed with status ${xhr.status} (${xhr.statusText})`);
-				const retryBtn = getRetryButton();
-				cancelBtn.replaceWith(retryBtn);
-                progressEl.classList.add("failed");
-				return;
-			}
-			const info = JSON.parse(xhr.response);
+		const onfail = (error) => {
+			console.error(error);
+			requests.forEach(xhr => xhr.abort());
+			requests.clear();
+			const retryBtn = getRetryButton(() => {
+				retryBtn.replaceWith(cancelBtn);
+				progressEl.classList.remove("failed");
+				start();
+			});
+			cancelBtn.replaceWith(retryBtn);
+			progressEl.classList.add("failed");
+		};
+		const onload = (info) => {
 			fileLink.href = "./file.html#";
 			const copyBtn = createElement('button', {class: 'copy-btn'});
 			const copyImage = createElement('img', {style: {height: '100%'}});
@@ -128,15 +204,31 @@ document.getElementById("fileLoadButton").onclick = (click) => {
 			progressEl.remove();
 			speedEl.remove();
 		};
-		xhr.onerror = xhr.onabort = (event) => {
-			const retryBtn = getRetryButton();
-			cancelBtn.replaceWith(retryBtn);
-            progressEl.classList.add("failed");
-			speedEl.remove();
-        };
-		let lastActve = new Date();
-		let lastLoaded = 0;
-		xhr.send(data);
+		const start = async () => {
+			try {
+				if (uploadId === null) {
+					const hash = await hashBlob(blob);
+					const instant = await sendRequest('POST', '/api/uploads/instant', {
+						json: {name: name, size: blob.size, type: blob.type, hash: hash},
+					}).catch(() => null);
+					if (instant) {
+						onload(instant);
+						return;
+					};
+				};
+				const upload = uploadId === null
+					? await sendRequest('POST', '/api/uploads', {json: {name: name, size: blob.size, type: blob.type}})
+					: await sendRequest('GET', `/api/uploads/${uploadId}`);
+				uploadId = upload.upload_id;
+				onload(await uploadChunks(blob, upload, {onprogress, requests}));
+			} catch (error) {
+				onfail(error);
+			};
+		};
+		cancelBtn.onclick = (click) => {
+			requests.forEach(xhr => xhr.abort());
+		};
+		start();
 	};
 	file.click();
 }
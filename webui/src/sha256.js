@@ -0,0 +1,103 @@
+const _SHA256_K = new Uint32Array([
+	0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+	0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+	0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+	0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+	0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+	0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+	0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+	0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+]);
+
+class Sha256 {
+	constructor() {
+		this.state = new Uint32Array([
+			0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+			0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19
+		]);
+		this.block = new Uint8Array(64);
+		this.blockLength = 0;
+		this.length = 0;
+		this.words = new Uint32Array(64);
+	}
+
+	update(data) {
+		let position = 0;
+		this.length += data.length;
+		if (this.blockLength) {
+			const take = Math.min(64 - this.blockLength, data.length);
+			this.block.set(data.subarray(0, take), this.blockLength);
+			this.blockLength += take;
+			position = take;
+			if (this.blockLength < 64) {
+				return this;
+			};
+			this._compress(this.block, 0);
+			this.blockLength = 0;
+		};
+		for (; position + 64 <= data.length; position += 64) {
+			this._compress(data, position);
+		};
+		this.block.set(data.subarray(position), 0);
+		this.blockLength = data.length - position;
+		return this;
+	}
+
+	hexdigest() {
+		const bitLength = this.length * 8;
+		const padding = new Uint8Array(((this.blockLength < 56) ? 56 : 120) - this.blockLength + 8);
+		padding[0] = 0x80;
+		const view = new DataView(padding.buffer);
+		view.setUint32(padding.length - 8, Math.floor(bitLength / 2**32));
+		view.setUint32(padding.length - 4, bitLength >>> 0);
+		this.update(padding);
+		return Array.from(this.state, word => word.toString(16).padStart(8, '0')).join('');
+	}
+
+	_compress(data, offset) {
+		const w = this.words;
+		for (let i = 0; i < 16; i++) {
+			const j = offset + i * 4;
+			w[i] = (data[j] << 24) | (data[j + 1] << 16) | (data[j + 2] << 8) | data[j + 3];
+		};
+		for (let i = 16; i < 64; i++) {
+			const x = w[i - 15], y = w[i - 2];
+			const s0 = ((x >>> 7) | (x << 25)) ^ ((x >>> 18) | (x << 14)) ^ (x >>> 3);
+			const s1 = ((y >>> 17) | (y << 15)) ^ ((y >>> 19) | (y << 13)) ^ (y >>> 10);
+			w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+		};
+		let [a, b, c, d, e, f, g, h] = this.state;
+		for (let i = 0; i < 64; i++) {
+			const S1 = ((e >>> 6) | (e << 26)) ^ ((e >>> 11) | (e << 21)) ^ ((e >>> 25) | (e << 7));
+			const ch = (e & f) ^ (~e & g);
+			const t1 = (h + S1 + ch + _SHA256_K[i] + w[i]) | 0;
+			const S0 = ((a >>> 2) | (a << 30)) ^ ((a >>> 13) | (a << 19)) ^ ((a >>> 22) | (a << 10));
+			const maj = (a & b) ^ (a & c) ^ (b & c);
+			const t2 = (S0 + maj) | 0;
+			h = g; g = f; f = e; e = (d + t1) | 0;
+			d = c; c = b; b = a; a = (t1 + t2) | 0;
+		};
+		const state = this.state;
+		state[0] += a; state[1] += b; state[2] += c; state[3] += d;
+		state[4] += e; state[5] += f; state[6] += g; state[7] += h;
+	}
+}
+
+const HASH_SLICE_SIZE = 4 * 1024 * 1024;
+const SUBTLE_HASH_LIMIT = 64 * 1024 * 1024;
+
+async function hashBlob(blob, onprogress) {
+	if (blob.size <= SUBTLE_HASH_LIMIT && window.crypto && crypto.subtle) {
+		const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+		return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+	};
+	const hasher = new Sha256();
+	for (let offset = 0; offset < blob.size; offset += HASH_SLICE_SIZE) {
+		const slice = blob.slice(offset, offset + HASH_SLICE_SIZE);
+		hasher.update(new Uint8Array(await slice.arrayBuffer()));
+		if (onprogress) {
+			onprogress(Math.min(offset + HASH_SLICE_SIZE, blob.size), blob.size);
+		};
+	};
+	return hasher.hexdigest();
+}